@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批次失敗時二分找出壞檔（batched driver 用）
+------------------------------------------------
+一支壞掉的影片讓整批 evaluate 失敗時，不再整批標成失敗：
+  - 整批失敗 → 切兩半各自重跑（遞迴）
+  - 只有部分影片失敗 → 只拿失敗的那些重跑
+  - 縮到剩一支還是失敗 → 寫進 quarantine 檔，結果保留失敗標記
+    （整批每一支都失敗就不隔離：多半是環境壞了，不是影片）
+好的影片結果直接保留；重跑用的是同一批已轉好的 mp4（consumer 等整批結束才刪暫存檔）。
+
+    preds = bisect_batch(bucket, lambda rows, tag: run_vbench_batch(rows, ...),
+                         failed=lambda row, preds: ..., quarantine=Quarantine(QUAR_FILE))
+
+一支壞檔在 N 支的批次裡約多跑 2·log2(N) 次 evaluate，總工作量不超過 ~2N 支。
+"""
+import os, time
+
+
+class Quarantine:
+    """隔離名單：<path> 每行 videoid \\t 影片路徑 \\t 原因 \\t 時間（多 process append）"""
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, vid, video_path, reason):
+        reason = " ".join(str(reason).split())[:500]
+        line = f"{vid}\t{video_path}\t{reason}\t{time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))      # 一行一次 write，O_APPEND 不會交錯
+        finally:
+            os.close(fd)
+
+    def ids(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, encoding="utf-8", errors="ignore") as f:
+            return {line.split("\t", 1)[0] for line in f if line.strip()}
+
+
+def bisect_batch(rows, run, failed, quarantine=None, key=lambda r: r[1],
+                 path=lambda r: r[0], log=print, tag="0"):
+    """
+    rows   : [(mp4, vid, url), ...]
+    run    : (rows, tag) -> {key: 結果}；丟 exception 視為整批失敗（tag 給子批次當輸出目錄名）
+    failed : (row, preds) -> bool，這支影片的結果算不算失敗
+    return : {key: 結果}；失敗的影片保留最後一次（失敗）的結果，沒有的不放
+
+    整批每一支都失敗時不隔離：比較可能是環境 / evaluate 本身壞了，不是這些影片壞，
+    隔離了之後的 run 會把整批好影片永遠跳過。至少有一支成功、失敗是孤立的才寫 quarantine。
+    """
+    leaves = []
+    out = _bisect(rows, run, failed, key, log, tag, leaves)
+    if len(leaves) == len(rows):
+        log(f"[BISECT] {tag}: all {len(rows)} failed, not quarantining (likely not the videos)")
+        return out
+    for r, reason in leaves:
+        log(f"[QUARANTINE] {key(r)}\t{reason}")
+        if quarantine is not None:
+            quarantine.add(key(r), path(r), reason)
+    return out
+
+def _bisect(rows, run, failed, key, log, tag, leaves):
+    """遞迴本體；縮到一支還失敗的 (row, 原因) 放進 leaves，由 bisect_batch 決定要不要隔離"""
+    try:
+        preds = run(rows, tag)
+        err = ""
+    except Exception as e:
+        preds, err = {}, f"{type(e).__name__}: {e}"
+    bad = [r for r in rows if failed(r, preds)]
+    out = {key(r): preds[key(r)] for r in rows if key(r) in preds and r not in bad}
+    if not bad:
+        return out
+
+    if len(rows) == 1:
+        r = rows[0]
+        leaves.append((r, err or f"result={preds.get(key(r), 'missing')}"))
+        if key(r) in preds:
+            out[key(r)] = preds[key(r)]
+        return out
+
+    if len(bad) < len(rows):                    # 部分失敗：只重跑失敗的
+        parts = [bad]
+    else:                                       # 整批失敗：切兩半
+        mid = len(rows) // 2
+        parts = [rows[:mid], rows[mid:]]
+    log(f"[BISECT] {tag}: {len(bad)}/{len(rows)} failed{' (' + err + ')' if err else ''}"
+        f" → retry {'+'.join(str(len(p)) for p in parts)}")
+    for i, part in enumerate(parts):
+        out.update(_bisect(part, run, failed, key, log, f"{tag}.{i}", leaves))
+    return out
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批次 pipeline：第 N 批在 evaluate 時，第 N+1 批已經在收集 / staging
+------------------------------------------------
+原本 consumer 是「湊滿 → 寫 batch tsv → evaluate → parse → 寫結果 → 刪暫存」一路串行，
+evaluate 時 consumer 不拉 queue，producer 轉完的檔塞滿 queue 後連轉檔都停了，
+evaluate 前後的 I/O 時間 GPU 又閒著。
+
+    pipe = BatchPipeline(evaluate, finish, depth=2, stage=stage)
+    pipe.submit(job)        # caller thread 跑 stage（建目錄、預讀 mp4），再排進 evaluate queue
+    ...
+    pipe.close()            # 等全部做完；任何 stage 的 exception 會在這裡 re-raise
+
+  stage    (caller thread) : 準備輸入（寫 tsv、posix_fadvise 預讀）
+  evaluate (eval thread)   : 一次只跑一批（GPU 上同時只有一個 evaluator）
+  finish   (finish thread) : parse 後寫結果、刪暫存檔，不佔 evaluate 的時間
+
+depth = 已 staged、等著 evaluate 的批次上限（submit 超過就擋住 → backpressure）；
+depth=0 時 submit 直接同步跑完三個 stage（舊行為）。
+tracer（trace_spans.Tracer）有給時，每批的 stage / evaluate / finish 各記一個 span（args 帶 job["idx"]）。
+"""
+import os, queue, threading, contextlib
+
+_STOP = object()
+
+
+def prefetch(paths):
+    """把下一批的 mp4 先讀進 page cache（evaluate 開檔時不用等磁碟 / 網路）"""
+    for p in paths:
+        try:
+            fd = os.open(p, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except (AttributeError, OSError):
+            pass
+        finally:
+            os.close(fd)
+
+
+class BatchPipeline:
+    def __init__(self, evaluate, finish, depth=1, stage=None, tracer=None):
+        self.evaluate = evaluate
+        self.finish = finish
+        self.stage = stage
+        self.depth = max(0, int(depth))
+        self.tracer = tracer
+        self._err = None
+        if self.depth:
+            self._eval_q = queue.Queue(self.depth)
+            self._fin_q = queue.Queue(self.depth)
+            self._threads = [threading.Thread(target=self._eval_loop, daemon=True),
+                             threading.Thread(target=self._finish_loop, daemon=True)]
+            for t in self._threads:
+                t.start()
+
+    def submit(self, job):
+        self._raise()
+        if self.stage:
+            with self._span("stage", job):
+                self.stage(job)
+        if not self.depth:
+            with self._span("evaluate", job):
+                res = self.evaluate(job)
+            with self._span("finish", job):
+                self.finish(job, res)
+            return
+        with self._span("submit_wait", job):    # eval queue 滿了 = evaluate 是瓶頸
+            self._eval_q.put(job)
+
+    def close(self):
+        if self.depth:
+            self._eval_q.put(_STOP)
+            for t in self._threads:
+                t.join()
+        self._raise()
+
+    # ───────────── threads ─────────────
+    def _span(self, name, job):
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name, cat="batch", batch=job.get("idx") if isinstance(job, dict) else None)
+
+    def _raise(self):
+        if self._err is not None:
+            err, self._err = self._err, None
+            raise err
+
+    def _eval_loop(self):
+        if self.tracer is not None:
+            self.tracer.name_thread("evaluate")
+        while True:
+            job = self._eval_q.get()
+            if job is _STOP:
+                self._fin_q.put(_STOP)
+                return
+            try:
+                with self._span("evaluate", job):
+                    res = self.evaluate(job)
+            except BaseException as e:          # 讓 caller 在下一次 submit / close 看到
+                self._err = self._err or e
+                continue
+            self._fin_q.put((job, res))
+
+    def _finish_loop(self):
+        if self.tracer is not None:
+            self.tracer.name_thread("finish")
+        while True:
+            item = self._fin_q.get()
+            if item is _STOP:
+                return
+            try:
+                with self._span("finish", item[0]):
+                    self.finish(*item)
+            except BaseException as e:
+                self._err = self._err or e
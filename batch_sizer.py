@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批次大小控制（batched driver 的 consumer 用）
+------------------------------------------------
+    sizer = BatchSizer(200, lo=8, hi=400, target_secs=600, adaptive=True)
+    if len(bucket) >= sizer.size or sizer.expired(bucket_t0): flush()
+    sizer.observe(n, elapsed, n_failed)      # 每批跑完回報 → 調整下一批大小
+
+- deadline : bucket 裡最舊的影片等超過 deadline 秒就先送，不等湊滿（輸入斷斷續續時結果不會卡在記憶體）
+- adaptive : 一批跑太久（> target）就照比例縮、跑很快且是滿批就放大（每次最多 ×1.5 / ÷2）；
+             失敗比例 > fail_hi 時直接減半，壞檔拖垮的範圍變小
+evaluate 每批有固定的模型載入成本，批越大 throughput 越好；target_secs 是「第一筆結果最久等多久」的上限。
+"""
+import time
+
+
+class BatchSizer:
+    def __init__(self, size, lo=1, hi=None, target_secs=600.0, deadline=0.0,
+                 adaptive=False, fail_hi=0.2):
+        self.size = max(1, int(size))
+        self.lo = max(1, int(lo))
+        self.hi = int(hi) if hi else self.size
+        self.target_secs = target_secs
+        self.deadline = deadline
+        self.adaptive = adaptive
+        self.fail_hi = fail_hi
+        self.history = []           # [(n, elapsed, n_failed, next_size), ...]
+
+    def expired(self, t0, now=None):
+        """bucket 最早一筆進來的時間 t0 → 是否該 deadline flush"""
+        return bool(self.deadline) and t0 is not None and (now or time.time()) - t0 >= self.deadline
+
+    def wait_timeout(self, t0):
+        """q.get 最多等多久（None = 一直等）"""
+        if not self.deadline or t0 is None:
+            return None
+        return max(0.0, self.deadline - (time.time() - t0))
+
+    def observe(self, n, elapsed, n_failed=0):
+        """一批跑完：回報大小 / 秒數 / 失敗支數；return 下一批大小"""
+        prev = self.size
+        if self.adaptive and n > 0:
+            fail_rate = n_failed / n
+            if fail_rate > self.fail_hi:
+                new = prev // 2
+            elif elapsed > self.target_secs:
+                new = max(prev // 2, int(prev * self.target_secs / elapsed))
+            elif n >= prev and elapsed < 0.8 * self.target_secs:
+                new = min(int(prev * 1.5), int(prev * self.target_secs / max(elapsed, 1e-3)))
+            else:
+                new = prev
+            self.size = min(self.hi, max(self.lo, new))
+        self.history.append((n, elapsed, n_failed, self.size))
+        return self.size
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VBench driver 端到端 throughput benchmark（離線、純 CPU 可跑）
+------------------------------------------------
+⚙  python bench_drivers.py --work_dir /tmp/vbench_bench --n_videos 24 \
+        --modes v21,v21_convert4,nondist_b8,nondist_b8_pipe,camera_b8 --out bench.json
+
+1. 用 ffmpeg testsrc 產生合成影片（長度 / 解析度 / 容器混合：.mp4 h264、.mov h264、.mov mpeg4），
+   同一組參數重跑會沿用已經產生的檔案
+2. work_dir 放一支 stub evaluate_safe.py（driver 都是呼叫 ./evaluate_safe.py）：
+     --stub sleep  : 每次呼叫固定 --stub_load_secs（模擬載模型）+ 每支 --stub_secs
+     --stub decode : 載模型時間 + 真的用 ffmpeg 把每支 decode 一遍（吃 CPU，看得出 oversubscription）
+   --scorer real 時不放 stub，改在 --real_cwd（預設 repo 根目錄，需有 vbench）跑真的 evaluate
+3. 每個 mode 各自一個乾淨的 output 目錄，開 --metrics 跑完整個 driver，記錄：
+     videos_per_sec、ttfr_secs（第一個 [PROGRESS]）、wall_secs、
+     peak_rss_mb（整棵 process tree 的 RSS 總和峰值）、peak_proc_rss_mb（單一 process 峰值）、
+     rows（output.txt 行數）、stages（driver 的 metrics.json：各 stage count / sum / p50 / p90）
+
+自訂 mode：--mode_args 'name=script.py --flag 1 ...'（可重複）；--extra_args 加在每個 mode 後面。
+
+CPU oversubscription（--cpu_plan / --pin_cpus）要在多核機器上用會吃 CPU 的 stub 比：
+    python bench_drivers.py --stub decode --modes v21_p4,v21_p4_cpuplan --n_videos 48 --repeat 2
+decode stub 照 driver 設的 CPU_PLAN_THREADS 開 ffmpeg -threads（沒設 = 每支都開滿核心數）。
+"""
+import os, sys, json, time, shlex, random, signal, shutil, argparse, threading, contextlib, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# name → driver 與參數（stub 沒辦法跑 --warm_workers / --shared_decode，那兩個要 --scorer real）
+MODES = {
+    "v21":             ["vbench_script_v21.py"],
+    "v21_convert4":    ["vbench_script_v21.py", "--convert_workers", "4"],
+    "v21_auto_score":  ["vbench_script_v21.py", "--convert_workers", "4",
+                        "--convert_plan", "auto", "--convert_profile", "score"],
+    "v21_p2":          ["vbench_script_v21.py", "--max_video_processes", "2", "--convert_workers", "2"],
+    "v21_p4":          ["vbench_script_v21.py", "--max_video_processes", "4", "--convert_workers", "2"],
+    "v21_p4_cpuplan":  ["vbench_script_v21.py", "--max_video_processes", "4", "--convert_workers", "2",
+                        "--cpu_plan", "--pin_cpus"],
+    "nondist_b8":      ["vbench_script_nondist_v2.py", "--batch_size", "8"],
+    "nondist_b8_pipe": ["vbench_script_nondist_v2.py", "--batch_size", "8", "--pipeline_depth", "1",
+                        "--convert_workers", "2"],
+    "camera_b8":       ["vbench_script_camera_motion_v2.py", "--batch_size", "8"],
+    "camera_adaptive": ["vbench_script_camera_motion_v2.py", "--batch_size", "4", "--adaptive_batch",
+                        "--batch_max", "16", "--batch_target_secs", "10", "--batch_deadline", "5"],
+}
+
+DURATIONS = (2, 5, 10, 20)
+SIZES = ("320x240", "640x360", "1280x720")
+KINDS = (("mp4", "libx264"), ("mov", "libx264"), ("mov", "mpeg4"))
+
+
+def ffmpeg_exe():
+    exe = shutil.which("ffmpeg")
+    if exe:
+        return exe
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+# ───────────── 合成影片 ─────────────
+def make_corpus(corpus_dir, n, seed=0, workers=4, fps=30):
+    """return [(path, vid, duration, size, container, codec), ...]；manifest 一樣就沿用"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    rnd = random.Random(seed)
+    specs = []
+    for i in range(n):
+        dur, size, (ext, codec) = rnd.choice(DURATIONS), rnd.choice(SIZES), KINDS[i % len(KINDS)]
+        vid = f"bench{i:04d}"
+        specs.append((os.path.join(corpus_dir, f"{vid}_{size}_{dur}s_{codec}.{ext}"), vid, dur, size, ext, codec))
+
+    exe = ffmpeg_exe()
+
+    def gen(spec):
+        path, _, dur, size, _, codec = spec
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            return
+        enc = (["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"] if codec == "libx264"
+               else ["-c:v", "mpeg4", "-q:v", "5"])
+        tmp = f"{path}.part{os.path.splitext(path)[1]}"
+        subprocess.run([exe, "-hide_banner", "-loglevel", "error", "-y",
+                        "-f", "lavfi", "-i", f"testsrc=size={size}:rate={fps}:duration={dur}",
+                        *enc, tmp], check=True)
+        os.replace(tmp, path)
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(gen, specs))
+    print(f"[BENCH] corpus {corpus_dir}: {n} videos ready in {time.time() - t0:.1f}s", flush=True)
+    return specs
+
+def write_inputs(specs, work_dir):
+    """v21 / nondist：vpath, vid, vq, url；camera：vpath, vid, _, _, url"""
+    four, five = os.path.join(work_dir, "input4.tsv"), os.path.join(work_dir, "input5.tsv")
+    with open(four, "w") as f4, open(five, "w") as f5:
+        for path, vid, *_ in specs:
+            print("\t".join([path, vid, "0.1", f"http://bench/{vid}"]), file=f4)
+            print("\t".join([path, vid, "", "", f"http://bench/{vid}"]), file=f5)
+    return four, five
+
+
+# ───────────── stub scorer ─────────────
+STUB = r'''#!/usr/bin/env python3
+# bench_drivers.py 產生的 stub：參數同 evaluate_safe.py，輸出格式同 VBench 的結果 json
+import os, sys, json, time, zlib, shutil, argparse, subprocess
+p = argparse.ArgumentParser()
+for a in ("--videos_path", "--dimension", "--mode", "--output_path", "--result_file", "--entry_script"):
+    p.add_argument(a)
+a, _ = p.parse_known_args()
+MODE, LOAD, PER = os.environ.get("BENCH_STUB", "sleep"), float(os.environ.get("BENCH_STUB_LOAD", "1")), \
+    float(os.environ.get("BENCH_STUB_SECS", "0.2"))
+if a.videos_path.endswith(".tsv"):
+    videos = [l.split("\t")[0] for l in open(a.videos_path) if l.strip()]
+else:
+    videos = [a.videos_path]
+time.sleep(LOAD)                                    # 模擬載模型
+exe = shutil.which("ffmpeg")
+if MODE == "decode" and not exe:
+    import imageio_ffmpeg; exe = imageio_ffmpeg.get_ffmpeg_exe()
+threads = os.environ.get("CPU_PLAN_THREADS")        # driver --cpu_plan 分到的；空 = ffmpeg 自己決定（≈ 核心數）
+items = []
+for v in videos:
+    if MODE == "decode":
+        subprocess.run([exe, "-hide_banner", "-loglevel", "error", *(["-threads", threads] if threads else []),
+                        "-i", v, "-f", "null", "-"], check=True)
+    else:
+        time.sleep(PER)
+    score = (zlib.crc32(os.path.basename(v).encode()) % 1000) / 1000
+    items.append({"video_path": os.path.abspath(v), "video_results": score, "predict_type": ["static"]})
+dim = a.dimension
+res = {dim: [sum(i["video_results"] for i in items) / len(items), items, items]}
+os.makedirs(os.path.dirname(os.path.abspath(a.result_file)), exist_ok=True)
+with open(a.result_file, "w") as f:
+    json.dump(res, f)
+'''
+
+
+# ───────────── 量測 ─────────────
+def _children(root):
+    """root 底下整棵 process tree 的 pid（讀 /proc/*/stat 的 ppid）"""
+    parent = {}
+    for d in os.listdir("/proc"):
+        if not d.isdigit():
+            continue
+        try:
+            with open(f"/proc/{d}/stat") as f:
+                st = f.read()
+            parent[int(d)] = int(st[st.rfind(")") + 2:].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    tree, frontier = {root}, [root]
+    while frontier:
+        nxt = [p for p, pp in parent.items() if pp in frontier and p not in tree]
+        tree.update(nxt)
+        frontier = nxt
+    return tree
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def run_mode(name, argv, work_dir, cwd, input4, input5, extra, env, timeout):
+    out_dir = os.path.join(work_dir, "out", name)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    shutil.rmtree(os.path.join(cwd, "tmp"), ignore_errors=True)      # driver 的 TMP_DIR
+    script = argv[0]
+    tsv = input5 if "camera_motion" in script else input4
+    cmd = [sys.executable, os.path.join(REPO, script), "--input_tsv", tsv, "--output_path", out_dir,
+           "--metrics", "--metrics_interval", "5", *argv[1:], *extra]
+    print(f"[BENCH] {name}: {' '.join(shlex.quote(c) for c in cmd)}", flush=True)
+
+    log_path = os.path.join(work_dir, f"{name}.log")
+    t0 = time.time()
+    first = [None]
+    peak = {"tree": 0, "proc": 0}
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, bufsize=1)
+
+        def sample():
+            while proc.poll() is None:
+                tree = _children(proc.pid)
+                if time.time() - t0 > timeout:      # 卡死的 driver：整棵 kill，stdout 才會結束
+                    peak["timeout"] = True
+                    for p in tree:
+                        with contextlib.suppress(OSError):
+                            os.kill(p, signal.SIGKILL)
+                    return
+                rss = [_rss_kb(p) for p in tree]
+                peak["tree"] = max(peak["tree"], sum(rss))
+                peak["proc"] = max(peak["proc"], max(rss, default=0))
+                time.sleep(0.2)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        for line in proc.stdout:
+            log.write(line)
+            if first[0] is None and line.startswith("[PROGRESS]"):
+                first[0] = time.time() - t0
+        rc = proc.wait()
+        sampler.join()
+        if peak.get("timeout"):
+            rc = "timeout"
+    wall = time.time() - t0
+
+    out_file = os.path.join(out_dir, "output.txt")
+    rows = sum(1 for line in open(out_file) if line.strip()) if os.path.exists(out_file) else 0
+    stages = {}
+    mpath = os.path.join(out_dir, "metrics.json")
+    if os.path.exists(mpath):
+        with open(mpath) as f:
+            m = json.load(f)
+        stages = {k: {x: v[x] for x in ("count", "sum", "mean", "p50", "p90")} for k, v in m["stages"].items()}
+    return {
+        "mode": name, "cmd": cmd[1:], "rc": rc, "rows": rows,
+        "wall_secs": round(wall, 3),
+        "videos_per_sec": round(rows / wall, 4) if wall else None,
+        "ttfr_secs": round(first[0], 3) if first[0] is not None else None,
+        "peak_rss_mb": round(peak["tree"] / 1024, 1),
+        "peak_proc_rss_mb": round(peak["proc"] / 1024, 1),
+        "stages": stages, "log": log_path,
+    }
+
+
+# ───────────── main ─────────────
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--work_dir", default="./bench_work")
+    ap.add_argument("--n_videos", type=int, default=24)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--modes", default="v21,v21_convert4,nondist_b8,nondist_b8_pipe,camera_b8",
+                    help=f"逗號分隔；內建：{', '.join(MODES)}")
+    ap.add_argument("--mode_args", action="append", default=[],
+                    help="自訂 mode：'name=script.py --flag v ...'（可重複）")
+    ap.add_argument("--extra_args", default="", help="加在每個 mode 後面的參數")
+    ap.add_argument("--scorer", choices=("stub", "real"), default="stub")
+    ap.add_argument("--real_cwd", default=REPO, help="--scorer real：driver 的 cwd（要有 evaluate_safe.py / vbench）")
+    ap.add_argument("--stub", choices=("sleep", "decode"), default="sleep")
+    ap.add_argument("--stub_load_secs", type=float, default=1.0, help="stub 每次呼叫的固定成本（模擬載模型）")
+    ap.add_argument("--stub_secs", type=float, default=0.2, help="--stub sleep：每支影片幾秒")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--timeout", type=float, default=3600)
+    ap.add_argument("--out", default="bench_results.json")
+    args = ap.parse_args()
+
+    modes = dict(MODES)
+    for spec in args.mode_args:
+        name, _, rest = spec.partition("=")
+        modes[name.strip()] = shlex.split(rest)
+    names = [m.strip() for m in args.modes.split(",") if m.strip()]
+    for extra_name in (s.partition("=")[0].strip() for s in args.mode_args):
+        if extra_name not in names:
+            names.append(extra_name)
+    unknown = [n for n in names if n not in modes]
+    if unknown:
+        raise SystemExit(f"unknown modes: {unknown}")
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    specs = make_corpus(os.path.join(work_dir, "corpus"), args.n_videos, args.seed)
+    input4, input5 = write_inputs(specs, work_dir)
+
+    env = os.environ.copy()
+    if args.scorer == "stub":
+        cwd = work_dir
+        with open(os.path.join(work_dir, "evaluate_safe.py"), "w") as f:
+            f.write(STUB)
+        env.update(BENCH_STUB=args.stub, BENCH_STUB_LOAD=str(args.stub_load_secs),
+                   BENCH_STUB_SECS=str(args.stub_secs))
+    else:
+        cwd = os.path.abspath(args.real_cwd)
+    env["PYTHONUNBUFFERED"] = "1"
+
+    results = []
+    for r in range(args.repeat):
+        for name in names:
+            res = run_mode(name, modes[name], work_dir, cwd, input4, input5,
+                           shlex.split(args.extra_args), env, args.timeout)
+            res["repeat"] = r
+            results.append(res)
+            print(f"[BENCH] {name}: {res['rows']} rows in {res['wall_secs']:.1f}s "
+                  f"→ {res['videos_per_sec']} videos/s, ttfr={res['ttfr_secs']}s, "
+                  f"peak_rss={res['peak_rss_mb']}MB rc={res['rc']}", flush=True)
+
+    report = {
+        "host": {"cpus": os.cpu_count(), "python": sys.version.split()[0]},
+        "corpus": {"n": len(specs), "seed": args.seed, "dir": os.path.join(work_dir, "corpus"),
+                   "mix": {f"{ext}/{codec}": sum(1 for s in specs if s[4] == ext and s[5] == codec)
+                           for ext, codec in KINDS},
+                   "total_secs": sum(s[2] for s in specs)},
+        "scorer": args.scorer if args.scorer == "real" else
+                  {"stub": args.stub, "load_secs": args.stub_load_secs, "secs_per_video": args.stub_secs},
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\n{'mode':<20}{'videos/s':>10}{'ttfr':>8}{'wall':>8}{'rss MB':>9}")
+    for res in results:
+        print(f"{res['mode']:<20}{res['videos_per_sec'] or 0:>10.3f}{res['ttfr_secs'] or -1:>8.1f}"
+              f"{res['wall_secs']:>8.1f}{res['peak_rss_mb']:>9.0f}")
+    print(f"[BENCH] → {args.out}")
+
+if __name__ == "__main__":
+    main()
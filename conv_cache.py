@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+轉檔結果快取（content fingerprint + 轉檔設定 → mp4）
+------------------------------------------------
+    cache = ConversionCache("/data/conv_cache", max_bytes=200 << 30)
+    key   = cache.key(src, "auto|center|score")
+    hit   = cache.get(key)                      # 命中回傳路徑，並更新 LRU 時間
+    if not hit:
+        tmp = cache.tmp_path(key)               # ffmpeg 先寫到暫存名
+        ...convert src → tmp...
+        hit = cache.put(key, tmp)               # os.replace 原子搬進快取，再依預算淘汰
+
+- key 用檔案大小 + 頭 / 中 / 尾各 1MB 的 sha1，搬家、改名、不同 driver 都能命中
+- LRU 時鐘就是 entry 的 mtime（命中時 os.utime 更新）
+- 多個 driver process 同時用：寫入靠暫存檔 + os.replace，淘汰時拿 flock；
+  最近 grace 秒內被用過的 entry 不淘汰，避免砍掉 queue 裡正要被讀的檔
+"""
+import os, time, uuid, fcntl, hashlib, contextlib
+
+_CHUNK = 1 << 20
+
+
+def fingerprint(path):
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        for off in sorted({0, max(0, size // 2 - _CHUNK // 2), max(0, size - _CHUNK)}):
+            f.seek(off)
+            h.update(f.read(_CHUNK))
+    return h.hexdigest()
+
+
+class ConversionCache:
+    def __init__(self, root, max_bytes, grace=3600):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.grace = grace
+        os.makedirs(root, exist_ok=True)
+        self._lock_path = os.path.join(root, ".lock")
+
+    def key(self, src, variant, fp=None):
+        """variant：會影響輸出內容的轉檔設定（plan / window / profile）；fp：已算好的 fingerprint"""
+        v = hashlib.sha1(variant.encode()).hexdigest()[:12]
+        return f"{fp or fingerprint(src)}_{v}"
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def tmp_path(self, key):
+        return os.path.join(self.root, f".{key}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp.mp4")
+
+    def get(self, key):
+        p = self.path(key)
+        try:
+            os.utime(p)             # touch = 更新 LRU
+        except FileNotFoundError:
+            return None
+        return p
+
+    def put(self, key, tmp):
+        p = self.path(key)
+        os.replace(tmp, p)          # 兩個 process 同時轉同一支 → 後到的覆蓋，內容相同
+        self.evict(keep=p)
+        return p
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self._lock_path, "a") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def evict(self, keep=None):
+        """超過 max_bytes 就從最久沒用的開始刪；return 刪掉的 bytes"""
+        freed = 0
+        with self._locked():
+            entries, total = [], 0
+            for e in os.scandir(self.root):
+                if not e.name.endswith(".mp4") or e.name.startswith("."):
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+            if total <= self.max_bytes:
+                return 0
+            now = time.time()
+            for mtime, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if p == keep or now - mtime < self.grace:
+                    continue
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                freed += size
+        if freed:
+            print(f"[CACHE] evicted {freed / 2**20:.1f} MB from {self.root}", flush=True)
+        return freed
+
+    def clean_stale_tmp(self, max_age=86400):
+        """清掉 crash 留下的暫存檔"""
+        now = time.time()
+        for e in os.scandir(self.root):
+            if e.name.endswith(".tmp.mp4"):
+                with contextlib.suppress(FileNotFoundError):
+                    if now - e.stat().st_mtime > max_age:
+                        os.remove(e.path)
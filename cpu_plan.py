@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPU 核心分配 / thread 數預算（VBench drivers 用）
+------------------------------------------------
+每個 consumer 開的 torch / OpenCV / ffmpeg 預設都開「核心數」個 thread，
+--max_video_processes 8 時整台機器被 oversubscribe 好幾倍，context switch 比算分還多。
+CpuPlan 把可用核心（目前的 affinity，或 --cpus 指定）切給 producer 與各 consumer：
+  - producer : --producer_cpus 個（0 = 自動：min(convert_workers, 核心數 / (consumer 數 + 1))），
+               每個轉檔 worker 的 ffmpeg -threads = producer 核心數 / convert_workers
+  - consumer : 剩下的平均分；核心比 consumer 少時輪流共用，每個 1 thread
+在各 process 一開始 apply()：設 OMP_NUM_THREADS 等環境變數（evaluate 子程序、之後才 import 的
+torch / cv2 都吃這組），已經 import 的 torch / cv2 直接設；pin=True 時再 sched_setaffinity
+（子程序會繼承）。
+
+    cpus = CpuPlan(n_consumers, convert_workers, pin=True) if args.cpu_plan else NULL
+    Process(target=cpus.wrap(consumer, "consumer", i), args=...)     # fork 才能傳 closure
+"""
+import os, sys
+
+# 各家 thread pool 讀的環境變數；CPU_PLAN_THREADS 給 driver 自己的子程序 / stub 參考
+THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+              "VECLIB_MAXIMUM_THREADS", "OPENCV_FOR_THREADS_NUM", "CPU_PLAN_THREADS")
+
+
+def parse_cpus(spec):
+    """'0-7,16,18-19' → [0, 1, ..., 7, 16, 18, 19]"""
+    out = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        out.extend(range(int(lo), int(hi or lo) + 1))
+    return sorted(set(out))
+
+def available_cpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:                  # 非 Linux
+        return list(range(os.cpu_count() or 1))
+
+def set_threads(n):
+    """這個 process 之後開的 thread pool / 子程序都用 n 個 thread"""
+    for k in THREAD_ENV:
+        os.environ[k] = str(n)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(n)
+    if "cv2" in sys.modules:
+        sys.modules["cv2"].setNumThreads(n)
+
+
+class CpuPlan:
+    def __init__(self, n_consumers, convert_workers=1, cpus=None, producer_cpus=0, pin=False):
+        cpus = list(cpus or available_cpus())
+        n_consumers = max(1, n_consumers)
+        if producer_cpus <= 0:
+            producer_cpus = max(1, min(convert_workers, len(cpus) // (n_consumers + 1)))
+        producer_cpus = min(producer_cpus, max(1, len(cpus) - n_consumers))
+        self.pin = pin
+        self.producer = cpus[:producer_cpus]
+        rest = cpus[producer_cpus:] or cpus
+        if len(rest) >= n_consumers:        # 平均分，多的核心給前面幾個
+            per, extra = divmod(len(rest), n_consumers)
+            self.consumers, i = [], 0
+            for c in range(n_consumers):
+                k = per + (c < extra)
+                self.consumers.append(rest[i:i + k])
+                i += k
+        else:                               # 核心不夠：輪流共用，每個 consumer 1 thread
+            self.consumers = [[rest[c % len(rest)]] for c in range(n_consumers)]
+        self.ffmpeg_threads = max(1, len(self.producer) // max(1, convert_workers))
+
+    def cpus_for(self, role, slot=0):
+        return self.producer if role == "producer" else self.consumers[slot % len(self.consumers)]
+
+    def apply(self, role, slot=0):
+        cpus = self.cpus_for(role, slot)
+        set_threads(len(cpus))
+        if self.pin:
+            os.sched_setaffinity(0, cpus)
+        if role == "producer":
+            from video_convert import set_ffmpeg_threads
+            set_ffmpeg_threads(self.ffmpeg_threads)
+        return cpus
+
+    def wrap(self, target, role, slot=0):
+        def run(*a, **kw):
+            self.apply(role, slot)
+            return target(*a, **kw)
+        return run
+
+    def describe(self):
+        pin = "pinned" if self.pin else "threads only"
+        lines = [f"[CPU] plan ({pin}): producer cpus={_span(self.producer)} ffmpeg -threads {self.ffmpeg_threads}"]
+        for i, c in enumerate(self.consumers):
+            lines.append(f"[CPU]   consumer {i}: cpus={_span(c)} threads={len(c)}")
+        return "\n".join(lines)
+
+
+def _span(cpus):
+    """[0,1,2,5] → '0-2,5'"""
+    out, start = [], None
+    for i, c in enumerate(cpus):
+        if start is None:
+            start = c
+        if i + 1 == len(cpus) or cpus[i + 1] != c + 1:
+            out.append(f"{start}-{c}" if c != start else f"{c}")
+            start = None
+    return ",".join(out)
+
+
+class _NullPlan:
+    def apply(self, *a, **kw): return None
+    def wrap(self, target, *a, **kw): return target
+    def describe(self): return ""
+
+NULL = _NullPlan()
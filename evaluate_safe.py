@@ -1,6 +1,28 @@
 import os
+import sys
+import glob
+import json
+import time
+import runpy
 import importlib
 
+# ------------------------------------------------------------------
+# 0) 本 wrapper 自己的參數（先從 sys.argv 拿掉，剩下的原封不動交給 evaluate CLI）
+#    --result_file  : 呼叫端指定的結果檔，driver 不用再掃 output_path 找最新 json
+#    --entry_script : 改跑其他 evaluate 腳本（例如 ./vbench_cust/evaluate_i2v.py）
+# ------------------------------------------------------------------
+def _pop_arg(name):
+    if name not in sys.argv:
+        return None
+    i = sys.argv.index(name)
+    val = sys.argv[i + 1]
+    del sys.argv[i:i + 2]
+    return val
+
+result_file = _pop_arg("--result_file")
+entry_script = _pop_arg("--entry_script")
+_start = time.time()
+
 # ------------------------------------------------------------------
 # 1) **關掉單進程時的 torch.distributed.init_process_group**
 #    => 避免重複監聽 29500
@@ -20,7 +42,61 @@ if not hasattr(dist_mod, "_orig_dist_init"):
     dist_mod.dist_init = patched_dist_init
 
 # ------------------------------------------------------------------
-# 2) 呼叫原生 evaluate CLI
+# 2) 結果另外寫一份到 --result_file（tmp + os.replace，讀的人不會看到半個檔）
+#    VBench / VBenchI2V 都是透過自己 module 裡的 save_json 寫 *_eval_results.json
 # ------------------------------------------------------------------
-from vbench.launch import evaluate
-evaluate.main()
\ No newline at end of file
+def _write_result(data):
+    tmp = f"{result_file}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, result_file)
+
+def _wrap_save_json(orig):
+    def save_json(data, path, *a, **k):
+        orig(data, path, *a, **k)
+        if str(path).endswith("_eval_results.json"):
+            _write_result(data)
+    save_json._orig = orig
+    return save_json
+
+if result_file:
+    importlib.import_module("vbench")
+    try:
+        importlib.import_module("vbench2_beta_i2v")
+    except ImportError:
+        pass
+    for name, mod in list(sys.modules.items()):
+        fn = getattr(mod, "save_json", None) if name.startswith("vbench") else None
+        if callable(fn) and not hasattr(fn, "_orig"):
+            mod.save_json = _wrap_save_json(fn)
+
+# ------------------------------------------------------------------
+# 3) 呼叫原生 evaluate CLI（或 --entry_script）
+# ------------------------------------------------------------------
+def _fallback_result():
+    """
+    entry script 若透過沒被包到的 module 存檔（例如自己 import 的 save_json），--result_file 不會被寫；
+    這時從 --output_path 撿這次 run 寫出的最新 *_eval_results.json 複製過去
+    """
+    if not result_file or os.path.exists(result_file) or "--output_path" not in sys.argv:
+        return
+    out_dir = sys.argv[sys.argv.index("--output_path") + 1]
+    found = [p for p in glob.glob(os.path.join(out_dir, "*_eval_results.json"))
+             if os.path.getmtime(p) >= _start]
+    if found:
+        with open(max(found, key=os.path.getmtime)) as f:
+            _write_result(json.load(f))
+
+try:
+    if entry_script:
+        sys.argv[0] = entry_script
+        runpy.run_path(entry_script, run_name="__main__")
+    else:
+        from vbench.launch import evaluate
+        evaluate.main()
+except SystemExit as e:         # CLI 正常結束也可能 sys.exit(0)
+    if e.code not in (None, 0):
+        raise
+    _fallback_result()
+    raise
+_fallback_result()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+已處理 video id 的精簡索引（取代 resume 時整個 set(str)）
+------------------------------------------------
+<path>      : 排序好的 64-bit hash（uint64 little-endian），mmap 後直接二分搜尋
+<path>.log  : 之後 commit 的 hash，append-only、未排序；開檔時讀進小 set
+
+1000 萬筆只佔 80MB 磁碟、幾乎不吃 RAM（page cache 按需載入），開檔近乎 0 秒。
+hash 為 blake2b-64；1000 萬筆的碰撞機率約 3e-6，誤判的後果只是少跑一支影片。
+
+    idx = ProcessedIndex.open(IDX_FILE, seed_from=OUT_FILE)   # 第一次會從 OUT_FILE 建
+    if vid in idx: ...
+    ResultSink(..., on_commit=IdIndexAppender(IDX_FILE))     # row commit 後增量寫入
+"""
+import os, sys, mmap, fcntl, struct, bisect, hashlib, contextlib
+from array import array
+
+_U64 = struct.Struct("<Q")
+
+
+def hash64(vid):
+    return _U64.unpack(hashlib.blake2b(str(vid).encode("utf-8"), digest_size=8).digest())[0]
+
+
+@contextlib.contextmanager
+def _locked(path):
+    with open(f"{path}.lock", "a") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+def _read_u64(path):
+    a = array("Q")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        a.frombytes(data[: len(data) - len(data) % 8])
+        if sys.byteorder != "little":
+            a.byteswap()
+    return a
+
+def append_hashes(path, hashes):
+    """增量加入（寫 .log）；多個 process 同時 append 靠 O_APPEND，每次寫入都是完整 8 bytes 的倍數"""
+    if not hashes:
+        return
+    buf = b"".join(_U64.pack(h) for h in hashes)
+    fd = os.open(f"{path}.log", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, buf)
+    finally:
+        os.close(fd)
+
+def compact(path):
+    """base + log 合併、排序、去重後原子換掉 base，清空 log"""
+    with _locked(path):
+        base, log = _read_u64(path), _read_u64(f"{path}.log")
+        try:
+            import numpy as np      # 千萬筆時 np.unique 比 Python set 省好幾 GB
+            merged = np.unique(np.concatenate([np.frombuffer(base, dtype=np.uint64),
+                                               np.frombuffer(log, dtype=np.uint64)]))
+            out = array("Q", merged.tobytes())
+        except ImportError:
+            out = array("Q", sorted(set(base) | set(log)))
+        n = len(out)
+        if sys.byteorder != "little":
+            out.byteswap()
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "wb") as f:
+            out.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        open(f"{path}.log", "wb").close()
+    return n
+
+def seed_from_tsv(path, tsv, col=0, chunk=100000):
+    """舊的 output.txt → 索引（只在索引還不存在時跑一次）"""
+    buf = []
+    with open(tsv, newline="", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            vid = line.rstrip("\r\n").split("\t")[col] if line.strip() else None
+            if vid:
+                buf.append(hash64(vid))
+            if len(buf) >= chunk:
+                append_hashes(path, buf); buf = []
+    append_hashes(path, buf)
+    return compact(path)
+
+
+class ProcessedIndex:
+    def __init__(self, path):
+        self.path = path
+        self._mm, self._base = None, memoryview(b"").cast("Q")
+        if os.path.exists(path) and os.path.getsize(path) >= 8 and sys.byteorder == "little":
+            with open(path, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            n = len(self._mm) - len(self._mm) % 8
+            self._base = memoryview(self._mm)[:n].cast("Q")
+        elif os.path.exists(path):
+            self._base = _read_u64(path)            # big-endian 機器：直接讀進 RAM
+        self._extra = set(_read_u64(f"{path}.log"))
+
+    @classmethod
+    def open(cls, path, seed_from=None, compact_ratio=0.1):
+        """seed_from：索引不存在時用來建索引的 TSV（第一欄是 videoid）"""
+        if not os.path.exists(path):
+            if seed_from and os.path.exists(seed_from):
+                n = seed_from_tsv(path, seed_from)
+                print(f"[INDEX] built {path} from {seed_from}: {n} ids", flush=True)
+            else:
+                compact(path)
+        elif os.path.exists(f"{path}.log"):
+            base_n = os.path.getsize(path) // 8
+            log_n = os.path.getsize(f"{path}.log") // 8
+            if log_n and log_n > compact_ratio * max(base_n, 1):
+                compact(path)
+        return cls(path)
+
+    def __contains__(self, vid):
+        h = hash64(vid)
+        if h in self._extra:
+            return True
+        i = bisect.bisect_left(self._base, h)
+        return i < len(self._base) and self._base[i] == h
+
+    def __len__(self):
+        return len(self._base) + len(self._extra)
+
+    def add(self, vids):
+        hs = [hash64(v) for v in vids]
+        append_hashes(self.path, hs)
+        self._extra.update(hs)
+
+
+class IdIndexAppender:
+    """給 ResultSink.on_commit 用：row commit 之後把 videoid 加進索引（可 pickle，spawn 也能用）"""
+    def __init__(self, path, key="videoid"):
+        self.path = path
+        self.key = key
+
+    def __call__(self, rows):
+        hs = []
+        for r in rows:
+            if isinstance(r, dict):
+                vid = r.get(self.key)
+            elif isinstance(r, str):
+                vid = r.split("\t", 1)[0]
+            else:
+                vid = r[0] if r else None
+            if vid:
+                hs.append(hash64(vid))
+        append_hashes(self.path, hs)
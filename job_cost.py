@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+每支影片的處理成本估計（給 --convert_order lpt 排程用）
+------------------------------------------------
+cost（秒）≈ 轉檔 + 評分
+  轉檔 : decode / encode 的 frame 數 × 百萬像素 × 每 MP-frame 秒數 × codec 係數
+         auto 且 codec 可 remux → 幾乎 0；center 視窗 → decode 到中間 + encode 6 秒
+  評分 : Σ 各維度歷史平均秒數（ledger，沒有就用預設）× 解析度比例（1080p = 1）
+         scorer 只看中間 5 秒，長度影響的是 decode 到中間那段（cv2 依序讀）
+
+絕對值不準沒關係，LPT 只需要相對大小：長的 4K .mov 排最前面，
+consumer 搶 queue 時最後剩下的都是短的 → 尾巴變短。
+probe 不到的影片退回用檔案大小估。
+"""
+import os
+from video_convert import probe_video, needs_conversion, REMUX_CODECS, CONVERT_PROFILES
+
+REF_MP = 1920 * 1080 / 1e6
+DECODE_S_PER_MPF = 0.0016       # x264 1080p CPU decode ~300 fps
+ENCODE_S_PER_MPF = {"fast": 0.008, "ultrafast": 0.003}
+CODEC_FACTOR = {"hevc": 1.5, "av1": 2.0, "vp9": 1.4, "prores": 1.2, "mpeg4": 0.8}
+DEFAULT_DIM_SECS = 3.0          # 沒有歷史時，每個維度在 1080p 上的秒數
+BYTES_PER_SEC = 2 << 20         # probe 失敗時：每 2MB 當 1 秒
+
+
+def estimate_cost(info, dims, dim_secs=None, plan="transcode", window="full", preset="fast"):
+    """plan=None：不用轉檔（--skip_conversion 或 needs_conversion 說不用轉）"""
+    w, h = info.get("width"), info.get("height")
+    fps, dur = info.get("fps"), info.get("duration")
+    if not (w and h and fps and dur):
+        return None
+    mp = w * h / 1e6
+    codec = (info.get("codec") or "").lower()
+    k = CODEC_FACTOR.get(codec, 1.0)
+    frames = fps * dur
+
+    if plan is None or (plan == "auto" and codec in REMUX_CODECS):
+        conv = 0.0
+    elif window == "center":
+        conv = mp * k * (frames / 2 + 3 * fps) * DECODE_S_PER_MPF + \
+            mp * 6 * fps * ENCODE_S_PER_MPF.get(preset, 0.008)
+    else:
+        conv = mp * k * frames * (DECODE_S_PER_MPF + ENCODE_S_PER_MPF.get(preset, 0.008))
+
+    dim_secs = dim_secs or {}
+    score = sum(dim_secs.get(d, DEFAULT_DIM_SECS) for d in dims) * mp / REF_MP
+    # scorer 依序 decode 到中間；center 視窗轉出來的檔只剩中間那段
+    seek = mp * k * (3 * fps if plan and window == "center" else frames / 2) * DECODE_S_PER_MPF
+    return conv + score + seek
+
+
+def make_cost_fn(dims, probe=None, dim_secs=None, plan="transcode", window="full",
+                 profile="default", convert=True):
+    """
+    return task -> cost（task[0] 是影片路徑），給 run_convert_pool(order="lpt") 用
+    probe   : probe_index.ProbeIndex（有就查 index，沒有就 probe_video）
+    convert : False（--skip_conversion）時不算轉檔成本；要不要轉照 needs_conversion（同 driver）
+    """
+    lookup = probe.lookup if probe is not None else probe_video
+    preset = CONVERT_PROFILES[profile]["preset"]
+
+    def cost(task):
+        path = task[0]
+        try:
+            info = lookup(path)
+            conv_plan = plan if convert and needs_conversion(path, info) else None
+            c = estimate_cost(info, dims, dim_secs, conv_plan, window, preset)
+        except Exception:
+            c = None
+        if c is None:
+            try:
+                c = os.path.getsize(path) / BYTES_PER_SEC
+            except OSError:
+                c = 0.0
+        return c
+
+    return cost
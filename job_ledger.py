@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite (WAL) job ledger：每個 (videoid, dimension) 一筆狀態
+------------------------------------------------
+state : pending → running → done / failed
+欄位  : attempts、started / finished / elapsed、score、err
+
+resume 不再掃 output.txt 收集第一欄：
+  - 「失敗給 -1」跟「真的算出 -1」分得開（state 不同）
+  - 只有缺的那個維度會重跑（todo() 回傳每支影片還缺哪些 dim）
+  - 上次 crash 時停在 running 的也會被撿回來
+
+每個 process 各自開 connection（fork 後自動重連），寫入都很短，busy_timeout 等鎖即可；
+parent fork 之前先 close()，不把開著的 connection 帶進子程序。
+第一次開（ledger 檔還不存在）時用 seed_from_tsv() 把舊 output.txt 裡算出來的分數（非 -1）標成 done，
+從舊 resume 方式切過來的第一個 run 才不會整批重算、重複寫 row。
+
+    ledger = JobLedger(os.path.join(out_dir, "ledger.sqlite"))
+    if ledger.created: ledger.seed_from_tsv(out_file, dims)
+    ledger.enqueue(vids, dims)                  # INSERT OR IGNORE
+    todo = ledger.todo(max_attempts)            # {videoid: [缺的 dim, ...]}
+    ledger.close()                              # fork 之前
+    ledger.start(vid, dim); ledger.finish(vid, dim, score, elapsed) / ledger.fail(...)
+"""
+import os, csv, time, sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    videoid  TEXT NOT NULL,
+    dim      TEXT NOT NULL,
+    state    TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    score    REAL,
+    err      TEXT,
+    started  REAL,
+    finished REAL,
+    elapsed  REAL,
+    PRIMARY KEY (videoid, dim)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, videoid);
+"""
+
+
+class JobLedger:
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self.created = not os.path.exists(path)
+        self.conn.executescript(_SCHEMA)
+
+    def __getstate__(self):
+        return {"path": self.path, "timeout": self.timeout, "_conn": None, "_pid": None}
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._conn, self._pid = c, os.getpid()
+        return self._conn
+
+    def close(self):
+        """關掉這個 process 的 connection（之後用到會再開）；fork 子程序前呼叫"""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = self._pid = None
+
+    # ───────────── enqueue / query ─────────────
+    def enqueue(self, videoids, dims, chunk=50000):
+        """沒出現過的 (videoid, dim) 才新增為 pending；return 新增筆數"""
+        c, added, buf = self.conn, 0, []
+
+        def _flush():
+            nonlocal added
+            c.execute("BEGIN")
+            cur = c.executemany("INSERT OR IGNORE INTO jobs (videoid, dim) VALUES (?, ?)", buf)
+            c.execute("COMMIT")
+            added += cur.rowcount
+            buf.clear()
+
+        for vid in videoids:
+            buf.extend((vid, d) for d in dims)
+            if len(buf) >= chunk:
+                _flush()
+        if buf:
+            _flush()
+        return added
+
+    def seed_from_tsv(self, path, dims, first_col=2, chunk=50000):
+        """
+        舊 output（videoid \t Imgurl \t dims...，沒有 header）裡非 -1 的分數標成 done；
+        同一支出現多次時 done 不會被後面的 -1 蓋掉。return 標成 done 的筆數
+        """
+        if not os.path.exists(path):
+            return 0
+        c, seeded, buf = self.conn, 0, []
+
+        def _flush():
+            nonlocal seeded
+            c.execute("BEGIN")
+            cur = c.executemany(
+                "INSERT INTO jobs (videoid, dim, state, score) VALUES (?, ?, 'done', ?) "
+                "ON CONFLICT (videoid, dim) DO UPDATE SET state='done', score=excluded.score", buf)
+            c.execute("COMMIT")
+            seeded += cur.rowcount
+            buf.clear()
+
+        with open(path, newline="", encoding="utf-8", errors="ignore") as f:
+            for row in csv.reader(f, delimiter="\t"):
+                if not row:
+                    continue
+                for dim, val in zip(dims, row[first_col:first_col + len(dims)]):
+                    try:
+                        score = float(val)
+                    except ValueError:
+                        continue
+                    if score != -1:
+                        buf.append((row[0], dim, score))
+                if len(buf) >= chunk:
+                    _flush()
+        if buf:
+            _flush()
+        return seeded
+
+    def todo(self, max_attempts=None):
+        """{videoid: [還沒 done 的 dim, ...]}；max_attempts 有給時跳過失敗太多次的"""
+        sql = "SELECT videoid, dim FROM jobs WHERE state != 'done'"
+        params = ()
+        if max_attempts is not None:
+            sql += " AND attempts < ?"
+            params = (max_attempts,)
+        out = {}
+        for vid, dim in self.conn.execute(sql, params):
+            out.setdefault(vid, []).append(dim)
+        return out
+
+    def missing(self, videoid, dims, max_attempts=None):
+        """dims 裡還沒 done 的；max_attempts 有給時也不算失敗太多次的"""
+        sql = "SELECT dim FROM jobs WHERE videoid = ? AND state = 'done'"
+        params = (videoid,)
+        if max_attempts is not None:
+            sql = "SELECT dim FROM jobs WHERE videoid = ? AND (state = 'done' OR attempts >= ?)"
+            params = (videoid, max_attempts)
+        skip = {d for (d,) in self.conn.execute(sql, params)}
+        return [d for d in dims if d not in skip]
+
+    def scores(self, videoid):
+        """已 done 的 {dim: score}"""
+        return dict(self.conn.execute(
+            "SELECT dim, score FROM jobs WHERE videoid = ? AND state = 'done'", (videoid,)))
+
+    def mean_elapsed(self):
+        """{dim: 已 done 的平均秒數}（給 job_cost 當歷史成本）"""
+        return dict(self.conn.execute(
+            "SELECT dim, AVG(elapsed) FROM jobs WHERE state = 'done' AND elapsed IS NOT NULL GROUP BY dim"))
+
+    def counts(self):
+        return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    # ───────────── state transitions ─────────────
+    def start(self, videoid, dim):
+        self.conn.execute(
+            "INSERT INTO jobs (videoid, dim, state, attempts, started) VALUES (?, ?, 'running', 1, ?) "
+            "ON CONFLICT (videoid, dim) DO UPDATE SET state='running', attempts=attempts+1, "
+            "started=excluded.started, finished=NULL, err=NULL",
+            (videoid, dim, time.time()))
+
+    def finish(self, videoid, dim, score, elapsed=None):
+        self._end(videoid, dim, "done", score, None, elapsed)
+
+    def fail(self, videoid, dim, err, elapsed=None, score=None):
+        self._end(videoid, dim, "failed", score, err, elapsed)
+
+    def _end(self, videoid, dim, state, score, err, elapsed):
+        self.conn.execute(
+            "INSERT INTO jobs (videoid, dim, state, score, err, finished, elapsed) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (videoid, dim) DO UPDATE SET state=excluded.state, score=excluded.score, "
+            "err=excluded.err, finished=excluded.finished, elapsed=excluded.elapsed",
+            (videoid, dim, state, score, err, time.time(), elapsed))
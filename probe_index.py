@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+影片 metadata 的 sidecar index（每支影片整個 corpus 只 probe 一次）
+------------------------------------------------
+key   : path；size / mtime_ns 對不上就當作沒 probe 過（檔案被換掉會自動重 probe）
+value : probe_video() 的 codec / width / height / fps / nb_frames / duration，
+        以及（選）conv_cache.fingerprint，轉檔快取算 key 時不用再讀 3MB
+
+先對整個 TSV 平行 probe 一次：
+    python probe_index.py --input_tsv videos.tsv --index probe.sqlite --workers 32 [--fingerprint]
+
+之後 driver 帶 --probe_index probe.sqlite（convert_video 查 index 決定 remux / 中間視窗），
+Tarsier 在 data config 的 video_sampling_strategy.probe_index 指到同一個檔（VisionParser 取 duration）。
+index 裡沒有的影片照常 probe，結果也會寫回去。
+
+SQLite WAL；每個 process / thread 各自開 connection，多個 driver 同時讀寫都可以。
+"""
+import os, sys, time, sqlite3, argparse, threading
+
+from video_convert import probe_video
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path      TEXT PRIMARY KEY,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    codec     TEXT,
+    width     INTEGER,
+    height    INTEGER,
+    fps       REAL,
+    nb_frames INTEGER,
+    duration  REAL,
+    fp        TEXT,
+    probed    REAL
+) WITHOUT ROWID;
+"""
+_FIELDS = ("codec", "width", "height", "fps", "nb_frames", "duration")
+
+
+class ProbeIndex:
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.conn.executescript(_SCHEMA)
+
+    def __getstate__(self):
+        return {"path": self.path, "timeout": self.timeout}
+
+    def __setstate__(self, st):
+        self.__dict__.update(st)
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        loc = self._local
+        if getattr(loc, "conn", None) is None or loc.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            loc.conn, loc.pid = c, os.getpid()
+        return loc.conn
+
+    # ───────────── read ─────────────
+    def _row(self, path, st):
+        return self.conn.execute(
+            f"SELECT {', '.join(_FIELDS)}, fp FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, st.st_size, st.st_mtime_ns)).fetchone()
+
+    def get(self, path, fingerprint=False):
+        """index 裡有且檔案沒變 → info dict；否則 None（fingerprint=True 時還要有 fp）"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        r = self._row(path, st)
+        if not r or (fingerprint and not r[-1]):
+            return None
+        return dict(zip(_FIELDS, r[:-1]))
+
+    # ───────────── write ─────────────
+    def put(self, path, info, st=None, fp=None):
+        st = st or os.stat(path)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO probes (path, size, mtime_ns, {', '.join(_FIELDS)}, fp, probed) "
+            f"VALUES (?, ?, ?, {', '.join('?' * len(_FIELDS))}, ?, ?)",
+            (path, st.st_size, st.st_mtime_ns, *(info.get(k) for k in _FIELDS), fp, time.time()))
+
+    def lookup(self, path, fingerprint=False):
+        """probe_video() 的替代品：有就直接回傳，沒有就 probe 一次並寫回 index"""
+        st = os.stat(path)
+        r = self._row(path, st)
+        if r and (r[-1] or not fingerprint):
+            return dict(zip(_FIELDS, r[:-1]))
+        info = dict(zip(_FIELDS, r[:-1])) if r else probe_video(path)
+        self.put(path, info, st, _fingerprint(path) if fingerprint else None)
+        return info
+
+    def fingerprint(self, path):
+        """conv_cache.fingerprint 的快取版"""
+        st = os.stat(path)
+        r = self._row(path, st)
+        if r and r[-1]:
+            return r[-1]
+        fp = _fingerprint(path)
+        self.put(path, dict(zip(_FIELDS, r[:-1])) if r else probe_video(path), st, fp)
+        return fp
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+
+
+def _fingerprint(path):
+    from conv_cache import fingerprint
+    return fingerprint(path)
+
+
+# ───────────── CLI：整個 TSV 平行 probe ─────────────
+def probe_tsv(index, tsv, col=0, workers=16, fingerprint=False, log_every=1000):
+    """return {"hit": n, "probed": n, "missing": n, "failed": n}"""
+    from tsv_stream import stream_checked
+
+    def check(row):
+        if len(row) <= col:
+            return None
+        p = row[col]
+        if not os.path.exists(p):
+            return "missing"
+        try:
+            if index.get(p, fingerprint) is not None:
+                return "hit"
+            index.lookup(p, fingerprint)
+            return "probed"
+        except Exception as e:
+            print(f"[PROBE] ✗ {p}: {e}", flush=True)
+            return "failed"
+
+    counts = {"hit": 0, "probed": 0, "missing": 0, "failed": 0}
+    tic = time.time()
+    for i, res in enumerate(stream_checked(tsv, check, workers), 1):
+        counts[res] += 1
+        if i % log_every == 0:
+            print(f"[PROBE] {i} rows {time.time() - tic:.1f}s {counts}", flush=True)
+    return counts
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="平行 probe 整個 TSV，結果寫進 sidecar index")
+    ap.add_argument("--input_tsv", required=True)
+    ap.add_argument("--index", required=True, help="sidecar index（SQLite）路徑")
+    ap.add_argument("--col", type=int, default=0, help="影片路徑在第幾欄")
+    ap.add_argument("--workers", type=int, default=16)
+    ap.add_argument("--fingerprint", action="store_true",
+                    help="順便算轉檔快取用的 content fingerprint（多讀每支 3MB）")
+    a = ap.parse_args(argv)
+    tic = time.time()
+    counts = probe_tsv(ProbeIndex(a.index), a.input_tsv, a.col, a.workers, a.fingerprint)
+    print(f"[PROBE] done {time.time() - tic:.1f}s {counts} → {a.index}", flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+結果寫檔元件（VBench drivers / Tarsier runners 共用）
+------------------------------------------------
+所有 consumer 把 row 丟進同一個 queue，由單一 writer process 負責：
+  - 累積成批再 append（batch_rows 筆或 flush_secs 秒）
+  - 每 fsync_secs 秒 fsync 一次，而不是每行一次
+  - fsync 後寫 commit marker（<path>.commit，內容為已落盤的 byte offset）
+    重跑時 start() 會先把 <path> 截到 marker 的 offset → 沒 commit 的半行 / 殘行丟掉，
+    resume 掃描只會看到完整 row（丟掉的 row 會被當成沒做過，重跑即可）。
+    marker 記著檔案的 inode：檔案被整個換掉（手動合併後 mv 回來…）或沒有 marker 的舊檔，
+    只去掉不完整的最後一行；在原檔後面手動 append 的 row 要保留時用 adopt_appended=True
+
+    sink = ResultSink(OUT_FILE, ["videoid", "Imgurl", "motion_smoothness", "dynamic_degree"])
+    sink.start()                  # 先 recover 再開 writer；要在讀 resume 之前呼叫
+    ... Process(target=consumer, args=(q, sink, ...)) ...
+    sink.write(row)               # dict（依 fields）、list/tuple（TSV）或已排好的字串
+    sink.close()                  # 送 stop，writer 把剩下的寫完、fsync、commit 後結束
+
+ResultSink 可以直接當 Process 參數傳給子程序（pickle 時只帶 queue）。
+"""
+import os, io, csv, json, time, queue
+import multiprocessing as mp
+
+_STOP = "__SINK_STOP__"
+
+
+def commit_path(path):
+    return f"{path}.commit"
+
+def read_commit(path):
+    try:
+        with open(commit_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_commit(path, offset, rows):
+    tmp = f"{commit_path(path)}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"offset": offset, "rows": rows, "ino": os.stat(path).st_ino, "time": time.time()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, commit_path(path))
+
+def _complete_lines(path, size):
+    """去掉最後不完整的一行後的長度（整個檔都沒有換行 → 0）"""
+    with open(path, "rb") as f:
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+    cut = tail.rfind(b"\n")
+    if tail and not tail.endswith(b"\n") and (cut >= 0 or len(tail) == size):
+        return size - len(tail) + cut + 1
+    return size
+
+def recover(path, adopt_appended=False):
+    """
+    有 marker 就把 path 截到最後一次 commit 的 offset（writer crash 前沒 commit 的 row 一律丟掉：
+    on_commit 沒看過它們，留著會跟 id index 對不上、resume 重跑後變成重複 row）。
+    沒有 marker 的舊檔、marker 的 inode 跟檔案對不上（檔案被換掉），或 adopt_appended=True
+    （commit 之後手動 append 了別台機器的結果）時不信 offset，只去掉最後不完整的一行
+    """
+    if not os.path.exists(path):
+        return 0
+    st = os.stat(path)
+    size = st.st_size
+    meta = read_commit(path)
+    foreign = meta is not None and meta.get("ino", st.st_ino) != st.st_ino
+    if meta is not None and not foreign and not adopt_appended:
+        keep = min(meta["offset"], size)
+    else:
+        if foreign:
+            print(f"[SINK] recover {path}: commit marker is for another file, keeping complete rows", flush=True)
+        keep = _complete_lines(path, size)
+    if keep < size:
+        with open(path, "r+b") as f:
+            f.truncate(keep)
+        print(f"[SINK] recover {path}: dropped {size - keep} uncommitted bytes", flush=True)
+    _write_commit(path, keep, (meta or {}).get("rows", 0))
+    return keep
+
+
+class ResultSink:
+    def __init__(self, path, fields=None, batch_rows=256, flush_secs=1.0, fsync_secs=5.0,
+                 on_commit=None, metrics=None, adopt_appended=False):
+        """
+        fields         : dict row 的欄位順序（csv.DictWriter, tab 分隔）；None 則只收 list / str
+        on_commit      : 在 writer process 裡、每次 commit 後以 [已 commit 的 row, ...] 呼叫
+        metrics        : stage_metrics.StageMetrics；記 write / fsync 耗時與寫出的 row 數
+        adopt_appended : start() 時保留 commit 之後別人 append 的完整 row（見 recover）
+        """
+        self.path = path
+        self.fields = list(fields) if fields else None
+        self.batch_rows = batch_rows
+        self.flush_secs = flush_secs
+        self.fsync_secs = fsync_secs
+        self.on_commit = on_commit
+        self.metrics = metrics
+        self.adopt_appended = adopt_appended
+        self.q = mp.Queue()
+        self._proc = None
+
+    def __getstate__(self):
+        st = self.__dict__.copy()
+        st["_proc"] = None          # 子程序只需要 queue
+        return st
+
+    def start(self):
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        recover(self.path, self.adopt_appended)
+        self._proc = mp.Process(target=_writer_loop, daemon=True,
+                                args=(self.q, self.path, self.fields, self.batch_rows,
+                                      self.flush_secs, self.fsync_secs, self.on_commit, self.metrics))
+        self._proc.start()
+        return self
+
+    def write(self, row):
+        self.q.put(row)
+
+    def close(self):
+        if self._proc is None:
+            return
+        self.q.put(_STOP)
+        self._proc.join()
+        self._proc = None
+
+
+def _writer_loop(q, path, fields, batch_rows, flush_secs, fsync_secs, on_commit, metrics=None):
+    buf = io.StringIO()
+    dict_writer = csv.DictWriter(buf, fields, delimiter="\t") if fields else None
+    list_writer = csv.writer(buf, delimiter="\t")
+    pending, uncommitted = [], []
+    rows_total = (read_commit(path) or {}).get("rows", 0)
+    last_flush = last_sync = time.time()
+    stop = False
+
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        synced = f.tell()
+        while not stop:
+            try:
+                item = q.get(timeout=flush_secs)
+                items = [item]
+                while len(items) < batch_rows:          # 一次把 queue 裡現有的都拿出來
+                    try:
+                        items.append(q.get_nowait())
+                    except queue.Empty:
+                        break
+            except queue.Empty:
+                items = []
+
+            for item in items:
+                if item == _STOP:
+                    stop = True
+                    continue
+                if isinstance(item, str):
+                    buf.write(item if item.endswith("\n") else item + "\n")
+                elif isinstance(item, dict):
+                    dict_writer.writerow(item)
+                else:
+                    list_writer.writerow(item)
+                pending.append(item)
+
+            now = time.time()
+            if pending and (stop or len(pending) >= batch_rows or now - last_flush >= flush_secs):
+                tic = time.time()
+                f.write(buf.getvalue())
+                f.flush()
+                buf.seek(0); buf.truncate()
+                if metrics:
+                    metrics.observe("write", time.time() - tic)
+                    metrics.inc("rows_written", len(pending))
+                uncommitted.extend(pending)
+                pending, last_flush = [], now
+
+            if f.tell() != synced and (stop or now - last_sync >= fsync_secs):
+                tic = time.time()
+                os.fsync(f.fileno())
+                if metrics:
+                    metrics.observe("fsync", time.time() - tic)
+                synced, last_sync = f.tell(), now
+                rows_total += len(uncommitted)
+                _write_commit(path, synced, rows_total)
+                if on_commit:
+                    on_commit(uncommitted)
+                uncommitted = []
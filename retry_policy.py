@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+失敗分類 + 重試（VBench drivers 用）
+------------------------------------------------
+classify(err_tag, detail) : 暫時性（OOM、port 撞到、被 OOM killer 殺、超時…）→ TRANSIENT，
+                            確定是影片本身的問題（壞檔、PARSE_ERR…）→ PERMANENT，
+                            其餘認不出來的 CLI_FAIL / NO_JSON → UNKNOWN：照樣重試，次數用完才進 dead-letter
+                            （環境壞掉——少 module、連不到 HF hub——的錯誤多半長這樣，不能第一次就判死）
+RetryPolicy              : 最多幾次、指數 backoff（±20% jitter，避免同時 OOM 的 consumer 又同時重來）
+RetryLane                : consumer 自己的低優先序重試 lane（heap，依到期時間）；
+                           主 queue 有東西就先做主 queue，主 queue 空了 / 收到 sentinel 後才做到期的重試
+CircuitBreaker           : 同一個錯誤簽章連續出現在 N 支不同影片 → 多半是環境壞了，整個 run 停下來，
+                           不寫 dead-letter（修好環境重跑就好）
+永久失敗寫進 dead-letter TSV（格式同 quarantine.tsv），之後的 run 直接跳過，不再重跑已知的壞檔。
+
+    policy = RetryPolicy(max_attempts=3, backoff=30)
+    lane = RetryLane(policy)
+    if classify(tag, stderr) == TRANSIENT and policy.should_retry(attempt):
+        lane.defer(item, attempt)               # attempt+1 在 backoff 秒後
+"""
+import re, time, heapq, random
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+UNKNOWN = "unknown"
+
+# stderr / 例外訊息裡出現這些就當暫時性（小寫比對）
+TRANSIENT_PATTERNS = (
+    "out of memory", "outofmemoryerror", "cudnn_status_alloc_failed", "cublas_status_alloc_failed",
+    "cannot allocate memory", "memoryerror",
+    "address already in use", "eaddrinuse",
+    "resource temporarily unavailable", "device or resource busy", "too many open files",
+    "connection reset", "connection refused", "nccl error",
+    "no space left on device",
+)
+TRANSIENT_TAGS = ("TIMEOUT", "WATCHDOG")    # watchdog 的 tag；一直超時的交給 TimeoutTracker 隔離
+# 確定是影片本身壞掉（ffmpeg / cv2 讀不了、結果解析不了）
+PERMANENT_PATTERNS = (
+    "invalid data found when processing input", "moov atom not found", "does not contain any stream",
+    "could not find codec parameters", "end of file", "corrupt",
+)
+PERMANENT_TAGS = ("PARSE_ERR",)
+TRANSIENT_RC = (-9, 137)                    # SIGKILL（多半是 OOM killer）
+
+
+def classify(err_tag, detail=""):
+    """err_tag 空字串 → None（沒失敗）"""
+    if not err_tag:
+        return None
+    if err_tag.startswith(TRANSIENT_TAGS):
+        return TRANSIENT
+    m = re.search(r"rc=(-?\d+)", err_tag)
+    if m and int(m.group(1)) in TRANSIENT_RC:
+        return TRANSIENT
+    text = f"{err_tag} {detail or ''}".lower()
+    if any(p in text for p in TRANSIENT_PATTERNS):
+        return TRANSIENT
+    if err_tag.startswith(PERMANENT_TAGS) or any(p in text for p in PERMANENT_PATTERNS):
+        return PERMANENT
+    return UNKNOWN
+
+
+def signature(err_tag, detail=""):
+    """錯誤簽章：tag + stderr 最後一行，路徑 / 數字抹掉（不同影片的同一種錯誤才對得起來）"""
+    lines = [l for l in (detail or "").strip().splitlines() if l.strip()]
+    last = lines[-1] if lines else ""
+    last = re.sub(r"(/[^\s'\"]+)+", "<path>", last)
+    last = re.sub(r"\d+", "#", last)
+    return f"{err_tag.split('(')[0]}|{last[:200]}"
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=3, backoff=30.0, factor=2.0, max_backoff=600.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+
+    def should_retry(self, attempt):
+        """attempt：剛失敗的是第幾次（從 1 起算）"""
+        return attempt < self.max_attempts
+
+    def delay(self, attempt):
+        base = min(self.max_backoff, self.backoff * self.factor ** (attempt - 1))
+        return base * random.uniform(0.8, 1.2)
+
+
+class RetryLane:
+    """單一 process 用（consumer 各自一條）"""
+    def __init__(self, policy):
+        self.policy = policy
+        self._heap = []         # [(due, seq, attempt, item)]
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def defer(self, item, attempt):
+        """attempt 次失敗 → 排第 attempt+1 次；return 幾秒後"""
+        d = self.policy.delay(attempt)
+        self._seq += 1
+        heapq.heappush(self._heap, (time.time() + d, self._seq, attempt + 1, item))
+        return d
+
+    def wait(self):
+        """離最早的重試到期還有幾秒（沒有重試 → None）"""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.time())
+
+    def pop_due(self):
+        """到期的 → (item, attempt)；沒有 → None"""
+        if self._heap and self._heap[0][0] <= time.time():
+            _, _, attempt, item = heapq.heappop(self._heap)
+            return item, attempt
+        return None
+
+
+class CircuitBreaker:
+    """
+    單一 process 用：同一個 key（例如維度）連續 threshold 支不同影片都是同一個錯誤簽章 → record() 回 True。
+    中間有任何一支成功（ok()）或錯誤不一樣就重新算。
+    """
+    def __init__(self, threshold=5):
+        self.threshold = threshold
+        self._streak = {}       # key → (signature, {vid})
+
+    def record(self, vid, err_tag, detail="", key=None):
+        if self.threshold <= 0:
+            return False
+        sig = signature(err_tag, detail)
+        prev, vids = self._streak.get(key, (None, set()))
+        if prev != sig:
+            vids = set()
+        vids.add(vid)
+        self._streak[key] = (sig, vids)
+        return len(vids) >= self.threshold
+
+    def ok(self, key=None):
+        self._streak.pop(key, None)
+
+    def last(self, key=None):
+        return self._streak.get(key, (None, ()))[0]
@@ -37,7 +37,7 @@ cd tarsier
 # setup.sh 有些步驟偶爾失敗不影響後續，因此用 || true
 bash setup.sh || true
 
-pip install -q flash-attn einops pyarrow 'accelerate>=0.26.0'
+pip install -q flash-attn einops pyarrow 'accelerate>=0.26.0' imageio-ffmpeg
 
 if [[ ! -d "checkpoints/tarsier2_full7b" ]]; then
   huggingface-cli download omni-research/Tarsier2-Recap-7b \
@@ -45,6 +45,10 @@ if [[ ! -d "checkpoints/tarsier2_full7b" ]]; then
 fi
 
 wget -q -N https://raw.githubusercontent.com/joedn522/mytool/main/tarsier_eval_docker.py
+# tarsier_eval_docker.py import 的 helper 模組（watchdog 用 video_convert 讀影片長度算期限）
+for m in result_sink batch_bisect watchdog video_convert; do
+  wget -q -N "https://raw.githubusercontent.com/joedn522/mytool/main/${m}.py"
+done
 
 # ---------- 執行評估 ----------
 python tarsier_eval_docker.py \
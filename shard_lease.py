@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多台機器分攤同一份 TSV（只靠共享檔案系統，不需要任何服務）
+------------------------------------------------
+--shard i/N   : 固定切分，videoid 的 64-bit hash % N == i 的才做（每台機器結果不重疊）
+lease 模式    : TSV 依行號切成 chunk，每台機器搶 lease 檔來領 chunk，做完的寫 .done；
+                慢的機器領得少、死掉的機器 lease 過期後被別人收回（work stealing）
+
+lease 檔：<lease_dir>/chunk_000123.lease
+  - 領取   : O_CREAT | O_EXCL 建檔（原子；NFSv3+ 也成立），內容是 owner
+  - 續約   : os.utime 更新 mtime（LeaseManager 背景 thread 每 ttl/3 一次）
+  - 收回   : mtime 超過 ttl → rename 成 .stale.<owner>（只有一個人 rename 得到），
+             rename 後發現其實剛被續約就 link 回去
+  - 完成   : 建 chunk_000123.done、刪 lease
+時間一律用「共享 FS 上剛 touch 的檔案 mtime」比較，不同機器時鐘不準也沒關係；ttl 仍建議 ≥ 數分鐘。
+
+被收回的 chunk 會整個重做；每台機器請用各自的 output_path，合併時依 videoid 去重。
+"""
+import os, time, socket, threading
+
+from id_index import hash64
+
+
+def parse_shard(spec):
+    """'3/8' → (3, 8)"""
+    try:
+        i, n = (int(x) for x in spec.split("/"))
+    except (ValueError, AttributeError):
+        raise ValueError(f"--shard must look like i/N, got {spec!r}")
+    if not 0 <= i < n:
+        raise ValueError(f"--shard index must be in [0, {n}), got {i}")
+    return i, n
+
+def in_shard(vid, shard):
+    """shard=None 時全部都算"""
+    return shard is None or hash64(vid) % shard[1] == shard[0]
+
+
+# ───────────── chunking ─────────────
+def chunk_offsets(tsv, chunk_rows):
+    """每個 chunk 第一行的 byte offset；所有機器讀同一份 TSV 會得到一樣的切法"""
+    offsets, n = [], 0
+    with open(tsv, "rb") as f:
+        while True:
+            pos = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if n % chunk_rows == 0:
+                offsets.append(pos)
+            n += 1
+    return offsets
+
+def read_chunk(tsv, offsets, c, chunk_rows):
+    """chunk c 的 TSV 行（已 split）"""
+    out = []
+    with open(tsv, "rb") as f:
+        f.seek(offsets[c])
+        for _ in range(chunk_rows):
+            line = f.readline()
+            if not line:
+                break
+            out.append(line.decode("utf-8", "ignore").rstrip("\r\n").split("\t"))
+    return out
+
+
+# ───────────── leases ─────────────
+class LeaseManager:
+    """可以直接傳給子程序：owner 在建立時決定，同一個 driver 的各 process 共用同一個 owner"""
+    def __init__(self, lease_dir, ttl=300.0, owner=None):
+        self.dir = lease_dir
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._tag = "".join(ch if ch.isalnum() else "_" for ch in self.owner)
+        self._stop = None
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def __getstate__(self):
+        st = self.__dict__.copy()
+        st["_stop"] = None
+        return st
+
+    def _lease(self, c):
+        return os.path.join(self.dir, f"chunk_{c:06d}.lease")
+
+    def _done(self, c):
+        return os.path.join(self.dir, f"chunk_{c:06d}.done")
+
+    def _fs_now(self):
+        """共享 FS 的「現在」：touch 自己的 clock 檔再讀 mtime"""
+        p = os.path.join(self.dir, f".clock.{self._tag}")
+        with open(p, "a"):
+            pass
+        os.utime(p)
+        return os.stat(p).st_mtime
+
+    def is_done(self, c):
+        return os.path.exists(self._done(c))
+
+    def owns(self, c):
+        try:
+            with open(self._lease(c)) as f:
+                return f.read().strip() == self.owner
+        except FileNotFoundError:
+            return False
+
+    def claim(self, c):
+        if self.is_done(c):
+            return False
+        lp = self._lease(c)
+        try:
+            fd = os.open(lp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not self._reclaim(c):
+                return False
+            try:
+                fd = os.open(lp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:         # 收回後被別人搶先建了
+                return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        if self.is_done(c):                 # 建 lease 的同時別人剛做完
+            os.remove(lp)
+            return False
+        return True
+
+    def _reclaim(self, c):
+        lp = self._lease(c)
+        try:
+            if self._fs_now() - os.stat(lp).st_mtime < self.ttl:
+                return False
+            stale = f"{lp}.stale.{self._tag}"
+            os.rename(lp, stale)            # 同時只有一台 rename 得到
+        except FileNotFoundError:
+            return False
+        try:
+            if self._fs_now() - os.stat(stale).st_mtime < self.ttl:   # stat 與 rename 之間被續約了
+                try:
+                    os.link(stale, lp)
+                except FileExistsError:
+                    pass
+                return False
+            with open(stale) as f:
+                print(f"[LEASE] reclaim chunk {c} from {f.read().strip()}", flush=True)
+            return True
+        finally:
+            os.remove(stale)
+
+    def renew(self):
+        """續約目錄裡所有自己的 lease；return 續約的 chunk"""
+        mine = []
+        for name in os.listdir(self.dir):
+            if not (name.startswith("chunk_") and name.endswith(".lease")):
+                continue
+            c = int(name[6:-6])
+            if self.owns(c):
+                try:
+                    os.utime(self._lease(c))
+                    mine.append(c)
+                except FileNotFoundError:
+                    pass
+        return mine
+
+    def release(self, c, done=True):
+        if done:
+            with open(self._done(c), "w") as f:
+                f.write(self.owner)
+        if self.owns(c):
+            try:
+                os.remove(self._lease(c))
+            except FileNotFoundError:
+                pass
+
+    def start_renewer(self):
+        self._stop = threading.Event()
+
+        def loop():
+            while not self._stop.wait(self.ttl / 3):
+                self.renew()
+
+        threading.Thread(target=loop, daemon=True).start()
+        return self
+
+    def stop_renewer(self):
+        if self._stop:
+            self._stop.set()
+
+    def claim_iter(self, n_chunks, poll=None):
+        """
+        依序領 chunk（從 owner hash 決定的位置開始，減少大家搶同一個）；
+        掃完一輪後若還有別人持有、沒做完的 chunk，就每 poll 秒再掃，等它們過期好收回；
+        全部 .done（或在自己手上）才結束
+        """
+        poll = poll or self.ttl / 3
+        start = hash64(self.owner) % max(1, n_chunks)
+        order = [(start + k) % n_chunks for k in range(n_chunks)]
+        while True:
+            pending = False
+            for c in order:
+                if self.is_done(c) or self.owns(c):
+                    continue
+                if self.claim(c):
+                    yield c
+                else:
+                    pending = pending or not (self.is_done(c) or self.owns(c))
+            if not pending:
+                return
+            time.sleep(poll)
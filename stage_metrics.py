@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pipeline 各 stage 的 counter / latency histogram（VBench drivers 共用）
+------------------------------------------------
+慢的時候到底在等誰：producer 轉檔？GPU evaluate？還是寫檔？
+producer / consumer / sink writer 各自是 process，統計一律丟進同一個 queue，
+由 main process 的一個 thread 匯總（同 ResultSink 的單一 writer 做法）：
+  - 每 interval 秒重寫 <prom_path>（Prometheus textfile 格式，node_exporter textfile collector 可直接收）
+  - close() 時寫最後一次 .prom 與 <json_path>（每個 stage 的 count / sum / p50 / p90 / p99 / max）
+
+    metrics = StageMetrics(prom_path, json_path).start()      # main，fork 之前
+    metrics.watch("queue_depth", q.qsize)                     # 每 interval 取樣一次的 gauge
+    metrics.observe("convert", conv_t, mode="transcode")      # 任何 process 都可以呼叫
+    with metrics.timer("parse"): ...
+    metrics.inc("videos", result="ok")
+    metrics.close()
+
+沒開 --metrics 時用 NULL（全部 no-op），呼叫端不用到處判斷。
+StageMetrics 可以直接當 Process 參數傳給子程序（pickle 時只帶 queue）。
+"""
+import os, json, time, queue, random, threading, contextlib
+import multiprocessing as mp
+
+_STOP = "__METRICS_STOP__"
+
+# 秒；evaluate 可能到數分鐘，write / parse 在毫秒級
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+RESERVOIR = 10000       # 算 percentile 用的取樣上限（每個 histogram）
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def _fmt_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def _pct(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    return round(sorted_vals[min(len(sorted_vals) - 1, int(p * len(sorted_vals)))], 4)
+
+
+class _Hist:
+    __slots__ = ("counts", "n", "sum", "max", "sample")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.n, self.sum, self.max, self.sample = 0, 0.0, 0.0, []
+
+    def add(self, v):
+        for i, b in enumerate(BUCKETS):
+            if v <= b:
+                self.counts[i] += 1
+                break
+        self.n += 1
+        self.sum += v
+        self.max = max(self.max, v)
+        if len(self.sample) < RESERVOIR:
+            self.sample.append(v)
+        else:                                   # reservoir sampling
+            j = random.randrange(self.n)
+            if j < RESERVOIR:
+                self.sample[j] = v
+
+
+class StageMetrics:
+    def __init__(self, prom_path, json_path=None, interval=15.0, prefix="vbench"):
+        self.prom_path = prom_path
+        self.json_path = json_path
+        self.interval = interval
+        self.prefix = prefix
+        self.q = mp.Queue()
+        self._thread = None
+        self._watch = []            # [(key, fn)]，只在 main 取樣
+        self._hist, self._count, self._gauge = {}, {}, {}
+        self._t0 = time.time()
+
+    def __getstate__(self):
+        return {"q": self.q, "prefix": self.prefix}
+
+    # ───────────── 任何 process ─────────────
+    def observe(self, name, secs, **labels):
+        self.q.put(("h", _key(name, labels), float(secs)))
+
+    def inc(self, name, n=1, **labels):
+        self.q.put(("c", _key(name, labels), n))
+
+    def set(self, name, value, **labels):
+        self.q.put(("g", _key(name, labels), float(value)))
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - tic, **labels)
+
+    # ───────────── main process ─────────────
+    def watch(self, name, fn, **labels):
+        self._watch.append((_key(name, labels), fn))
+        return self
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is None:
+            return
+        self.q.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._write_prom()
+        if self.json_path:
+            tmp = f"{self.json_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.summary(), f, indent=2, ensure_ascii=False)
+            os.replace(tmp, self.json_path)
+
+    def _loop(self):
+        next_dump = time.time() + self.interval
+        while True:
+            try:
+                item = self.q.get(timeout=max(0.0, next_dump - time.time()))
+            except queue.Empty:
+                item = None
+            if item == _STOP:
+                return
+            if item is not None:
+                kind, key, v = item
+                if kind == "h":
+                    self._hist.setdefault(key, _Hist()).add(v)
+                elif kind == "c":
+                    self._count[key] = self._count.get(key, 0) + v
+                else:
+                    self._gauge_add(key, v)
+            if time.time() >= next_dump:
+                for key, fn in self._watch:
+                    try:
+                        self._gauge_add(key, fn())
+                    except Exception:       # Manager 已經關了之類
+                        pass
+                self._write_prom()
+                next_dump = time.time() + self.interval
+
+    def _gauge_add(self, key, v):
+        g = self._gauge.setdefault(key, {"last": v, "max": v, "sum": 0.0, "n": 0})
+        g["last"], g["max"] = v, max(g["max"], v)
+        g["sum"] += v
+        g["n"] += 1
+
+    def _write_prom(self):
+        p = self.prefix
+        lines, typed = [], set()
+
+        def typ(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), h in sorted(self._hist.items()):
+            metric = f"{p}_{name}_seconds"
+            typ(metric, "histogram")
+            cum = 0
+            for b, c in zip(BUCKETS, h.counts):
+                cum += c
+                lines.append(f"{metric}_bucket{_fmt_labels(labels, [('le', b)])} {cum}")
+            lines.append(f"{metric}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {h.n}")
+            lines.append(f"{metric}_sum{_fmt_labels(labels)} {h.sum:.6f}")
+            lines.append(f"{metric}_count{_fmt_labels(labels)} {h.n}")
+        for (name, labels), v in sorted(self._count.items()):
+            typ(f"{p}_{name}_total", "counter")
+            lines.append(f"{p}_{name}_total{_fmt_labels(labels)} {v}")
+        for (name, labels), g in sorted(self._gauge.items()):
+            typ(f"{p}_{name}", "gauge")
+            lines.append(f"{p}_{name}{_fmt_labels(labels)} {g['last']}")
+        typ(f"{p}_uptime_seconds", "gauge")
+        lines.append(f"{p}_uptime_seconds {time.time() - self._t0:.1f}")
+
+        tmp = f"{self.prom_path}.tmp"       # 原子替換：collector 不會讀到寫一半的檔
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prom_path)
+
+    def summary(self):
+        def name_of(key):
+            name, labels = key
+            return name + "".join(f"[{k}={v}]" for k, v in labels)
+
+        stages = {}
+        for key, h in sorted(self._hist.items()):
+            s = sorted(h.sample)
+            stages[name_of(key)] = {
+                "count": h.n, "sum": round(h.sum, 3),
+                "mean": round(h.sum / h.n, 4) if h.n else None,
+                "p50": _pct(s, .5), "p90": _pct(s, .9), "p99": _pct(s, .99), "max": round(h.max, 4),
+            }
+        return {
+            "wall_secs": round(time.time() - self._t0, 3),
+            "stages": stages,
+            "counters": {name_of(k): v for k, v in sorted(self._count.items())},
+            "gauges": {name_of(k): {"last": g["last"], "max": g["max"],
+                                    "mean": round(g["sum"] / g["n"], 3) if g["n"] else None}
+                       for k, g in sorted(self._gauge.items())},
+        }
+
+
+class _NullMetrics:
+    def observe(self, *a, **kw): pass
+    def inc(self, *a, **kw): pass
+    def set(self, *a, **kw): pass
+    def watch(self, *a, **kw): return self
+    def start(self): return self
+    def close(self): pass
+
+    def timer(self, *a, **kw):
+        return contextlib.nullcontext()
+
+NULL = _NullMetrics()
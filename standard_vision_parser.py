@@ -7,6 +7,10 @@ try:
     import imageio_ffmpeg as iio_ffmpeg
 except Exception:
     iio_ffmpeg = None
+try:
+    from probe_index import ProbeIndex
+except Exception:
+    ProbeIndex = None
 
 from .utils import sample_video, read_image, adjust_bbox, filter_ocr_polygon
 
@@ -26,6 +30,13 @@ class VisionParser:
         # 預設：推論時（非訓練）強制用中間 5 秒；可被上游覆寫
         self._center_clip = self.video_sampling_strategy.get("center_clip", True)
         self._center_sec  = self.video_sampling_strategy.get("clip_len_sec", 5)
+        # (選) probe_index.py 建好的 sidecar index：duration 先查 index，不用每支都跑 ffprobe
+        self._probe_index = None
+        idx_path = self.video_sampling_strategy.get("probe_index")
+        if idx_path and ProbeIndex is not None:
+            self._probe_index = ProbeIndex(idx_path)
+        elif idx_path:
+            print("[VisionParser] probe_index module not available; fall back to ffprobe.")
         print(f"[VisionParser] center_clip={self._center_clip}, clip_len_sec={self._center_sec}")
 
         # fmt: off
@@ -272,7 +283,14 @@ class VisionParser:
             return None
 
     def _get_duration(self, path: str) -> Union[float, None]:
-        # 先嘗試 ffprobe，失敗再用 imageio-ffmpeg
+        # 有 sidecar index 先查（沒有的會 probe 一次並寫回），再嘗試 ffprobe，失敗再用 imageio-ffmpeg
+        if self._probe_index is not None:
+            try:
+                d = self._probe_index.lookup(path).get("duration")
+                if d is not None and d > 0:
+                    return d
+            except Exception as e:
+                print(f"[VisionParser] probe_index lookup failed: {e}")
         d = self._ffprobe_duration(path)
         if d is not None and d > 0:
             return d
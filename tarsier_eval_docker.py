@@ -7,11 +7,18 @@ import time
 from argparse import ArgumentParser, Namespace
 from pathlib import Path
 
+from result_sink import ResultSink
+from batch_bisect import Quarantine
+from watchdog import video_duration, timeout_for, run_with_deadline, TimeoutTracker
+
 def run(args: Namespace):
     data_path = Path(args.data)
     out_path = Path(args.out)
     outlog_path = Path(args.outlog) if hasattr(args, "outlog") and args.outlog else None
 
+    # 先開 sink：recover 會把 out 截到最後一次 commit，resume 才不會讀到殘行
+    out_sink = ResultSink(str(out_path)).start()
+
     processed = set()
     if out_path.exists():
         with out_path.open(newline="") as f:
@@ -20,6 +27,13 @@ def run(args: Namespace):
                 if parts and len(parts) > 0:
                     processed.add(parts[0])  # vid
 
+    # 超時的影片不寫結果（下次 run 再試）；同一支超時 max_timeouts 次才隔離、寫 ERROR 結果
+    tracker = None
+    if getattr(args, "timeout_base", 0) > 0:
+        tracker = TimeoutTracker(f"{out_path}.timeouts.tsv", f"{out_path}.quarantine.tsv",
+                                 args.max_timeouts)
+        processed |= Quarantine(f"{out_path}.quarantine.tsv").ids()
+
     # input: localpath, videoid, label (no header)
     all_rows = []
     with data_path.open(newline="") as f:
@@ -65,13 +79,24 @@ def run(args: Namespace):
         ]
         if args.device != "cpu":
             os.environ["CUDA_VISIBLE_DEVICES"] = args.device.split(":")[-1]
+        timeout = (timeout_for(video_duration(str(video_fp)), args.timeout_base, args.timeout_per_sec)
+                   if tracker else None)
         try:
-            pred = subprocess.check_output(cmd, text=True, stderr=subprocess.STDOUT)
+            pred = run_with_deadline(cmd, timeout, check=True, text=True,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
             log_write(f"[{videoid}] STDOUT:\n{pred}")
         except subprocess.CalledProcessError as e:
             print(e.output, file=sys.stderr)
             log_write(f"[{videoid}] ERROR:\n{e.output}")
             pred = "ERROR: inference failed"
+        except subprocess.TimeoutExpired as e:
+            elapsed = time.time() - start_time
+            msg = f"[{videoid}] TIMEOUT after {elapsed:.0f}s (limit {timeout:.0f}s):\n{e.output or ''}"
+            print(msg, file=sys.stderr)
+            log_write(msg)
+            if not tracker.record(videoid, "inference", elapsed, localpath):
+                continue                    # 不寫結果，下次 run 再試
+            pred = f"ERROR: inference timeout x{args.max_timeouts} (quarantined)"
 
         # crude extraction of the last ###Prediction block
         m = re.search(r"###Prediction:\s*(.*)\Z", pred, re.S)
@@ -79,8 +104,7 @@ def run(args: Namespace):
 
         # append to results (vid, file_path, tarsier_text) tab-separated, no header
         safe_text = tarsier_text.replace('\t', ' ').replace('\n', ' ')
-        with out_path.open("a", newline="") as f_out:
-            f_out.write(f"{videoid}\t{localpath}\t{safe_text}\n")
+        out_sink.write(f"{videoid}\t{localpath}\t{safe_text}\n")
         processed.add(videoid)
 
         elapsed = time.time() - start_time
@@ -90,6 +114,8 @@ def run(args: Namespace):
 
         time.sleep(args.sleep)
 
+    out_sink.close()
+
 def cli() -> Namespace:
     p = ArgumentParser()
     p.add_argument("--data", required=True, help="input TSV path (no header, localpath, videoid, ...)")
@@ -98,6 +124,11 @@ def cli() -> Namespace:
     p.add_argument("--device", default="cuda:0", help="cuda:N or cpu")
     p.add_argument("--sleep", type=float, default=0.0, help="seconds to sleep between items")
     p.add_argument("--outlog", required=False, help="log file path (append log line by line)")
+    p.add_argument("--timeout-base", type=float, default=0,
+                   help="per-video deadline = base + per-sec * video seconds; 0 disables (old behaviour)")
+    p.add_argument("--timeout-per-sec", type=float, default=20, help="extra seconds allowed per second of video")
+    p.add_argument("--max-timeouts", type=int, default=2,
+                   help="quarantine a video (<out>.quarantine.tsv) after this many timeouts")
     return p.parse_args()
 
 if __name__ == "__main__":
@@ -12,21 +12,16 @@ import torch
 from tasks.utils import load_model_and_processor
 from tasks.inference_quick_start import process_one
 
+from result_sink import ResultSink
+from id_index import ProcessedIndex, IdIndexAppender
+from trace_spans import Tracer, NULL as NULL_TRACER
+
 
 # ---------- util ----------
-def safe_write(path: Path | None, txt: str, lock=None):
-    if not path:
-        return
-    path.parent.mkdir(parents=True, exist_ok=True)
-    if lock:
-        with lock:
-            with path.open("a", encoding="utf-8") as f:
-                f.write(txt + "\n")
-                f.flush()
-                os.fsync(f.fileno())
-    else:
-        with path.open("a", encoding="utf-8") as f:
-            f.write(txt + "\n")
+def sink_write(sink: ResultSink | None, txt: str):
+    """結果 / log 都交給 result sink：單一 writer 批次 append、定期 fsync"""
+    if sink:
+        sink.write(txt)
 
 # ---------- init once ----------
 def init_model(ckpt: str, cfg_path: str, device: str):
@@ -39,28 +34,29 @@ def init_model(ckpt: str, cfg_path: str, device: str):
 # ---------- worker ----------
 def run_one(video_fp: Path, vid: str,
             model, processor, device: str,
-            prompt: str, out_path: Path, outlog: Path | None,
-            max_new_tokens: int = 256, file_lock=None):
+            prompt: str, out_sink: ResultSink, log_sink: ResultSink | None,
+            max_new_tokens: int = 256, tracer=NULL_TRACER):
 
     start = time.time()
     gen_kwargs = dict(max_new_tokens=max_new_tokens, do_sample=False,
                       temperature=0, top_p=0, use_cache=True)
 
     try:
-        with torch.cuda.device(device):
+        with torch.cuda.device(device), tracer.span("process_one", vid=vid):
             pred_txt = process_one(model, processor, prompt, str(video_fp), gen_kwargs)
     except Exception as e:
         msg = f"[{vid}] ERROR: {e}"
-        safe_write(outlog, msg) if outlog else None
+        sink_write(log_sink, msg)
         pred_txt = msg
 
     clean = pred_txt.replace('\t', ' ').replace('\n', ' ')
-    safe_write(out_path, f"{vid}\t{video_fp}\t{clean}", file_lock)
+    sink_write(out_sink, f"{vid}\t{video_fp}\t{clean}")
 
     elapsed = time.time() - start
     log = f"✓ Done {vid} | Time: {elapsed:.2f} s | Safe text: {clean}"
     print(log)
-    safe_write(outlog, log, file_lock) if outlog else None
+    sink_write(log_sink, log)
+    tracer.add("run_one", start, vid=vid)
     return vid
 
 
@@ -77,14 +73,18 @@ def init_multiple_models(ckpt: str, cfg_path: str, device: str, num_models: int)
     return models, processors
 
 # ---------- worker ----------
-def worker_run(task_queue, device, ckpt, config, prompt, out_path, outlog, max_new_tokens, file_lock):
-    model, processor = init_model(ckpt, config, device)
+def worker_run(task_queue, device, ckpt, config, prompt, out_sink, log_sink, max_new_tokens,
+               tracer=NULL_TRACER):
+    tracer.name_process("worker")
+    with tracer.span("init_model"):
+        model, processor = init_model(ckpt, config, device)
     while not task_queue.empty():
         try:
             video_fp, vid = task_queue.get_nowait()
         except:
             break
-        run_one(video_fp, vid, model, processor, device, prompt, out_path, outlog, max_new_tokens, file_lock)
+        run_one(video_fp, vid, model, processor, device, prompt, out_sink, log_sink, max_new_tokens,
+                tracer)
 
 # ---------- main ----------
 def main(args):
@@ -106,8 +106,17 @@ def main(args):
     out_path = Path(args.out)
     outlog = Path(args.outlog) if args.outlog else None
 
+    # 先開 sink：recover 會把 out 截到最後一次 commit，resume 才不會讀到殘行
+    idx_path = f"{out_path}.idx"
+    out_sink = ResultSink(str(out_path),
+                          on_commit=IdIndexAppender(idx_path) if args.id_index else None).start()
+    log_sink = ResultSink(str(outlog)).start() if outlog else None
+
     data_rows = [row for row in csv.reader(Path(args.data).open(), delimiter="\t") if len(row) >= 2]
-    done = {line.split("\t", 1)[0] for line in out_path.open()} if out_path.exists() else set()
+    if args.id_index:       # 排序 hash + mmap，千萬筆也不用整個讀進 set
+        done = ProcessedIndex.open(idx_path, seed_from=str(out_path))
+    else:
+        done = {line.split("\t", 1)[0] for line in out_path.open()} if out_path.exists() else set()
     todo = [row for row in data_rows if row[1] not in done]
     print(f"Total {len(data_rows)} | Already {len(done)} | To-run {len(todo)}")
 
@@ -120,19 +129,25 @@ def main(args):
     prompt = "Describe the camera motion in detail."
     num_workers = min(args.workers, len(todo))
     processes = []
-    file_lock = mp.Lock()
+    # --trace：每個 worker 各寫 <out>.trace/trace.<pid>.jsonl，結束時合併成 <out>.trace.json
+    tracer = Tracer(f"{out_path}.trace") if args.trace else NULL_TRACER
 
     for i in range(num_workers):
         p = mp.Process(
             target=worker_run,
             args=(task_queue, devices[0], args.ckpt, args.config,
-                  prompt, out_path, outlog, args.max_new_tokens, file_lock)
+                  prompt, out_sink, log_sink, args.max_new_tokens, tracer)
         )
         p.start()
         processes.append(p)
 
     for p in processes:
         p.join()
+    out_sink.close()
+    if log_sink:
+        log_sink.close()
+    if args.trace:
+        print(f"trace → {out_path}.trace.json ({tracer.merge(f'{out_path}.trace.json')} events)")
 
     # 統計總時間與平均
     total_time = time.time() - start_time
@@ -163,6 +178,9 @@ def parse_cli():
     ap.add_argument("--device", default="cuda:0", help="cpu 或多卡 'cuda:0,cuda:1'")
     ap.add_argument("--workers", type=int, default=3, help="並行推理執行緒數")
     ap.add_argument("--max_new_tokens", type=int, default=256, help="生成最大 token 數")
+    ap.add_argument("--id_index", action="store_true", help="resume 改用 <out>.idx 精簡索引")
+    ap.add_argument("--trace", action="store_true",
+                    help="每支影片的 run_one / process_one 時間區段合併成 <out>.trace.json（chrome://tracing、Perfetto）")
     return ap.parse_args()
 
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+暫存轉檔目錄（./tmp）的 byte 預算 / 剩餘空間 backpressure（VBench drivers 用）
+------------------------------------------------
+--max_queue_size 只限制「幾支」：20 支 4K 轉出來可能就把 tmp 塞滿，20 支短片卻幾乎不佔空間。
+producer 每支要轉進 tmp 的影片送進轉檔 pool 之前先 admit()：
+  - tmp 現有檔案大小 + 轉檔中的預估大小 + 這支的預估 > max_bytes → 等
+  - tmp 所在磁碟剩餘空間 - 轉檔中與這支的預估 < min_free_bytes → 等
+轉完（不管成功與否）release()，之後就算在 tmp 的實際檔案大小裡。
+
+等的時候：
+  - 先 drain() 已經送出的轉檔（依 --convert_order 把最舊的 emit 進 queue），
+    否則 input 順序下轉好的後面幾支會卡在 pool 裡、永遠輪不到 consumer 刪 → 死結
+  - 沒東西可 drain 就每 poll 秒重掃 tmp（consumer 在別的 process 刪檔，沒有通知）
+預估大小 = 來源檔大小（轉檔多半只會變小，寧可保守）。
+比這個 producer 啟動還舊的檔（上次 run 留下的）不算：不是這次 consumer 會刪的，等了會卡死。
+沒有轉檔中的工作、而且 tmp 是空的或 starved()（queue 空了）時一律放行：
+tmp 裡剩下的都在 consumer 手上，batch driver 湊不滿一批不會刪，再等只會死結；
+所以 batch driver 的預算實際上至少是 batch_size × consumer 數支，設太小只會變成一支一支餵。
+
+    budget = TmpBudget(TMP_DIR, max_bytes, min_free_bytes, starved=lambda: q.qsize() == 0,
+                       metrics=metrics, tracer=tracer)
+    run_convert_pool(tasks, convert_one, emit, ..., admit=lambda t, drain: budget.admit(t[0], drain, t[1]))
+    # convert_one 結束時 budget.release(t[0])
+
+throttle 時：metrics 記 tmp_throttle（等了幾秒）與 tmp_throttled_total{reason=bytes|free}，
+trace 上是一段 tmp_throttle；main 可以 metrics.watch("tmp_bytes", TmpBudget(TMP_DIR).usage) 取樣目前用量。
+"""
+import os, time, shutil, threading
+
+from stage_metrics import NULL as NULL_METRICS
+from trace_spans import NULL as NULL_TRACER
+
+GB = 2**30
+
+
+def _fmt(n):
+    return f"{n / GB:.2f}GB" if n >= GB else f"{n / 2**20:.1f}MB"
+
+
+def dir_bytes(path, since=0.0):
+    """path 底下（不遞迴）mtime >= since 的一般檔案大小總和；tmp 只放轉好的 mp4"""
+    total = 0
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                try:
+                    if e.is_file(follow_symlinks=False):
+                        st = e.stat(follow_symlinks=False)
+                        if st.st_mtime >= since:
+                            total += st.st_size
+                except OSError:             # consumer 剛好刪掉
+                    pass
+    except FileNotFoundError:
+        pass
+    return total
+
+
+class TmpBudget:
+    def __init__(self, tmp_dir, max_bytes=0, min_free_bytes=0, poll=1.0, starved=None,
+                 metrics=NULL_METRICS, tracer=NULL_TRACER):
+        self.dir = tmp_dir
+        self.max_bytes = max_bytes
+        self.min_free = min_free_bytes
+        self.poll = poll
+        self.starved = starved              # () -> bool：consumer 沒東西做了
+        self.metrics = metrics
+        self.tracer = tracer
+        self._since = time.time() - 1       # mtime 精度
+        self._held = {}                     # src → 預估 bytes（已 admit、還沒 release）
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or self.min_free > 0
+
+    def usage(self):
+        return dir_bytes(self.dir)
+
+    def free(self):
+        return shutil.disk_usage(self.dir).free
+
+    def _blocked(self, est):
+        """None = 可以轉；否則 (reason, 說明)"""
+        used = dir_bytes(self.dir, self._since)
+        reserved = sum(self._held.values())
+        if not self._held and (used == 0 or (self.starved is not None and self.starved())):
+            return None
+        if self.max_bytes and used + reserved + est > self.max_bytes:
+            return "bytes", f"tmp {_fmt(used)} + converting {_fmt(reserved)} + {_fmt(est)} > {_fmt(self.max_bytes)}"
+        if self.min_free:
+            free = self.free()
+            if free - reserved - est < self.min_free:
+                return "free", f"free {_fmt(free)} - {_fmt(reserved + est)} < {_fmt(self.min_free)}"
+        return None
+
+    def admit(self, src, drain=None, vid=None):
+        """卡到預算允許為止，然後把 src 的預估大小記成轉檔中"""
+        if not self.enabled:
+            return
+        try:
+            est = os.path.getsize(src)
+        except OSError:
+            est = 0
+        tic, reason = time.time(), None
+        while True:
+            with self._cond:
+                blocked = self._blocked(est)
+                if blocked is None:
+                    self._held[src] = self._held.get(src, 0) + est
+                    break
+            if reason is None:
+                reason = blocked[0]
+                print(f"[THROTTLE] {vid or src}: {blocked[1]}, waiting for consumers", flush=True)
+                self.metrics.inc("tmp_throttled", reason=reason)
+            if drain is not None and drain():
+                continue
+            with self._cond:
+                self._cond.wait(self.poll)
+        if reason is not None:
+            waited = time.time() - tic
+            self.metrics.observe("tmp_throttle", waited)
+            self.tracer.add("tmp_throttle", tic, vid=vid, reason=reason)
+            print(f"[THROTTLE] {vid or src}: resumed after {waited:.1f}s", flush=True)
+
+    def release(self, src):
+        """轉完（或沒轉）；沒 admit 過的 src 直接略過"""
+        with self._cond:
+            if self._held.pop(src, None) is not None:
+                self._cond.notify_all()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chrome trace 時間軸（chrome://tracing / https://ui.perfetto.dev 直接開）
+------------------------------------------------
+看 producer、各 consumer、evaluate 子程序在時間上怎麼重疊、哪裡有空檔（pipeline bubble）。
+
+    tracer = Tracer(os.path.join(out_dir, "trace"))       # fork / spawn 前建好，可以直接傳給子程序
+    tracer.name_process("producer")                       # 在各 process 裡呼叫一次，時間軸上的列名
+    with tracer.span("convert", vid=vid): ...
+    tracer.add("video", t0, vid=vid)                      # 已經量好的區間（t0 = 當初的 time.time()）
+    tracer.merge(os.path.join(out_dir, "trace.json"))     # main 最後：合併所有 process 的片段
+
+每個 process 各寫自己的 <trace_dir>/trace.<pid>.jsonl（一行一個 event，append），
+不經過 queue、不用鎖跨 process；被 kill 的 consumer 寫到一半的最後一行 merge 時丟掉。
+時間用 wall clock（μs），不同 process 的 span 才對得起來。
+沒開 --trace 時用 NULL（全部 no-op）。
+"""
+import os, json, time, glob, threading, contextlib
+
+
+class Tracer:
+    def __init__(self, trace_dir):
+        self.dir = trace_dir
+        os.makedirs(trace_dir, exist_ok=True)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)   # fork 時別的 thread 可能正拿著 lock
+
+    def _reset(self):
+        self._f = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"dir": self.dir}
+
+    def __setstate__(self, st):
+        self.__init__(st["dir"])
+
+    def _emit(self, ev):
+        pid = os.getpid()
+        ev.setdefault("pid", pid)
+        ev.setdefault("tid", threading.get_native_id())
+        line = json.dumps(ev, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._pid != pid:                # 每個 process 第一次寫時開自己的檔
+                self._f = open(os.path.join(self.dir, f"trace.{pid}.jsonl"), "a", buffering=1)
+                self._pid = pid
+            self._f.write(line)
+
+    def name_process(self, name):
+        self._emit({"name": "process_name", "ph": "M", "args": {"name": f"{name} ({os.getpid()})"}})
+
+    def name_thread(self, name):
+        self._emit({"name": "thread_name", "ph": "M", "args": {"name": name}})
+
+    @contextlib.contextmanager
+    def span(self, name, cat="pipeline", **args):
+        ts = time.time()
+        try:
+            yield
+        finally:
+            self._emit({"name": name, "cat": cat, "ph": "X", "ts": int(ts * 1e6),
+                        "dur": int((time.time() - ts) * 1e6), "args": args})
+
+    def add(self, name, start, end=None, cat="pipeline", **args):
+        """已經量好的區間（start / end 是 time.time()；不方便包 with 的地方用）"""
+        end = time.time() if end is None else end
+        self._emit({"name": name, "cat": cat, "ph": "X", "ts": int(start * 1e6),
+                    "dur": int((end - start) * 1e6), "args": args})
+
+    def instant(self, name, cat="pipeline", **args):
+        self._emit({"name": name, "cat": cat, "ph": "i", "s": "p",
+                    "ts": int(time.time() * 1e6), "args": args})
+
+    def merge(self, out_path, cleanup=True):
+        """所有 trace.<pid>.jsonl → 一個 Chrome trace JSON；return event 數"""
+        events, parts = [], sorted(glob.glob(os.path.join(self.dir, "trace.*.jsonl")))
+        with self._lock:
+            if self._f:
+                self._f.close()
+                self._f, self._pid = None, None
+        for p in parts:
+            with open(p, encoding="utf-8", errors="ignore") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:          # 被 kill 時寫一半的行
+                        pass
+        events.sort(key=lambda e: e.get("ts", 0))
+        tmp = f"{out_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.replace(tmp, out_path)
+        if cleanup:
+            for p in parts:
+                os.remove(p)
+            try:
+                os.rmdir(self.dir)
+            except OSError:                     # 還有別的檔（例如別次 run 的）就留著
+                pass
+        return len(events)
+
+
+class _NullTracer:
+    def name_process(self, name): pass
+    def name_thread(self, name): pass
+    def add(self, *a, **kw): pass
+    def instant(self, *a, **kw): pass
+    def merge(self, *a, **kw): return 0
+
+    def span(self, *a, **kw):
+        return contextlib.nullcontext()
+
+NULL = _NullTracer()
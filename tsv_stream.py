@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+串流讀 input TSV（取代「整個讀進 tasks list + 逐行 os.path.exists」）
+------------------------------------------------
+    for kind, item in stream_checked(args.input_tsv, check_row, workers=32):
+        ...                                 # check_row(row) 的回傳值，None 的列直接丟掉
+
+- check(row) 在 thread pool 裡跑，網路磁碟上的 stat 可以同時打出去
+- 依輸入順序 yield；同時在飛的列最多 window 筆 → 記憶體跟 TSV 多大無關
+- 是 generator：第一批驗完就開始往下游送，不用等整個 TSV 掃完
+"""
+import csv, collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+def stream_checked(path, check, workers=16, window=None):
+    workers = max(1, workers)
+    window = window or workers * 8
+    pending = collections.deque()
+    with open(path, newline="") as f, ThreadPoolExecutor(max_workers=workers) as pool:
+        for row in csv.reader(f, delimiter="\t"):
+            pending.append(pool.submit(check, row))
+            if len(pending) >= window:
+                res = pending.popleft().result()
+                if res is not None:
+                    yield res
+        while pending:
+            res = pending.popleft().result()
+            if res is not None:
+                yield res
@@ -1,9 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, csv, time, json, argparse, subprocess
+import os, csv, time, json, queue, argparse, threading, subprocess
 from multiprocessing import Process, Manager, Queue
-import imageio_ffmpeg
+from conv_cache import ConversionCache
+from probe_index import ProbeIndex
+from job_cost import make_cost_fn
+from result_sink import ResultSink
+from id_index import ProcessedIndex, IdIndexAppender
+from tsv_stream import stream_checked
+from shard_lease import parse_shard, in_shard
+from batch_sizer import BatchSizer
+from batch_bisect import bisect_batch, Quarantine
+from batch_pipeline import BatchPipeline, prefetch
+from watchdog import video_duration, timeout_for, run_with_deadline
+from stage_metrics import StageMetrics, NULL as NULL_METRICS
+from trace_spans import Tracer, NULL as NULL_TRACER
+from tmp_budget import TmpBudget, GB
+from cpu_plan import CpuPlan, parse_cpus, NULL as NULL_CPU_PLAN
+from video_convert import convert_video, needs_conversion, run_convert_pool, CONVERT_ORDERS, CONVERT_PLANS, CONVERT_PROFILES
 import socket, contextlib
 import uuid, tempfile
 
@@ -13,7 +28,58 @@ parser.add_argument("--input_tsv", required=True)
 parser.add_argument("--output_path", required=True)
 parser.add_argument("--max_video_processes", type=int, default=1)
 parser.add_argument("--max_queue_size", type=int, default=20)
-parser.add_argument("--skip_conversion", action="store_true", help="Skip .mov to .mp4 conversion")
+parser.add_argument("--tmp_budget_gb", type=float, default=0,
+                    help="./tmp 裡轉好還沒做完的 mp4 總大小上限（GB），超過 producer 就先不轉；0 = 不限（舊行為）")
+parser.add_argument("--tmp_min_free_gb", type=float, default=0,
+                    help="./tmp 所在磁碟至少留幾 GB，不夠 producer 就先不轉；0 = 不檢查")
+parser.add_argument("--skip_conversion", action="store_true", help="Skip conversion to .mp4 (.mov / non-mp4 / non-H.264)")
+parser.add_argument("--convert_workers", type=int, default=1, help="平行轉檔 worker 數")
+parser.add_argument("--convert_order", choices=CONVERT_ORDERS, default="input",
+                    help="input=保持輸入順序；sjf=小檔先轉；lpt=預估最久的先做（多 consumer 時縮短尾巴）")
+parser.add_argument("--convert_plan", choices=CONVERT_PLANS, default="transcode",
+                    help="auto=先 probe codec，H.264 直接 remux，其餘才 transcode")
+parser.add_argument("--convert_profile", choices=sorted(CONVERT_PROFILES), default="default",
+                    help="轉檔參數組：video_only 不帶音軌 + ultrafast；score 再壓短邊 512、GOP 8")
+parser.add_argument("--cache_dir", default=None,
+                    help="持久轉檔快取目錄（content fingerprint + 轉檔設定為 key），不可放在 ./tmp 底下")
+parser.add_argument("--cache_gb", type=float, default=100, help="轉檔快取容量上限（GB，LRU 淘汰）")
+parser.add_argument("--probe_index", default=None,
+                    help="probe_index.py 建好的 sidecar metadata index（SQLite）；沒 probe 過的影片會補寫進去")
+parser.add_argument("--id_index", action="store_true",
+                    help="resume 改用 output_path/processed.idx（排序 64-bit hash + mmap），不把所有 id 讀進 set")
+parser.add_argument("--stream_input", action="store_true",
+                    help="邊讀 input_tsv 邊平行 stat 邊轉檔，不先把整個 TSV 讀進記憶體")
+parser.add_argument("--stat_workers", type=int, default=32, help="--stream_input 時平行 stat 的 thread 數")
+parser.add_argument("--batch_size", type=int, default=200, help="一批幾支影片（--adaptive_batch 時為起始值）")
+parser.add_argument("--batch_deadline", type=float, default=0,
+                    help="bucket 最舊的影片等超過幾秒就先送出，不等湊滿（0=關閉）")
+parser.add_argument("--adaptive_batch", action="store_true",
+                    help="依每批耗時與失敗比例自動調整批次大小（範圍 --batch_min ~ --batch_max）")
+parser.add_argument("--batch_min", type=int, default=8)
+parser.add_argument("--batch_max", type=int, default=400)
+parser.add_argument("--batch_target_secs", type=float, default=600,
+                    help="--adaptive_batch 的目標：每批耗時上限（秒）")
+parser.add_argument("--bisect_failures", action="store_true",
+                    help="批次失敗時二分重跑找出壞檔，只隔離壞檔（寫進 output_path/quarantine.tsv）")
+parser.add_argument("--pipeline_depth", type=int, default=0,
+                    help="evaluate 第 N 批時最多先 staged 幾批（0=同步，舊行為；1~2=double buffer）")
+parser.add_argument("--timeout_base", type=float, default=0,
+                    help="每批 evaluate 的期限 = base + per_sec × 這批影片總秒數；0 = 不設期限（舊行為）。"
+                         "超時整批殺掉、標 BATCH_FAIL；搭 --bisect_failures 會把卡住的那支隔離出來")
+parser.add_argument("--timeout_per_sec", type=float, default=20, help="每秒影片多給幾秒（見 --timeout_base）")
+parser.add_argument("--metrics", action="store_true",
+                    help="各 stage 的 latency histogram / queue 深度：定期重寫 output_path/metrics.prom，結束時寫 metrics.json")
+parser.add_argument("--metrics_interval", type=float, default=15, help="metrics.prom 幾秒重寫一次")
+parser.add_argument("--trace", action="store_true",
+                    help="記錄 producer / consumer / evaluate 的時間區段，結束時合併成 output_path/trace.json（chrome://tracing、Perfetto）")
+parser.add_argument("--shard", default=None,
+                    help="i/N：只做 videoid hash % N == i 的影片（多台機器固定切分）")
+parser.add_argument("--cpu_plan", action="store_true",
+                    help="把核心切給 producer / 各 consumer，OMP_NUM_THREADS、torch / cv2 threads、ffmpeg -threads 照分到的核心數設，避免 oversubscription")
+parser.add_argument("--pin_cpus", action="store_true", help="再用 sched_setaffinity 把各 process 綁在分到的核心上（隱含 --cpu_plan）")
+parser.add_argument("--cpus", default=None, help="--cpu_plan 可用的核心，例如 0-15,32-47（預設 = 目前的 affinity）")
+parser.add_argument("--producer_cpus", type=int, default=0,
+                    help="--cpu_plan 給 producer（轉檔）幾個核心；0 = min(convert_workers, 核心數 / (consumer 數 + 1))")
 args = parser.parse_args()
 
 # ───────────── constants ─────────────
@@ -23,9 +89,27 @@ SENTINEL = ("__DONE__", None, None, None, None)
 os.makedirs(args.output_path, exist_ok=True)
 os.makedirs(TMP_DIR, exist_ok=True)
 
+if args.cache_dir and os.path.commonpath([os.path.abspath(args.cache_dir), os.path.abspath(TMP_DIR)]) == os.path.abspath(TMP_DIR):
+    raise SystemExit("--cache_dir 不可放在 TMP_DIR 底下（consumer 會刪掉 TMP_DIR 裡的 mp4）")
+if args.stream_input and args.convert_order in ("sjf", "lpt"):
+    raise SystemExit("--stream_input 不能搭 --convert_order sjf / lpt（要先看到全部檔案才能排序）")
+
 OUT_FILE = os.path.join(args.output_path, "output.txt")
 DBG_FILE = os.path.join(args.output_path, "debug.txt")
-BATCH_SIZE = 200                                           # 一批幾支影片
+IDX_FILE = os.path.join(args.output_path, "processed.idx")
+QUAR_FILE = os.path.join(args.output_path, "quarantine.tsv")
+BATCH_FAIL_TAGS = ("BATCH_FAIL", "PARSE_FAIL")
+PROM_FILE = os.path.join(args.output_path, "metrics.prom")
+METRICS_FILE = os.path.join(args.output_path, "metrics.json")
+
+# 每個 process 都往同一個 queue 丟，main 的 thread 匯總（fork 前建好）
+metrics = StageMetrics(PROM_FILE, METRICS_FILE, args.metrics_interval) if args.metrics else NULL_METRICS
+TRACE_FILE = os.path.join(args.output_path, "trace.json")
+tracer = Tracer(os.path.join(args.output_path, "trace")) if args.trace else NULL_TRACER
+# 各 process 一開始照分到的核心設 thread 數（/ affinity）；Process target 用 cpus.wrap 包
+cpus = (CpuPlan(args.max_video_processes, args.convert_workers, parse_cpus(args.cpus) if args.cpus else None,
+                args.producer_cpus, pin=args.pin_cpus)
+        if args.cpu_plan or args.pin_cpus else NULL_CPU_PLAN)
 
 def get_free_port():
     with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
@@ -38,32 +122,77 @@ def convert_to_mp4_worker(task_list, q: Queue, n_consumer: int):
     task_list 裡每筆是 (orig_path, video_id, video_url)
     轉檔完成後送進 queue → (orig_path, video_id, video_url, mp4_path, conv_time)
     """
+    cache = (ConversionCache(args.cache_dir, args.cache_gb * 2**30)
+             if args.cache_dir else None)
+    probe = ProbeIndex(args.probe_index) if args.probe_index else None
+    # 轉進 tmp 前先看 byte 預算 / 剩餘空間；有 --cache_dir 時寫進快取（自己有容量上限），不佔 tmp
+    budget = TmpBudget(TMP_DIR, 0 if cache else args.tmp_budget_gb * GB,
+                       0 if cache else args.tmp_min_free_gb * GB, starved=lambda: q.qsize() == 0,
+                       metrics=metrics, tracer=tracer)
+    tracer.name_process("producer")
+
+    # 要不要轉：.mov 一律轉，其他依 probe 到的容器 / codec（.mkv、HEVC 的 .mp4 也轉）；
+    # admit 先問過的記在這裡，convert_one 取走，同一支只 probe 一次
+    planned = {}
+
+    def must_convert(vpath, keep=False):
+        conv = planned.pop(vpath, None)
+        if conv is None:
+            conv = needs_conversion(vpath, probe=probe)
+        if keep:
+            planned[vpath] = conv
+        return conv
+
+    def convert_one(task):
+        vpath, vid, vurl = task
+        mp4_path, conv_t = vpath, 0.0  # 預設值（不用轉或已快取）
+
+        # 如果開啟了 --skip_conversion，直接使用原始檔案
+        if args.skip_conversion:
+            print(f"[SKIP_CONVERT] {vpath} - Using original file", flush=True)
+            return (vpath, vid, vurl, vpath, conv_t)
+
+        if must_convert(vpath):
+            mp4_path = os.path.join(TMP_DIR, f"{os.path.splitext(vpath.replace('/','_'))[0]}.mp4")
+            if cache or not os.path.exists(mp4_path):
+                with tracer.span("convert", vid=vid):
+                    mp4_path, conv_t, mode, err = convert_video(
+                        vpath, mp4_path, args.convert_plan, profile=args.convert_profile,
+                        cache=cache, probe=probe)
+                metrics.observe("convert", conv_t, mode=mode)
+                if mp4_path:
+                    print(f"[CONVERT] ✓ {mode} {mp4_path} {conv_t:.2f}s", flush=True)
+                else:
+                    print(f"[CONVERT] ✗ {vpath}\n{err}", flush=True)
+                with open(DBG_FILE, "a") as f:      # 記錄每支影片走哪條路
+                    print(f"{vid}\tconvert:{mode}\t{conv_t:.2f}s", file=f)
+        return (vpath, vid, vurl, mp4_path, conv_t)
+
+    cost = None
+    if args.convert_order == "lpt":
+        cost = make_cost_fn(["camera_motion"], probe, None,
+                            args.convert_plan, "full", args.convert_profile,
+                            convert=not args.skip_conversion)
+
+    def emit(item):
+        # 卡在 put = queue 滿了、consumer 跟不上（evaluate 是瓶頸）
+        with metrics.timer("enqueue_wait"), tracer.span("enqueue_wait", vid=item[1]):
+            q.put(item)
+
+    def admit(task, drain):         # 要轉進 tmp 的才佔預算；等的時候先把轉好的送出去
+        if not args.skip_conversion and must_convert(task[0], keep=True):
+            budget.admit(task[0], drain, vid=task[1])
+
+    def convert_and_release(task):
+        try:
+            return convert_one(task)
+        finally:
+            budget.release(task[0])
+
     try:
-        for vpath, vid, vurl in task_list:
-            mp4_path, conv_t = vpath, 0.0  # 預設值（非 .mov 或已快取）
-
-            # 如果開啟了 --skip_conversion，直接使用原始檔案
-            if args.skip_conversion:
-                print(f"[SKIP_CONVERT] {vpath} - Using original file", flush=True)
-                q.put((vpath, vid, vurl, vpath, conv_t))
-                continue
-
-            if vpath.lower().endswith(".mov"):
-                mp4_path = os.path.join(TMP_DIR, f"{os.path.splitext(vpath.replace('/','_'))[0]}.mp4")
-                if not os.path.exists(mp4_path):
-                    tic = time.time()
-                    try:
-                        subprocess.run(
-                            [imageio_ffmpeg.get_ffmpeg_exe(), "-i", vpath,
-                             "-c:v", "libx264", "-preset", "fast", "-crf", "22",
-                             "-c:a", "aac", "-b:a", "128k", mp4_path],
-                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                        conv_t = time.time() - tic
-                        print(f"[CONVERT] ✓ {mp4_path} {conv_t:.2f}s", flush=True)
-                    except subprocess.CalledProcessError as e:
-                        print(f"[CONVERT] ✗ {vpath}\n{e.stderr.decode()}", flush=True)
-                        mp4_path = None
-            q.put((vpath, vid, vurl, mp4_path, conv_t))
+        run_convert_pool(task_list, convert_and_release, emit,
+                         args.convert_workers, args.convert_order, cost,
+                         admit if budget.enabled else None)
     finally:
         for _ in range(n_consumer):
             q.put(SENTINEL)
@@ -71,11 +200,12 @@ def convert_to_mp4_worker(task_list, q: Queue, n_consumer: int):
 # --------------------------------------------------------
 # 把「一批影片」丟給 VBench 的小工具
 # --------------------------------------------------------
-def run_vbench_batch(batch_rows, odir, batch_idx):
+def run_vbench_batch(batch_rows, odir, batch_idx, timeout=None):
     """
-    batch_rows : [(mp4_path, video_id, url), ...]  長度 <= BATCH_SIZE
+    batch_rows : [(mp4_path, video_id, url), ...]  長度 <= 目前批次大小
     odir       : 這批輸出目錄
     batch_idx  : 第幾批 (1-based)
+    timeout    : evaluate 最多跑幾秒（超過整組 kill、丟 subprocess.TimeoutExpired）
     return     : dict {video_id: predict_type 或 error_tag}
     """
     # 計時開始
@@ -88,8 +218,13 @@ def run_vbench_batch(batch_rows, odir, batch_idx):
             print("\t".join([mp4, vid, "", "", url]), file=f)
 
     # (2) 呼叫 evaluate_i2v
+    result_file = os.path.join(odir, f"batch_{batch_idx:03d}_result.json")
+    if os.path.exists(result_file):   # 舊的結果檔不能被當成這次的
+        os.remove(result_file)
     cmd = [
-        "python", "./vbench_cust/evaluate_i2v.py",
+        "python", "./evaluate_safe.py",
+        "--entry_script", "./vbench_cust/evaluate_i2v.py",
+        "--result_file", result_file,
         "--videos_path", batch_tsv,
         "--mode", "custom_input",
         "--dimension", "camera_motion",
@@ -97,14 +232,14 @@ def run_vbench_batch(batch_rows, odir, batch_idx):
     ]
     env = os.environ.copy()
     env["HUB_NO_GIT"] = "1"              # 關掉 git ping → 更快
-    subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
-
-    # (3) 找到最新 _eval_results.json
-    jfile = max(
-        (p for p in os.listdir(odir) if p.endswith("_eval_results.json")),
-        key=lambda p: os.path.getmtime(os.path.join(odir, p))
-    )
-    with open(os.path.join(odir, jfile)) as jf:
+    with tracer.span("evaluate_subprocess", batch=batch_idx, n=len(batch_rows)):
+        run_with_deadline(cmd, timeout, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    metrics.observe("evaluate", time.time() - batch_start_time)
+    parse_tic = time.time()
+
+    # (3) 讀 evaluate_safe 寫到指定位置的結果（不再掃目錄找最新 json）
+    with open(result_file) as jf:
         res = json.load(jf)["camera_motion"][2]          # list[dict]
 
     # (4) 轉成 {basename: predict_str}
@@ -117,6 +252,8 @@ def run_vbench_batch(batch_rows, odir, batch_idx):
     out = {}
     for mp4, vid, _ in batch_rows:
         out[vid] = name2pred.get(os.path.abspath(mp4), "PARSE_FAIL")
+    metrics.observe("parse", time.time() - parse_tic)
+    tracer.add("parse", parse_tic, batch=batch_idx)
 
     # 計時結束
     batch_elapsed_time = time.time() - batch_start_time
@@ -124,10 +261,15 @@ def run_vbench_batch(batch_rows, odir, batch_idx):
 
     return out
 
-def run_vbench(mp4, odir):
-    """return (predict_type, elapsed, err_msg, stderr_text)"""
+def run_vbench(mp4, odir, timeout=None):
+    """return (predict_type, elapsed, err_msg, stderr_text)；超過 timeout 秒 err_msg = TIMEOUT"""
+    result_file = os.path.join(odir, "camera_motion_result.json")
+    if os.path.exists(result_file):   # 舊的結果檔不能被當成這次的
+        os.remove(result_file)
     cmd = [
-        "python", "./vbench_cust/evaluate_i2v.py",
+        "python", "./evaluate_safe.py",
+        "--entry_script", "./vbench_cust/evaluate_i2v.py",
+        "--result_file", result_file,
         "--videos_path", mp4,
         "--mode", "custom_input",
         "--dimension", "camera_motion",
@@ -137,7 +279,10 @@ def run_vbench(mp4, odir):
     env = os.environ.copy()  # 使用默認環境變量
 
     tic = time.time()
-    result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    try:
+        result = run_with_deadline(cmd, timeout, env=env, capture_output=True, text=True)
+    except subprocess.TimeoutExpired as e:
+        return None, time.time() - tic, f"TIMEOUT({timeout:.0f}s)", (e.stderr or "").strip()[-5000:]
 
     et = time.time() - tic
     err_txt = result.stderr.strip()[:5000]  # 前 500 字即可，太長寫檔
@@ -145,13 +290,11 @@ def run_vbench(mp4, odir):
     if result.returncode != 0:
         return None, et, f"CLI_FAIL(rc={result.returncode})", err_txt
 
-    json_files = [f for f in os.listdir(odir) if f.endswith("_eval_results.json")]
-    if not json_files:
+    if not os.path.exists(result_file):
         return None, et, "NO_JSON", err_txt
 
-    latest = os.path.join(odir, max(json_files, key=lambda f: os.path.getmtime(os.path.join(odir, f))))
     try:
-        with open(latest) as jf:
+        with open(result_file) as jf:
             j = json.load(jf)
         predict_types = j["camera_motion"][2][0].get("predict_type", [])
         predict_types_str = ";".join(predict_types)  # 將 predict_type 用分號分隔
@@ -161,51 +304,105 @@ def run_vbench(mp4, odir):
     return predict_types_str, et, "", err_txt
 
 # --------------------------------------------------------
-# NEW consumer —— 每 batch 片 flush 一批
+# NEW consumer —— 湊滿一批或等太久（deadline）就 flush
+#   flush 只是把這批交給 BatchPipeline：evaluate / 寫結果在背景 thread，
+#   consumer 繼續拉 queue 收下一批（--pipeline_depth 0 = 舊的同步行為）
 # --------------------------------------------------------
-def consumer(q: Queue, results, dbg, total_tasks):
+def consumer(q: Queue, results, dbg, total_tasks, sink):
     def log(msg): print(msg, file=open(dbg, "a"), flush=True)
+    tracer.name_process("consumer")
 
     bucket       = []        # 暫存 (mp4, vid, url)
+    bucket_t0    = None      # bucket 第一筆進來的時間
     batch_idx    = 0
     processed    = 0
     start_time   = time.time()
+    sizer = BatchSizer(args.batch_size, args.batch_min, args.batch_max,
+                       args.batch_target_secs, args.batch_deadline, args.adaptive_batch)
+    quarantine = Quarantine(QUAR_FILE)
+    src_of = {}              # vid → 原始影片路徑（quarantine 記原檔，不記暫存 mp4）
+    job_dur = {}             # vid → 影片秒數（stage 時 probe；evaluate / bisect 算期限用）
+    lock = threading.Lock()  # processed 在 consumer 與 finish thread 都會加
+
+    def count(vid):
+        nonlocal processed
+        with lock:
+            processed += 1
+            print(f"[PROGRESS] Processed {processed}/{total_tasks} videos: {vid}",
+                  flush=True)
 
-    def flush_batch(final=False):
-        nonlocal bucket, batch_idx, processed
-        if not bucket:
-            return
-        batch_idx += 1
-        odir = os.path.join(
-            args.output_path, "evaluate_result",
-            f"camera_motion_batch_{batch_idx:03d}"
-        )
-        os.makedirs(odir, exist_ok=True)
-
+    # ---- stage：建輸出目錄、預讀 mp4（在 consumer thread 跑） ----
+    def stage(job):
+        os.makedirs(job["odir"], exist_ok=True)
+        if args.pipeline_depth:
+            prefetch(mp4 for mp4, _, _ in job["rows"])
+        if args.timeout_base:
+            for mp4, vid, _ in job["rows"]:
+                job_dur[vid] = video_duration(mp4)
+
+    # ---- evaluate：一次一批 ----
+    def deadline(rows):
+        """這批（或 bisect 的子批）的期限，依影片總秒數放大"""
+        if not args.timeout_base:
+            return None
+        return timeout_for([job_dur.get(vid) for _, vid, _ in rows],
+                           args.timeout_base, args.timeout_per_sec)
+
+    def evaluate(job):
+        rows, odir, idx = job["rows"], job["odir"], job["idx"]
+        job["tic"] = time.time()
+        if args.bisect_failures:
+            def run(sub_rows, tag):
+                sub = odir if tag == "0" else os.path.join(odir, f"bisect_{tag}")
+                os.makedirs(sub, exist_ok=True)
+                return run_vbench_batch(sub_rows, sub, idx, deadline(sub_rows))
+
+            src = job["src_of"]
+            preds = bisect_batch(
+                rows, run,
+                failed=lambda r, p: p.get(r[1], "PARSE_FAIL").startswith(BATCH_FAIL_TAGS),
+                quarantine=quarantine, path=lambda r: src.get(r[1], r[0]), log=log)
+            return {vid: preds.get(vid, "BATCH_FAIL(quarantined)") for _, vid, _ in rows}
         try:
-            preds = run_vbench_batch(bucket, odir, batch_idx)
+            return run_vbench_batch(rows, odir, idx, deadline(rows))
         except subprocess.CalledProcessError as e:
-            preds = {vid: f"BATCH_FAIL({e.returncode})"
-                     for _, vid, _ in bucket}
-            log(f"[BATCH_FAIL] batch_{batch_idx:03d} rc={e.returncode}")
+            log(f"[BATCH_FAIL] batch_{idx:03d} rc={e.returncode}")
+            return {vid: f"BATCH_FAIL({e.returncode})" for _, vid, _ in rows}
+        except subprocess.TimeoutExpired as e:
+            log(f"[BATCH_FAIL] batch_{idx:03d} timeout {e.timeout:.0f}s")
+            return {vid: "BATCH_FAIL(timeout)" for _, vid, _ in rows}
+        except (OSError, ValueError, KeyError, IndexError) as e:     # 沒有 / 壞掉的結果檔
+            log(f"[BATCH_FAIL] batch_{idx:03d} no result json: {type(e).__name__}: {e}")
+            return {vid: "BATCH_FAIL(NO_JSON)" for _, vid, _ in rows}
+
+    # ---- finish：寫結果、調批次大小、刪暫存 ----
+    def finish(job, preds):
+        rows, idx = job["rows"], job["idx"]
+        n_fail = sum(1 for _, vid, _ in rows
+                     if preds.get(vid, "unknown").startswith(BATCH_FAIL_TAGS + ("unknown",)))
+        elapsed = time.time() - job["tic"]
+        prev, nxt = sizer.size, sizer.observe(len(rows), elapsed, n_fail)
+        metrics.observe("batch", elapsed)
+        metrics.set("batch_size", nxt)
+        metrics.inc("videos", len(rows) - n_fail, result="ok")
+        metrics.inc("videos", n_fail, result="failed")
+        msg = (f"[BATCH_SIZE] batch_{idx:03d} n={len(rows)} ({job['reason']}) "
+               f"t={elapsed:.1f}s fail={n_fail} size {prev}→{nxt}")
+        print(msg, flush=True)
+        log(msg)
 
         # 把批次結果寫回每支影片
-        for mp4, vid, url in bucket:
+        for mp4, vid, url in rows:
             pred = preds.get(vid, "unknown")
             row  = {"videoid": vid, "Imgurl": url, "camera_motion": pred}
             results.append(row)
 
-            # 立即 append 至 OUT_FILE 方便 resume
-            with open(OUT_FILE, "a", newline="") as f:
-                writer = csv.DictWriter(f,
-                         ["videoid", "Imgurl", "camera_motion"],
-                         delimiter="\t")
-                writer.writerow(row)
+            # 交給 result sink（單一 writer 批次寫入 OUT_FILE，方便 resume）
+            sink.write(row)
 
             log(f"{vid}\tcamera_motion:{pred}")
-            processed += 1
-            print(f"[PROGRESS] Processed {processed}/{total_tasks} videos: {vid}",
-                  flush=True)
+            count(vid)
+            job_dur.pop(vid, None)
 
             # 若 mp4 是暫存檔就刪掉
             if mp4.startswith(TMP_DIR) and os.path.exists(mp4):
@@ -215,32 +412,54 @@ def consumer(q: Queue, results, dbg, total_tasks):
                 except Exception as e:
                     log(f"[CLEAN_FAIL] {mp4}\t{e}")
 
-        bucket = []    # 清空
+    pipe = BatchPipeline(evaluate, finish, args.pipeline_depth, stage, tracer)
+
+    def flush_batch(reason="full"):
+        nonlocal bucket, bucket_t0, src_of, batch_idx
+        if not bucket:
+            return
+        batch_idx += 1
+        odir = os.path.join(
+            args.output_path, "evaluate_result",
+            f"camera_motion_batch_{batch_idx:03d}"
+        )
+        job = {"idx": batch_idx, "rows": bucket, "odir": odir,
+               "src_of": src_of, "reason": reason}
+        bucket, bucket_t0, src_of = [], None, {}    # 清空（job 帶走原本的 list / dict）
+        pipe.submit(job)
 
     # ---------------- 主迴圈 ----------------
     while True:
-        vpath, vid, vurl, mp4, _ = q.get()
+        tic = time.time()
+        try:
+            vpath, vid, vurl, mp4, _ = q.get(timeout=sizer.wait_timeout(bucket_t0))
+        except queue.Empty:             # 等到 deadline 還沒湊滿 → 先送
+            flush_batch(reason="deadline")
+            continue
+        finally:                        # 等 queue = producer 轉檔跟不上
+            metrics.observe("dequeue_wait", time.time() - tic)
+            tracer.add("dequeue_wait", tic)
         if vpath == "__DONE__":
-            flush_batch(final=True)      # 清理殘餘未滿 50 片的 bucket
+            flush_batch(reason="final")      # 清理殘餘未滿一批的 bucket
             break
 
         if not mp4:
             log(f"{vid}\tconvert_failed")
-            results.append({"videoid": vid,
-                            "Imgurl": vurl,
-                            "camera_motion": "convert_failed"})
-            # 即時寫檔
-            with open(OUT_FILE, "a", newline="") as f:
-                writer = csv.DictWriter(f,
-                         ["videoid", "Imgurl", "camera_motion"],
-                         delimiter="\t")
-                writer.writerow(results[-1])
-            processed += 1
+            row = {"videoid": vid, "Imgurl": vurl, "camera_motion": "convert_failed"}
+            results.append(row)
+            sink.write(row)
+            count(vid)
             continue
 
         bucket.append((mp4, vid, vurl))
-        if len(bucket) >= BATCH_SIZE:
+        src_of[vid] = vpath
+        bucket_t0 = bucket_t0 or time.time()
+        if len(bucket) >= sizer.size:
             flush_batch()
+        elif sizer.expired(bucket_t0):
+            flush_batch(reason="deadline")
+
+    pipe.close()                         # 等還在 evaluate / 寫結果的批次做完
 
     # ---------------- 收尾 ----------------
     total_elapsed = time.time() - start_time
@@ -250,49 +469,97 @@ def consumer(q: Queue, results, dbg, total_tasks):
 def main():
     tasks, skipped = [], []
     processed_videos = set()
+    shard = parse_shard(args.shard) if args.shard else None
+
+    # 先開 sink：recover 會把 OUT_FILE 截到最後一次 commit，resume 才不會讀到殘行
+    metrics.start()
+    if args.cpu_plan or args.pin_cpus:
+        print(cpus.describe(), flush=True)
+    tracer.name_process("main")
+    sink = ResultSink(OUT_FILE, ["videoid", "Imgurl", "camera_motion"],
+                      on_commit=IdIndexAppender(IDX_FILE) if args.id_index else None,
+                      metrics=metrics if args.metrics else None).start()
 
     # 檢查 OUT_FILE 是否已存在，並讀取已處理的檔案
-    if os.path.exists(OUT_FILE):
+    if args.id_index:
+        processed_videos = ProcessedIndex.open(IDX_FILE, seed_from=OUT_FILE)
+        print(f"[MAIN] Resuming from {IDX_FILE}, already processed {len(processed_videos)} videos")
+    elif os.path.exists(OUT_FILE):
         with open(OUT_FILE, "r") as f:
             reader = csv.reader(f, delimiter="\t")
             for row in reader:
                 processed_videos.add(row[0])  # 使用第一列作為 videoid
         print(f"[MAIN] Resuming from {OUT_FILE}, already processed {len(processed_videos)} videos")
 
-    # 讀取 input_tsv，過濾掉已處理的檔案
-    with open(args.input_tsv) as f:
-        for r in csv.reader(f, delimiter="\t"):
-            if len(r) < 5: continue  # 確保有足夠的欄位
-            vpath, vid, _, _, vurl = r[:5]  # 忽略 motion_smoothness 和 dynamic_degree
-            if not os.path.exists(vpath):
-                skipped.append({"videoid": vid, "Imgurl": vurl, "camera_motion": "skipped"})
-                continue
-            if vid in processed_videos:
-                print(f"[SKIP] {vid} already processed, skipping", flush=True)
-                continue
-            tasks.append((vpath, vid, vurl))
-    print(f"[MAIN] tasks={len(tasks)} skipped={len(skipped)}")
+    def check_row(r):
+        """input_tsv 一行 → ("task", (vpath, vid, vurl)) / ("skip", row) / None（丟掉）"""
+        if len(r) < 5: return None  # 確保有足夠的欄位
+        vpath, vid, _, _, vurl = r[:5]  # 忽略 motion_smoothness 和 dynamic_degree
+        if not in_shard(vid, shard):    # 別台機器的，連 stat 都不用做
+            return None
+        if not os.path.exists(vpath):
+            return ("skip", {"videoid": vid, "Imgurl": vurl, "camera_motion": "skipped"})
+        if vid in processed_videos:
+            print(f"[SKIP] {vid} already processed, skipping", flush=True)
+            return None
+        return ("task", (vpath, vid, vurl))
+
+    if args.stream_input:
+        # producer 邊讀邊 stat 邊轉檔（fork 後在 producer process 裡跑）；總數未知，skipped 列直接寫進 sink
+        def iter_tasks():
+            n_task = n_skip = 0
+            for kind, item in stream_checked(args.input_tsv, check_row, args.stat_workers):
+                if kind == "skip":
+                    n_skip += 1
+                    sink.write(item)
+                    continue
+                n_task += 1
+                yield item
+            print(f"[MAIN] input exhausted: tasks={n_task} skipped={n_skip}", flush=True)
+
+        tasks, total = iter_tasks(), "?"
+    else:
+        # 讀取 input_tsv，過濾掉已處理的檔案
+        with open(args.input_tsv) as f:
+            for r in csv.reader(f, delimiter="\t"):
+                res = check_row(r)
+                if res is None: continue
+                (tasks if res[0] == "task" else skipped).append(res[1])
+        print(f"[MAIN] tasks={len(tasks)} skipped={len(skipped)}")
+        total = len(tasks)
 
     with Manager() as m:
         q = m.Queue(args.max_queue_size)
         results = m.list(skipped)
         open(DBG_FILE, "w").close()
-
-        prod = Process(target=convert_to_mp4_worker, args=(tasks, q, args.max_video_processes))
+        metrics.watch("queue_depth", q.qsize)
+        metrics.set("queue_capacity", args.max_queue_size)
+        if args.tmp_budget_gb or args.tmp_min_free_gb:     # 看 tmp 用量跟 throttle 對得起來
+            tmp = TmpBudget(TMP_DIR)
+            metrics.watch("tmp_bytes", tmp.usage).watch("tmp_free_bytes", tmp.free)
+            metrics.set("tmp_budget_bytes", args.tmp_budget_gb * GB)
+
+        prod = Process(target=cpus.wrap(convert_to_mp4_worker, "producer"),
+                       args=(tasks, q, args.max_video_processes))
         prod.start()
-        workers = [Process(target=consumer, args=(q, results, DBG_FILE, len(tasks)))
-                   for _ in range(args.max_video_processes)]
+        workers = [Process(target=cpus.wrap(consumer, "consumer", i), args=(q, results, DBG_FILE, total, sink))
+                   for i in range(args.max_video_processes)]
         for w in workers: w.start()
 
         prod.join()
         for w in workers: w.join()
 
-        # 持續將結果寫入 OUT_FILE
-        with open(OUT_FILE, "a", newline="") as f:
-            writer = csv.writer(f, delimiter="\t")
-            writer.writerows([[row["videoid"], row["Imgurl"], row["camera_motion"]] for row in results])
+    # consumer 已經逐筆寫過；這裡只補 skipped（不要再把整個 results 重寫一次）
+    for row in skipped:
+        sink.write(row)
+    sink.close()
+    metrics.close()                     # 寫最後一次 metrics.prom + metrics.json
     
     print(f"[DONE] → {OUT_FILE}\n[DONE] debug → {DBG_FILE}")
+    if args.metrics:
+        print(f"[DONE] metrics → {METRICS_FILE}")
+    if args.trace:
+        print(f"[DONE] trace → {TRACE_FILE} ({tracer.merge(TRACE_FILE)} events)")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -11,7 +11,21 @@
 """
 import os, csv, time, json, argparse, subprocess, tempfile, contextlib, socket
 from multiprocessing import Process, Manager, Queue
-import imageio_ffmpeg
+from conv_cache import ConversionCache
+from probe_index import ProbeIndex
+from job_cost import make_cost_fn
+from result_sink import ResultSink
+from id_index import ProcessedIndex, IdIndexAppender
+from tsv_stream import stream_checked
+from shard_lease import parse_shard, in_shard
+from batch_bisect import bisect_batch, Quarantine
+from batch_pipeline import BatchPipeline, prefetch
+from watchdog import video_duration, timeout_for, run_with_deadline
+from stage_metrics import StageMetrics, NULL as NULL_METRICS
+from trace_spans import Tracer, NULL as NULL_TRACER
+from tmp_budget import TmpBudget, GB
+from cpu_plan import CpuPlan, parse_cpus, NULL as NULL_CPU_PLAN
+from video_convert import convert_video, needs_conversion, run_convert_pool, CONVERT_ORDERS, CONVERT_PLANS, CONVERT_WINDOWS, CONVERT_PROFILES
 
 # ─────────── CLI ───────────
 P = argparse.ArgumentParser()
@@ -20,43 +34,153 @@ P.add_argument("--output_path", required=True)
 P.add_argument("--batch_size", type=int, default=50)
 P.add_argument("--max_video_processes", type=int, default=1)
 P.add_argument("--max_queue_size", type=int, default=20)
+P.add_argument("--tmp_budget_gb", type=float, default=0,
+               help="./tmp 裡轉好還沒做完的 mp4 總大小上限（GB），超過 producer 就先不轉；0 = 不限（舊行為）")
+P.add_argument("--tmp_min_free_gb", type=float, default=0,
+               help="./tmp 所在磁碟至少留幾 GB，不夠 producer 就先不轉；0 = 不檢查")
 P.add_argument("--skip_conversion", action="store_true")
+P.add_argument("--shared_decode", action="store_true",
+               help="consumer 內常駐模型，每支影片只 decode 一次、所有維度共用")
+P.add_argument("--convert_workers", type=int, default=1, help="平行轉檔 worker 數")
+P.add_argument("--convert_order", choices=CONVERT_ORDERS, default="input",
+               help="input=保持輸入順序；sjf=小檔先轉；lpt=預估最久的先做（多 consumer 時縮短尾巴）")
+P.add_argument("--convert_plan", choices=CONVERT_PLANS, default="transcode",
+               help="auto=先 probe codec，H.264 直接 remux，其餘才 transcode")
+P.add_argument("--convert_profile", choices=sorted(CONVERT_PROFILES), default="default",
+               help="轉檔參數組：video_only 不帶音軌 + ultrafast；score 再壓短邊 512、GOP 8")
+P.add_argument("--convert_window", choices=CONVERT_WINDOWS, default="full",
+               help="center=只轉中間視窗（與 5 秒取樣對齊，分數不變）")
+P.add_argument("--cache_dir", default=None,
+               help="持久轉檔快取目錄（content fingerprint + 轉檔設定為 key），不可放在 ./tmp 底下")
+P.add_argument("--cache_gb", type=float, default=100, help="轉檔快取容量上限（GB，LRU 淘汰）")
+P.add_argument("--probe_index", default=None,
+               help="probe_index.py 建好的 sidecar metadata index（SQLite）；沒 probe 過的影片會補寫進去")
+P.add_argument("--id_index", action="store_true",
+               help="resume 改用 output_path/processed.idx（排序 64-bit hash + mmap），不把所有 id 讀進 set")
+P.add_argument("--stream_input", action="store_true",
+               help="邊讀 input_tsv 邊平行 stat 邊轉檔，不先把整個 TSV 讀進記憶體")
+P.add_argument("--stat_workers", type=int, default=32, help="--stream_input 時平行 stat 的 thread 數")
+P.add_argument("--bisect_failures", action="store_true",
+               help="批次有影片拿到 -1 時二分重跑找出壞檔，只隔離壞檔（寫進 output_path/quarantine.tsv）")
+P.add_argument("--pipeline_depth", type=int, default=0,
+               help="evaluate 第 N 批時最多先 staged 幾批（0=同步，舊行為；1~2=double buffer）")
+P.add_argument("--timeout_base", type=float, default=0,
+               help="每個維度每批的期限 = base + per_sec × 這批影片總秒數；0 = 不設期限（舊行為）。"
+                    "超時整組 kill、該維度維持 -1；搭 --bisect_failures 會把卡住的那支隔離出來")
+P.add_argument("--timeout_per_sec", type=float, default=20, help="每秒影片多給幾秒（見 --timeout_base）")
+P.add_argument("--metrics", action="store_true",
+               help="各 stage 的 latency histogram / queue 深度：定期重寫 output_path/metrics.prom，結束時寫 metrics.json")
+P.add_argument("--metrics_interval", type=float, default=15, help="metrics.prom 幾秒重寫一次")
+P.add_argument("--trace", action="store_true",
+               help="記錄 producer / consumer / evaluate 的時間區段，結束時合併成 output_path/trace.json（chrome://tracing、Perfetto）")
+P.add_argument("--shard", default=None,
+               help="i/N：只做 videoid hash % N == i 的影片（多台機器固定切分）")
+P.add_argument("--cpu_plan", action="store_true",
+               help="把核心切給 producer / 各 consumer，OMP_NUM_THREADS、torch / cv2 threads、ffmpeg -threads 照分到的核心數設，避免 oversubscription")
+P.add_argument("--pin_cpus", action="store_true", help="再用 sched_setaffinity 把各 process 綁在分到的核心上（隱含 --cpu_plan）")
+P.add_argument("--cpus", default=None, help="--cpu_plan 可用的核心，例如 0-15,32-47（預設 = 目前的 affinity）")
+P.add_argument("--producer_cpus", type=int, default=0,
+               help="--cpu_plan 給 producer（轉檔）幾個核心；0 = min(convert_workers, 核心數 / (consumer 數 + 1))")
 args = P.parse_args()
 
 VBENCH_DIMS = ["motion_smoothness", "dynamic_degree"]
 TMP_DIR     = "./tmp"
 os.makedirs(args.output_path, exist_ok=True)
 os.makedirs(TMP_DIR, exist_ok=True)
+if args.cache_dir and os.path.commonpath([os.path.abspath(args.cache_dir), os.path.abspath(TMP_DIR)]) == os.path.abspath(TMP_DIR):
+    raise SystemExit("--cache_dir 不可放在 TMP_DIR 底下（consumer 會刪掉 TMP_DIR 裡的 mp4）")
+if args.stream_input and args.convert_order in ("sjf", "lpt"):
+    raise SystemExit("--stream_input 不能搭 --convert_order sjf / lpt（要先看到全部檔案才能排序）")
+
 OUT_FILE = os.path.join(args.output_path, "output.txt")
 DBG_FILE = os.path.join(args.output_path, "debug.txt")
+IDX_FILE = os.path.join(args.output_path, "processed.idx")
+QUAR_FILE = os.path.join(args.output_path, "quarantine.tsv")
+PROM_FILE = os.path.join(args.output_path, "metrics.prom")
+METRICS_FILE = os.path.join(args.output_path, "metrics.json")
+
+# 每個 process 都往同一個 queue 丟，main 的 thread 匯總（fork 前建好）
+metrics = StageMetrics(PROM_FILE, METRICS_FILE, args.metrics_interval) if args.metrics else NULL_METRICS
+TRACE_FILE = os.path.join(args.output_path, "trace.json")
+tracer = Tracer(os.path.join(args.output_path, "trace")) if args.trace else NULL_TRACER
+# 各 process 一開始照分到的核心設 thread 數（/ affinity）；Process target 用 cpus.wrap 包
+cpus = (CpuPlan(args.max_video_processes, args.convert_workers, parse_cpus(args.cpus) if args.cpus else None,
+                args.producer_cpus, pin=args.pin_cpus)
+        if args.cpu_plan or args.pin_cpus else NULL_CPU_PLAN)
 
 # ─────────── 轉檔 Producer ───────────
 def convert_worker(task_list, q: Queue, n_consumer):
+    cache = (ConversionCache(args.cache_dir, args.cache_gb * 2**30)
+             if args.cache_dir else None)
+    probe = ProbeIndex(args.probe_index) if args.probe_index else None
+    # 轉進 tmp 前先看 byte 預算 / 剩餘空間；有 --cache_dir 時寫進快取（自己有容量上限），不佔 tmp
+    budget = TmpBudget(TMP_DIR, 0 if cache else args.tmp_budget_gb * GB,
+                       0 if cache else args.tmp_min_free_gb * GB, starved=lambda: q.qsize() == 0,
+                       metrics=metrics, tracer=tracer)
+    tracer.name_process("producer")
+
+    # 要不要轉：.mov 一律轉，其他依 probe 到的容器 / codec（.mkv、HEVC 的 .mp4 也轉）；
+    # admit 先問過的記在這裡，convert_one 取走，同一支只 probe 一次
+    planned = {}
+
+    def must_convert(vpath, keep=False):
+        conv = planned.pop(vpath, None)
+        if conv is None:
+            conv = needs_conversion(vpath, probe=probe)
+        if keep:
+            planned[vpath] = conv
+        return conv
+
+    def convert_one(task):
+        vpath, vid, vurl = task
+        mp4 = vpath
+        if (not args.skip_conversion) and must_convert(vpath):
+            mp4 = os.path.join(TMP_DIR, f"{vid}.mp4")
+            if cache or not os.path.exists(mp4):
+                with tracer.span("convert", vid=vid):
+                    mp4, conv_t, mode, _ = convert_video(
+                        vpath, mp4, args.convert_plan, args.convert_window, args.convert_profile,
+                        cache=cache, probe=probe)
+                metrics.observe("convert", conv_t, mode=mode)
+                with open(DBG_FILE, "a") as f:      # 記錄每支影片走哪條路
+                    print(f"{vid}\tconvert:{mode}\t{conv_t:.2f}s", file=f)
+        return (vpath, vid, vurl, mp4)
+
+    cost = None
+    if args.convert_order == "lpt":
+        cost = make_cost_fn(VBENCH_DIMS, probe, None,
+                            args.convert_plan, args.convert_window, args.convert_profile,
+                            convert=not args.skip_conversion)
+
+    def emit(item):
+        # 卡在 put = queue 滿了、consumer 跟不上（evaluate 是瓶頸）
+        with metrics.timer("enqueue_wait"), tracer.span("enqueue_wait", vid=item[1]):
+            q.put(item)
+
+    def admit(task, drain):         # 要轉進 tmp 的才佔預算；等的時候先把轉好的送出去
+        if not args.skip_conversion and must_convert(task[0], keep=True):
+            budget.admit(task[0], drain, vid=task[1])
+
+    def convert_and_release(task):
+        try:
+            return convert_one(task)
+        finally:
+            budget.release(task[0])
+
     try:
-        for vpath, vid, vurl in task_list:
-            mp4 = vpath
-            if (not args.skip_conversion) and vpath.lower().endswith(".mov"):
-                mp4 = os.path.join(TMP_DIR, f"{vid}.mp4")
-                if not os.path.exists(mp4):
-                    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-i", vpath,
-                           "-c:v", "libx264", "-preset", "fast", "-crf", "22",
-                           "-c:a", "aac", "-b:a", "128k", mp4]
-                    try:
-                        subprocess.run(cmd, check=True,
-                                       stdout=subprocess.DEVNULL,
-                                       stderr=subprocess.DEVNULL)
-                    except subprocess.CalledProcessError:
-                        mp4 = None
-            q.put((vpath, vid, vurl, mp4))
+        run_convert_pool(task_list, convert_and_release, emit,
+                         args.convert_workers, args.convert_order, cost,
+                         admit if budget.enabled else None)
     finally:
         for _ in range(n_consumer):
             q.put(("__DONE__", None, None, None))
 
 # ---------- 呼叫 VBench（逐-dimension 版本．修正版） ----------
-def run_vbench_batch(rows, odir, batch_idx):
+def run_vbench_batch(rows, odir, batch_idx, timeout=None):
     """
-    rows : [(mp4_path, video_id, url), ...]
-    回傳 : {video_id: {"motion_smoothness": s, "dynamic_degree": d}}
+    rows    : [(mp4_path, video_id, url), ...]
+    timeout : 每個維度的 evaluate 最多跑幾秒（超過整組 kill，該維度維持 -1）
+    回傳    : {video_id: {"motion_smoothness": s, "dynamic_degree": d}}
     """
     batch_tsv = os.path.join(odir, f"batch_{batch_idx:03d}.tsv")
     with open(batch_tsv, "w") as f:
@@ -70,6 +194,9 @@ def run_vbench_batch(rows, odir, batch_idx):
     for dim in VBENCH_DIMS:
         dim_out = os.path.join(odir, dim)
         os.makedirs(dim_out, exist_ok=True)
+        result_file = os.path.join(dim_out, f"batch_{batch_idx:03d}_result.json")
+        if os.path.exists(result_file):   # 舊的結果檔不能被當成這次的
+            os.remove(result_file)
 
         cmd = [
             "python", "./evaluate_safe.py",
@@ -77,6 +204,7 @@ def run_vbench_batch(rows, odir, batch_idx):
             "--dimension", dim,
             "--mode", "custom_input",
             "--output_path", dim_out,
+            "--result_file", result_file,
         ]
         env = os.environ.copy()
         env["HUB_NO_GIT"] = "1"
@@ -85,19 +213,23 @@ def run_vbench_batch(rows, odir, batch_idx):
         err_path = os.path.join(dim_out,
                                 f"{dim}_batch_{batch_idx:03d}.err")
         try:
-            with open(err_path, "w") as ef:                # ← 第二個 open（新增）
-                subprocess.run(cmd, env=env, check=True,
-                               stdout=subprocess.DEVNULL,
-                               stderr=ef)
+            with open(err_path, "w") as ef, metrics.timer("evaluate", dim=dim), \
+                    tracer.span("evaluate_subprocess", dim=dim, batch=batch_idx, n=len(rows)):
+                run_with_deadline(cmd, timeout, env=env, check=True,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=ef)
         except subprocess.CalledProcessError:
             # 這個維度整批失敗，維持 -1
             continue
+        except subprocess.TimeoutExpired:
+            with open(err_path, "a") as ef:
+                print(f"[TIMEOUT] killed after {timeout:.0f}s", file=ef)
+            continue
 
-        # 讀最新 json
-        jfile = max((p for p in os.listdir(dim_out)
-                     if p.endswith("_eval_results.json")),
-                    key=lambda p: os.path.getmtime(os.path.join(dim_out, p)))
-        with open(os.path.join(dim_out, jfile)) as jf:
+        # 讀 evaluate_safe 寫到指定位置的結果
+        if not os.path.exists(result_file):
+            continue
+        with open(result_file) as jf, metrics.timer("parse", dim=dim), tracer.span("parse", dim=dim):
             data = json.load(jf)[dim]
 
         # -------- ① 純數值：整批同分 --------
@@ -121,50 +253,117 @@ def run_vbench_batch(rows, odir, batch_idx):
     return out
 
 
+# ---------- shared decode：process 內逐支算分 ----------
+def score_batch_shared(rows, scorer, log):
+    """
+    rows : [(mp4_path, video_id, url), ...]
+    回傳 : {video_id: {"motion_smoothness": s, "dynamic_degree": d}}（同 run_vbench_batch）
+    """
+    out = {}
+    for mp4, vid, _ in rows:
+        res, dec_t = scorer.score_all(mp4, VBENCH_DIMS)
+        out[vid] = {d: res[d][0] for d in VBENCH_DIMS}
+        for d in VBENCH_DIMS:
+            if res[d][2]:
+                log(f"{vid}\t{d}\t{res[d][2]}\t{res[d][3]}")
+        log(f"{vid}\tdecode:{dec_t:.2f}s")
+    return out
+
+
 # ─────────── Consumer (批次 flush) ───────────
-def consumer(q: Queue, results, dbg, total_tasks):
+#   flush 把這批交給 BatchPipeline：evaluate / 寫結果在背景 thread，consumer 繼續收下一批
+def consumer(q: Queue, results, dbg, total_tasks, sink):
     def log(m): print(m, file=open(dbg, "a"), flush=True)
+    tracer.name_process("consumer")
 
     bucket, batch_idx, done = [], 0, 0
     start = time.time()
+    quarantine = Quarantine(QUAR_FILE)
+    src_of = {}      # vid → 原始影片路徑（quarantine 記原檔，不記暫存 mp4）
+    job_dur = {}     # vid → 影片秒數（stage 時 probe；evaluate / bisect 算期限用）
 
-    def flush():
-        nonlocal bucket, batch_idx, done
-        if not bucket: return
-        batch_idx += 1
-        odir = os.path.join(args.output_path, "evaluate_result",
-                            f"batch_{batch_idx:03d}")
-        os.makedirs(odir, exist_ok=True)
+    scorer = None
+    if args.shared_decode:
+        from vbench_worker import VBenchScorer
+        scorer = VBenchScorer(VBENCH_DIMS).warmup()
+
+    def stage(job):
+        os.makedirs(job["odir"], exist_ok=True)
+        if args.pipeline_depth:
+            prefetch(mp4 for mp4, _, _ in job["rows"])
+        if args.timeout_base and not scorer:
+            for mp4, vid, _ in job["rows"]:
+                job_dur[vid] = video_duration(mp4)
+
+    def deadline(rows):
+        """這批（或 bisect 的子批）每個維度的期限，依影片總秒數放大"""
+        if not args.timeout_base:
+            return None
+        return timeout_for([job_dur.get(vid) for _, vid, _ in rows],
+                           args.timeout_base, args.timeout_per_sec)
+
+    def evaluate(job):
+        rows, odir, idx = job["rows"], job["odir"], job["idx"]
+        if args.bisect_failures and not scorer:   # shared decode 本來就逐支算，不需要二分
+            def run(sub_rows, tag):
+                sub = odir if tag == "0" else os.path.join(odir, f"bisect_{tag}")
+                os.makedirs(sub, exist_ok=True)
+                return run_vbench_batch(sub_rows, sub, idx, deadline(sub_rows))
+
+            def failed(row, p):        # 任一維度 -1（或整支沒結果）就算失敗
+                return row[1] not in p or any(p[row[1]].get(d, -1) == -1 for d in VBENCH_DIMS)
+
+            src = job["src_of"]
+            return bisect_batch(rows, run, failed, quarantine=quarantine,
+                                path=lambda r: src.get(r[1], r[0]), log=log)
         try:
-            preds = run_vbench_batch(bucket, odir, batch_idx)
+            return (score_batch_shared(rows, scorer, log) if scorer
+                    else run_vbench_batch(rows, odir, idx, deadline(rows)))
         except subprocess.CalledProcessError as e:
-            preds = {vid: {d: -1} for _, vid, _ in bucket}
-            log(f"[BATCH_FAIL] {batch_idx:03d} rc={e.returncode}")
+            log(f"[BATCH_FAIL] {idx:03d} rc={e.returncode}")
+            return {vid: {d: -1} for _, vid, _ in rows}
 
-        for mp4, vid, url in bucket:
+    def finish(job, preds):
+        nonlocal done
+        for mp4, vid, url in job["rows"]:
             row = {"videoid": vid, "Imgurl": url}
             row.update(preds.get(vid, {d: -1 for d in VBENCH_DIMS}))
             results.append(row)
-            with open(OUT_FILE, "a", newline="") as f:
-                csv.DictWriter(f, ["videoid", "Imgurl"]+VBENCH_DIMS,
-                               delimiter="\t").writerow(row)
-            done += 1
+            metrics.inc("videos", result="ok" if all(row.get(d, -1) != -1 for d in VBENCH_DIMS) else "failed")
+            sink.write(row)
+            done += 1          # 只有 finish thread 會加
             print(f"[PROGRESS] {done}/{total_tasks} {vid}", flush=True)
+            job_dur.pop(vid, None)
             if mp4.startswith(TMP_DIR) and os.path.exists(mp4):
                 os.remove(mp4)
-        bucket = []
+
+    pipe = BatchPipeline(evaluate, finish, args.pipeline_depth, stage, tracer)
+
+    def flush():
+        nonlocal bucket, batch_idx, src_of
+        if not bucket: return
+        batch_idx += 1
+        odir = os.path.join(args.output_path, "evaluate_result",
+                            f"batch_{batch_idx:03d}")
+        job = {"idx": batch_idx, "rows": bucket, "odir": odir, "src_of": src_of}
+        bucket, src_of = [], {}
+        pipe.submit(job)
 
     while True:
-        vpath, vid, url, mp4 = q.get()
+        with metrics.timer("dequeue_wait"), tracer.span("dequeue_wait"):   # 等 queue = producer 轉檔跟不上
+            vpath, vid, url, mp4 = q.get()
         if vpath == "__DONE__":
             flush(); break
         if not mp4:
+            metrics.inc("videos", result="convert_failed")
             results.append({"videoid": vid, "Imgurl": url,
                             **{d: -1 for d in VBENCH_DIMS}})
             continue
         bucket.append((mp4, vid, url))
+        src_of[vid] = vpath
         if len(bucket) >= args.batch_size:
             flush()
+    pipe.close()
 
     print(f"[DONE] {done} vids in {time.time()-start:.1f}s", flush=True)
 
@@ -172,40 +371,72 @@ def consumer(q: Queue, results, dbg, total_tasks):
 def main():
     # ── 補 resume ──
     processed = set()
-    if os.path.exists(OUT_FILE):
+    shard = parse_shard(args.shard) if args.shard else None
+    metrics.start()
+    if args.cpu_plan or args.pin_cpus:
+        print(cpus.describe(), flush=True)
+    tracer.name_process("main")
+    sink = ResultSink(OUT_FILE, ["videoid", "Imgurl"]+VBENCH_DIMS,
+                      on_commit=IdIndexAppender(IDX_FILE) if args.id_index else None,
+                      metrics=metrics if args.metrics else None).start()
+    if args.id_index:
+        processed = ProcessedIndex.open(IDX_FILE, seed_from=OUT_FILE)
+    elif os.path.exists(OUT_FILE):
         with open(OUT_FILE) as f:
             for r in csv.reader(f, delimiter="\t"):
                 processed.add(r[0])
+    def check_row(r):
+        if len(r) < 4: return None
+        vpath, vid, vq, url = r[:4]
+        try: vq = float(vq)
+        except: return None
+        if not in_shard(vid, shard): return None     # 別台機器的，連 stat 都不用做
+        if vq > .3 or not os.path.exists(vpath):
+            return ("skip", {"videoid": vid, "Imgurl": url,
+                             **{d:-1 for d in VBENCH_DIMS}})
+        if vid in processed: return None
+        return ("task", (vpath, vid, url))
+
     tasks, skipped = [], []
-    with open(args.input_tsv) as f:
-        for r in csv.reader(f, delimiter="\t"):
-            if len(r) < 4: continue
-            vpath, vid, vq, url = r[:4]
-            try: vq = float(vq)
-            except: continue
-            if vq > .3 or not os.path.exists(vpath):
-                skipped.append({"videoid": vid, "Imgurl": url,
-                                **{d:-1 for d in VBENCH_DIMS}})
-                continue
-            if vid in processed: continue
-            tasks.append((vpath, vid, url))
-    print(f"[MAIN] todo={len(tasks)} skipped={len(skipped)}")
+    if args.stream_input:
+        # producer 邊讀邊 stat 邊轉檔；總數未知
+        tasks = (item for kind, item in
+                 stream_checked(args.input_tsv, check_row, args.stat_workers) if kind == "task")
+        total = "?"
+    else:
+        with open(args.input_tsv) as f:
+            for r in csv.reader(f, delimiter="\t"):
+                res = check_row(r)
+                if res is None: continue
+                (tasks if res[0] == "task" else skipped).append(res[1])
+        print(f"[MAIN] todo={len(tasks)} skipped={len(skipped)}")
+        total = len(tasks)
 
     with Manager() as m:
         q   = m.Queue(args.max_queue_size)
         res = m.list(skipped)
         open(DBG_FILE, "w").close()
+        metrics.watch("queue_depth", q.qsize)
+        metrics.set("queue_capacity", args.max_queue_size)
+        if args.tmp_budget_gb or args.tmp_min_free_gb:     # 看 tmp 用量跟 throttle 對得起來
+            tmp = TmpBudget(TMP_DIR)
+            metrics.watch("tmp_bytes", tmp.usage).watch("tmp_free_bytes", tmp.free)
+            metrics.set("tmp_budget_bytes", args.tmp_budget_gb * GB)
 
-        prod = Process(target=convert_worker,
+        prod = Process(target=cpus.wrap(convert_worker, "producer"),
                        args=(tasks, q, args.max_video_processes))
         prod.start()
-        cons = [Process(target=consumer,
-                        args=(q, res, DBG_FILE, len(tasks)))
-                for _ in range(args.max_video_processes)]
+        cons = [Process(target=cpus.wrap(consumer, "consumer", i),
+                        args=(q, res, DBG_FILE, total, sink))
+                for i in range(args.max_video_processes)]
         for c in cons: c.start()
         prod.join(); [c.join() for c in cons]
+    sink.close()
+    metrics.close()                 # 寫最後一次 metrics.prom + metrics.json
 
     print(f"[DONE] -> {OUT_FILE}")
+    if args.trace:
+        print(f"[DONE] trace -> {TRACE_FILE} ({tracer.merge(TRACE_FILE)} events)")
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, csv, time, json, argparse, subprocess
+import os, csv, time, json, queue, argparse, threading, subprocess, collections
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process, Manager, Queue
-import imageio_ffmpeg
+from conv_cache import ConversionCache
+from probe_index import ProbeIndex
+from job_cost import make_cost_fn
+from result_sink import ResultSink
+from id_index import ProcessedIndex, IdIndexAppender
+from job_ledger import JobLedger
+from tsv_stream import stream_checked
+from shard_lease import parse_shard, in_shard, chunk_offsets, read_chunk, LeaseManager
+from batch_bisect import Quarantine
+from watchdog import video_duration, timeout_for, run_with_deadline, TimeoutTracker, supervise
+from retry_policy import classify, RetryPolicy, RetryLane, CircuitBreaker, TRANSIENT, PERMANENT, UNKNOWN
+from stage_metrics import StageMetrics, NULL as NULL_METRICS
+from trace_spans import Tracer, NULL as NULL_TRACER
+from tmp_budget import TmpBudget, GB
+from cpu_plan import CpuPlan, parse_cpus, NULL as NULL_CPU_PLAN
+from video_convert import convert_video, needs_conversion, run_convert_pool, CONVERT_ORDERS, CONVERT_PLANS, CONVERT_WINDOWS, CONVERT_PROFILES
 import socket, contextlib
 
 # ───────────── argparse ─────────────
@@ -12,7 +28,65 @@ parser.add_argument("--input_tsv", required=True)
 parser.add_argument("--output_path", required=True)
 parser.add_argument("--max_video_processes", type=int, default=1)
 parser.add_argument("--max_queue_size", type=int, default=20)
-parser.add_argument("--skip_conversion", action="store_true", help="Skip .mov to .mp4 conversion")
+parser.add_argument("--tmp_budget_gb", type=float, default=0,
+                    help="./tmp 裡轉好還沒做完的 mp4 總大小上限（GB），超過 producer 就先不轉；0 = 不限（舊行為）")
+parser.add_argument("--tmp_min_free_gb", type=float, default=0,
+                    help="./tmp 所在磁碟至少留幾 GB，不夠 producer 就先不轉；0 = 不檢查")
+parser.add_argument("--skip_conversion", action="store_true", help="Skip conversion to .mp4 (.mov / non-mp4 / non-H.264)")
+parser.add_argument("--warm_workers", action="store_true",
+                    help="consumer 內常駐模型直接算分，不再每支影片開 vbench evaluate")
+parser.add_argument("--shared_decode", action="store_true",
+                    help="每支影片中間視窗只 decode 一次，所有維度共用（隱含 --warm_workers）")
+parser.add_argument("--convert_workers", type=int, default=1, help="平行轉檔 worker 數")
+parser.add_argument("--convert_order", choices=CONVERT_ORDERS, default="input",
+                    help="input=保持輸入順序；sjf=小檔先轉；lpt=預估最久的先做（多 consumer 時縮短尾巴）")
+parser.add_argument("--convert_plan", choices=CONVERT_PLANS, default="transcode",
+                    help="auto=先 probe codec，H.264 直接 remux，其餘才 transcode")
+parser.add_argument("--convert_profile", choices=sorted(CONVERT_PROFILES), default="default",
+                    help="轉檔參數組：video_only 不帶音軌 + ultrafast；score 再壓短邊 512、GOP 8")
+parser.add_argument("--convert_window", choices=CONVERT_WINDOWS, default="full",
+                    help="center=只轉中間視窗（與 5 秒取樣對齊，分數不變）")
+parser.add_argument("--cache_dir", default=None,
+                    help="持久轉檔快取目錄（content fingerprint + 轉檔設定為 key），不可放在 ./tmp 底下")
+parser.add_argument("--cache_gb", type=float, default=100, help="轉檔快取容量上限（GB，LRU 淘汰）")
+parser.add_argument("--probe_index", default=None,
+                    help="probe_index.py 建好的 sidecar metadata index（SQLite）；沒 probe 過的影片會補寫進去")
+parser.add_argument("--ledger", action="store_true",
+                    help="用 SQLite job ledger（output_path/ledger.sqlite）記錄每個 (videoid, dim) 狀態，resume 只補缺的維度")
+parser.add_argument("--id_index", action="store_true",
+                    help="resume 改用 output_path/processed.idx（排序 64-bit hash + mmap），不把所有 id 讀進 set")
+parser.add_argument("--stream_input", action="store_true",
+                    help="邊讀 input_tsv 邊平行 stat 邊轉檔，不先把整個 TSV 讀進記憶體")
+parser.add_argument("--stat_workers", type=int, default=32, help="--stream_input 時平行 stat 的 thread 數")
+parser.add_argument("--shard", default=None,
+                    help="i/N：只做 videoid hash % N == i 的影片（多台機器固定切分）")
+parser.add_argument("--lease_dir", default=None,
+                    help="共享檔案系統上的 lease 目錄：多台機器搶 chunk（work stealing），死掉的機器的 chunk 過期後被收回")
+parser.add_argument("--lease_chunk", type=int, default=500, help="lease 模式每個 chunk 幾行 TSV")
+parser.add_argument("--lease_ttl", type=float, default=600, help="lease 幾秒沒續約就視為過期（背景每 ttl/3 續約）")
+parser.add_argument("--timeout_base", type=float, default=0,
+                    help="每個維度的期限 = base + per_sec × 影片秒數；0 = 不設期限（舊行為）")
+parser.add_argument("--timeout_per_sec", type=float, default=20, help="每秒影片多給幾秒（見 --timeout_base）")
+parser.add_argument("--max_timeouts", type=int, default=2,
+                    help="同一支影片超時 / 卡死幾次就寫進 quarantine.tsv，之後不再重試")
+parser.add_argument("--retry", action="store_true",
+                    help="暫時性失敗（OOM、port 衝突、超時…）backoff 後重試；永久失敗寫進 dead_letter.tsv，之後的 run 跳過")
+parser.add_argument("--max_attempts", type=int, default=3,
+                    help="--retry：每支影片最多跑幾次；--ledger：同一個 (videoid, dim) 跨 run 累計最多跑幾次")
+parser.add_argument("--retry_backoff", type=float, default=30, help="--retry：第一次重試等幾秒（之後每次 ×2）")
+parser.add_argument("--breaker_threshold", type=int, default=5,
+                    help="--retry：同一個錯誤連續出現在幾支不同影片就中止整個 run（環境壞了，不寫 dead-letter）；0 = 不中止")
+parser.add_argument("--metrics", action="store_true",
+                    help="各 stage 的 latency histogram / queue 深度：定期重寫 output_path/metrics.prom，結束時寫 metrics.json")
+parser.add_argument("--metrics_interval", type=float, default=15, help="metrics.prom 幾秒重寫一次")
+parser.add_argument("--trace", action="store_true",
+                    help="記錄 producer / consumer / evaluate 的時間區段，結束時合併成 output_path/trace.json（chrome://tracing、Perfetto）")
+parser.add_argument("--cpu_plan", action="store_true",
+                    help="把核心切給 producer / 各 consumer，OMP_NUM_THREADS、torch / cv2 threads、ffmpeg -threads 照分到的核心數設，避免 oversubscription")
+parser.add_argument("--pin_cpus", action="store_true", help="再用 sched_setaffinity 把各 process 綁在分到的核心上（隱含 --cpu_plan）")
+parser.add_argument("--cpus", default=None, help="--cpu_plan 可用的核心，例如 0-15,32-47（預設 = 目前的 affinity）")
+parser.add_argument("--producer_cpus", type=int, default=0,
+                    help="--cpu_plan 給 producer（轉檔）幾個核心；0 = min(convert_workers, 核心數 / (consumer 數 + 1))")
 args = parser.parse_args()
 
 # ───────────── constants ─────────────
@@ -23,8 +97,32 @@ SENTINEL = ("__DONE__", None, None, None, None)
 os.makedirs(args.output_path, exist_ok=True)
 os.makedirs(TMP_DIR, exist_ok=True)
 
+if args.cache_dir and os.path.commonpath([os.path.abspath(args.cache_dir), os.path.abspath(TMP_DIR)]) == os.path.abspath(TMP_DIR):
+    raise SystemExit("--cache_dir 不可放在 TMP_DIR 底下（consumer 會刪掉 TMP_DIR 裡的 mp4）")
+
+if (args.stream_input or args.lease_dir) and args.convert_order in ("sjf", "lpt"):
+    raise SystemExit("--stream_input / --lease_dir 不能搭 --convert_order sjf / lpt（要先看到全部檔案才能排序）")
+if args.shard and args.lease_dir:
+    raise SystemExit("--shard 與 --lease_dir 擇一（lease 模式本身就會分配工作）")
+
 OUT_FILE = os.path.join(args.output_path, "output.txt")
 DBG_FILE = os.path.join(args.output_path, "debug.txt")
+IDX_FILE = os.path.join(args.output_path, "processed.idx")
+LEDGER_FILE = os.path.join(args.output_path, "ledger.sqlite")
+QUAR_FILE = os.path.join(args.output_path, "quarantine.tsv")
+TIMEOUT_FILE = os.path.join(args.output_path, "timeouts.tsv")
+DEAD_FILE = os.path.join(args.output_path, "dead_letter.tsv")
+PROM_FILE = os.path.join(args.output_path, "metrics.prom")
+METRICS_FILE = os.path.join(args.output_path, "metrics.json")
+
+# 每個 process 都往同一個 queue 丟，main 的 thread 匯總（fork 前建好）
+metrics = StageMetrics(PROM_FILE, METRICS_FILE, args.metrics_interval) if args.metrics else NULL_METRICS
+TRACE_FILE = os.path.join(args.output_path, "trace.json")
+tracer = Tracer(os.path.join(args.output_path, "trace")) if args.trace else NULL_TRACER
+# 各 process 一開始照分到的核心設 thread 數（/ affinity）；Process target 用 cpus.wrap 包
+cpus = (CpuPlan(args.max_video_processes, args.convert_workers, parse_cpus(args.cpus) if args.cpus else None,
+                args.producer_cpus, pin=args.pin_cpus)
+        if args.cpu_plan or args.pin_cpus else NULL_CPU_PLAN)
 
 def get_free_port():
     with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
@@ -37,111 +135,329 @@ def convert_to_mp4_worker(task_list, q: Queue, n_consumer: int):
     task_list 裡每筆是 (orig_path, video_id, video_url)
     轉檔完成後送進 queue → (orig_path, video_id, video_url, mp4_path, conv_time)
     """
-    try:
-        for vpath, vid, vurl in task_list:
-            mp4_path, conv_t = vpath, 0.0  # 預設值（非 .mov 或已快取）
+    cache = (ConversionCache(args.cache_dir, args.cache_gb * 2**30)
+             if args.cache_dir else None)
+    probe = ProbeIndex(args.probe_index) if args.probe_index else None
+    retry = RetryPolicy(args.max_attempts, args.retry_backoff)
+    # 轉進 tmp 前先看 byte 預算 / 剩餘空間；有 --cache_dir 時寫進快取（自己有容量上限），不佔 tmp
+    budget = TmpBudget(TMP_DIR, 0 if cache else args.tmp_budget_gb * GB,
+                       0 if cache else args.tmp_min_free_gb * GB, starved=lambda: q.qsize() == 0,
+                       metrics=metrics, tracer=tracer)
+    tracer.name_process("producer")
 
-            # 如果開啟了 --skip_conversion，直接使用原始檔案
-            if args.skip_conversion:
-                print(f"[SKIP_CONVERT] {vpath} - Using original file", flush=True)
-                q.put((vpath, vid, vurl, vpath, conv_t))
-                continue
+    # 要不要轉：.mov 一律轉，其他依 probe 到的容器 / codec（.mkv、HEVC 的 .mp4 也轉）；
+    # admit 先問過的記在這裡，convert_one 取走，同一支只 probe 一次
+    planned = {}
+
+    def must_convert(vpath, keep=False):
+        conv = planned.pop(vpath, None)
+        if conv is None:
+            conv = needs_conversion(vpath, probe=probe)
+        if keep:
+            planned[vpath] = conv
+        return conv
+
+    def convert_one(task):
+        vpath, vid, vurl = task
+        mp4_path, conv_t = vpath, 0.0  # 預設值（不用轉或已快取）
+
+        # 如果開啟了 --skip_conversion，直接使用原始檔案
+        if args.skip_conversion:
+            print(f"[SKIP_CONVERT] {vpath} - Using original file", flush=True)
+            return (vpath, vid, vurl, vpath, conv_t)
+
+        if must_convert(vpath):
+            mp4_path = os.path.join(TMP_DIR, f"{os.path.splitext(vpath.replace('/','_'))[0]}.mp4")
+            if cache or not os.path.exists(mp4_path):
+                dst = mp4_path
+                for attempt in range(1, (args.max_attempts if args.retry else 1) + 1):
+                    with tracer.span("convert", vid=vid, attempt=attempt):
+                        mp4_path, conv_t, mode, err = convert_video(
+                            vpath, dst, args.convert_plan, args.convert_window, args.convert_profile,
+                            cache=cache, probe=probe)
+                    if mp4_path or not args.retry:
+                        break
+                    if classify("convert_failed", err) == PERMANENT:    # 認不出來的照樣重試、也不進 dead-letter
+                        Quarantine(DEAD_FILE).add(vid, vpath, f"convert:{err}")
+                        break
+                    if retry.should_retry(attempt):     # 暫時性（磁碟滿、記憶體不足）：這個轉檔 thread 等一下再轉
+                        time.sleep(retry.delay(attempt))
+                metrics.observe("convert", conv_t, mode=mode)
+                if mp4_path:
+                    print(f"[CONVERT] ✓ {mode} {mp4_path} {conv_t:.2f}s", flush=True)
+                else:
+                    print(f"[CONVERT] ✗ {vpath}\n{err}", flush=True)
+                with open(DBG_FILE, "a") as f:      # 記錄每支影片走哪條路
+                    print(f"{vid}\tconvert:{mode}\t{conv_t:.2f}s", file=f)
+        return (vpath, vid, vurl, mp4_path, conv_t)
+
+    cost = None
+    if args.convert_order == "lpt":
+        cost = make_cost_fn(VBENCH_DIMS, probe, JobLedger(LEDGER_FILE).mean_elapsed() if args.ledger else None,
+                            args.convert_plan, args.convert_window, args.convert_profile,
+                            convert=not args.skip_conversion)
+
+    def emit(item):
+        # 卡在 put = queue 滿了、consumer 跟不上（evaluate 是瓶頸）
+        with metrics.timer("enqueue_wait"), tracer.span("enqueue_wait", vid=item[1]):
+            q.put(item)
 
-            if vpath.lower().endswith(".mov"):
-                mp4_path = os.path.join(TMP_DIR, f"{os.path.splitext(vpath.replace('/','_'))[0]}.mp4")
-                if not os.path.exists(mp4_path):
-                    tic = time.time()
-                    try:
-                        subprocess.run(
-                            [imageio_ffmpeg.get_ffmpeg_exe(), "-i", vpath,
-                             "-c:v", "libx264", "-preset", "fast", "-crf", "22",
-                             "-c:a", "aac", "-b:a", "128k", mp4_path],
-                            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                        conv_t = time.time() - tic
-                        print(f"[CONVERT] ✓ {mp4_path} {conv_t:.2f}s", flush=True)
-                    except subprocess.CalledProcessError as e:
-                        print(f"[CONVERT] ✗ {vpath}\n{e.stderr.decode()}", flush=True)
-                        mp4_path = None
-            q.put((vpath, vid, vurl, mp4_path, conv_t))
+    def admit(task, drain):         # 要轉進 tmp 的才佔預算；等的時候先把轉好的送出去
+        if not args.skip_conversion and must_convert(task[0], keep=True):
+            budget.admit(task[0], drain, vid=task[1])
+
+    def convert_and_release(task):
+        try:
+            return convert_one(task)
+        finally:
+            budget.release(task[0])
+
+    try:
+        run_convert_pool(task_list, convert_and_release, emit,
+                         args.convert_workers, args.convert_order, cost,
+                         admit if budget.enabled else None)
     finally:
         for _ in range(n_consumer):
             q.put(SENTINEL)
 
-def run_vbench(mp4, dim, odir):
-    """return (score, elapsed, err_msg, stderr_text)"""
+def run_vbench(mp4, dim, odir, timeout=None, on_child=None):
+    """
+    return (score, elapsed, err_msg, stderr_text)；超過 timeout 秒整組 kill，err_msg = TIMEOUT
+    on_child 見 watchdog.run_with_deadline（consumer 把 evaluate 的 pgid 登記給 supervise）
+    """
+    result_file = os.path.join(odir, f"{dim}_result.json")   # 由 driver 指定，不再掃目錄找最新 json
+    if os.path.exists(result_file):   # 舊的結果檔不能被當成這次的
+        os.remove(result_file)
     cmd = [
-        "vbench", "evaluate",
-        "--ngpus", "1",
+        "python", "./evaluate_safe.py",
         "--videos_path", mp4,
         "--dimension", dim,
         "--mode", "custom_input",
         "--output_path", odir,
+        "--result_file", result_file,
     ]
 
     env = os.environ.copy()  # 使用默認環境變量
+    env["HUB_NO_GIT"] = "1"
+    env["RANK"] = "0"        # 確保 get_rank()==0
 
     tic = time.time()
-    result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    try:
+        result = run_with_deadline(cmd, timeout, env=env, capture_output=True, text=True, on_child=on_child)
+    except subprocess.TimeoutExpired as e:
+        err = e.stderr.decode("utf-8", "ignore") if isinstance(e.stderr, bytes) else (e.stderr or "")
+        return -1, time.time() - tic, f"TIMEOUT({timeout:.0f}s)", err.strip()[-500:]
 
     et = time.time() - tic
-    err_txt = result.stderr.strip()[:500]  # 前 500 字即可，太長寫檔
+    err_txt = result.stderr.strip()[-500:]  # 最後 500 字即可（traceback 的例外在最後，--retry 靠它分類）
 
     if result.returncode != 0:
         return -1, et, f"CLI_FAIL(rc={result.returncode})", err_txt
 
-    json_files = [f for f in os.listdir(odir) if f.endswith("_eval_results.json")]
-    if not json_files:
+    if not os.path.exists(result_file):
         return -1, et, "NO_JSON", err_txt
 
-    latest = os.path.join(odir, max(json_files, key=lambda f: os.path.getmtime(os.path.join(odir, f))))
     try:
-        with open(latest) as jf:
-            j = json.load(jf)
-        val = j.get(dim, -1)
-        if isinstance(val, list):
-            val = val[1][0].get("video_results", -1) if dim == "dynamic_degree" \
-                  else val[1][0].get("video_results", -1)
-        score = float(val) if val != -1 else -1
+        with metrics.timer("parse", dim=dim), tracer.span("parse", dim=dim):
+            with open(result_file) as jf:
+                j = json.load(jf)
+            val = j.get(dim, -1)
+            if isinstance(val, list):
+                val = val[1][0].get("video_results", -1)
+            score = float(val) if val != -1 else -1
     except Exception as e:
         return -1, et, f"PARSE_ERR:{e}", err_txt
 
     return score, et, "", err_txt
 
 # ───────────── consumer ─────────────
-def consumer(q: Queue, results, dbg, total_tasks):
+def consumer(q: Queue, results, dbg, total_tasks, sink, ledger=None, busy=None, abort=None, settled=None):
     def log(m): print(m, file=open(dbg, "a"), flush=True)
     processed_count = 0  # 記錄已處理的影片數量
     start_time = time.time()  # 記錄處理開始時間
+    watch = args.timeout_base > 0
+    probe = ProbeIndex(args.probe_index) if watch and args.probe_index else None
+    tracker = TimeoutTracker(TIMEOUT_FILE, QUAR_FILE, args.max_timeouts) if watch else None
+    lane = RetryLane(RetryPolicy(args.max_attempts, args.retry_backoff)) if args.retry else None
+
+    def publish_child(pgid):
+        # evaluate 子程序的 process group 登記進 busy：supervise 殺這個 consumer 時連它一起殺
+        ent = busy.get(os.getpid())
+        if ent:
+            busy[os.getpid()] = (ent[0], {**ent[1], "pgid": pgid}, ent[2])
+    dead = Quarantine(DEAD_FILE)
+    breaker = CircuitBreaker(args.breaker_threshold if args.retry else 0)
+    works = set()               # 這個 consumer 裡成功過的維度（環境沒壞的證據）
+    input_done = False
+    tracer.name_process("consumer")
+
+    # warm worker：模型每個 consumer 只載一次
+    scorer = None
+    if args.warm_workers or args.shared_decode:
+        from vbench_worker import VBenchScorer
+        scorer = VBenchScorer(VBENCH_DIMS).warmup()
+
+    def next_job():
+        """
+        return (task, attempt, row, dims)；沒有了 → None
+        主 queue 優先；主 queue 暫時沒東西 / 已收到 sentinel 才做到期的重試（低優先序 lane），
+        lane 積太多（> max_queue_size，暫存 mp4 佔著磁碟）時到期的重試先做
+        """
+        nonlocal input_done
+        while True:
+            if abort is not None and abort.is_set():    # 別的 consumer 觸發了 circuit breaker
+                return None
+            if lane and len(lane) > args.max_queue_size:
+                due = lane.pop_due()
+                if due:
+                    (task, row, dims), attempt = due
+                    return task, attempt, row, dims
+            if not input_done:
+                wait = lane.wait() if lane else None
+                tic = time.time()
+                try:
+                    task = q.get() if wait is None else q.get(timeout=max(wait, 0.01))
+                except queue.Empty:
+                    task = None
+                # 等 queue = producer 轉檔跟不上（GPU 閒著）
+                metrics.observe("dequeue_wait", time.time() - tic)
+                tracer.add("dequeue_wait", tic)
+                if task is not None:
+                    if task[0] != "__DONE__":
+                        return task, 1, None, None
+                    input_done = True
+            if not lane:
+                return None
+            due = lane.pop_due()
+            if due:
+                (task, row, dims), attempt = due
+                return task, attempt, row, dims
+            if input_done:
+                if not len(lane):
+                    return None
+                time.sleep(min(lane.wait(), 5.0))
 
     while True:
-        vpath, vid, vurl, mp4, _ = q.get()
-        if vpath == "__DONE__":
+        job = next_job()
+        if job is None:
             break
+        (vpath, vid, vurl, mp4, _), attempt, row, dims = job
+        # ledger 模式只跑還沒 done 的維度，已 done 的分數直接沿用；重試只跑上次暫時性失敗的維度
+        if dims is None:
+            dims = ledger.missing(vid, VBENCH_DIMS, args.max_attempts) if ledger else VBENCH_DIMS
         if not mp4:
             log(f"{vid}\tconvert_failed")
+            metrics.inc("videos", result="convert_failed")
             results.append({"videoid": vid, "Imgurl": vurl,
                             "motion_smoothness": -1, "dynamic_degree": -1})
+            for dim in (dims if ledger else []):
+                ledger.fail(vid, dim, "convert_failed")
             continue
 
-        row = {"videoid": vid, "Imgurl": vurl}
+        if row is None:
+            row = {"videoid": vid, "Imgurl": vurl, **{d: -1 for d in VBENCH_DIMS}}
+            if ledger:
+                row.update(ledger.scores(vid))
+        if ledger:
+            for dim in dims:
+                ledger.start(vid, dim)
         base_out = os.path.join(args.output_path, "evaluate_result")
         video_start_time = time.time()  # 記錄單部影片處理開始時間
-        for dim in VBENCH_DIMS:
-            odir = os.path.join(base_out, dim, vid)  # 每影片專屬子目錄
-            os.makedirs(odir, exist_ok=True)
-            score, elapsed, err_tag, stderr_txt = run_vbench(mp4, dim, odir)
+        dim_timeout = None
+        if watch:
+            dur = video_duration(vpath if probe else mp4, probe)
+            dim_timeout = timeout_for(dur, args.timeout_base, args.timeout_per_sec)
+            # main 的 supervise 看這個：in-process 算分卡死時整個 consumer 換掉
+            # （subprocess 模式多給一個 base 的餘裕，正常會先被 run_vbench 的 timeout 收掉）
+            busy[os.getpid()] = (video_start_time + dim_timeout * len(dims) + args.timeout_base,
+                                 {"vid": vid, "vurl": vurl, "vpath": vpath, "mp4": mp4, "dims": dims},
+                                 video_start_time)
+        shared = None
+        if args.shared_decode:
+            with tracer.span("score_all", vid=vid):
+                shared, dec_t = scorer.score_all(mp4, dims)
+            log(f"{vid}\tdecode:{dec_t:.2f}s")
+        retry_dims, unknown_dims, quarantined, tripped = [], {}, False, None
+        for dim in dims:
+            dim_tic = time.time()
+            if shared:
+                score, elapsed, err_tag, stderr_txt = shared[dim]
+            elif scorer:
+                score, elapsed, err_tag, stderr_txt = scorer.score(mp4, dim)
+            else:
+                odir = os.path.join(base_out, dim, vid)  # 每影片專屬子目錄
+                os.makedirs(odir, exist_ok=True)
+                score, elapsed, err_tag, stderr_txt = run_vbench(mp4, dim, odir, dim_timeout,
+                                                                 publish_child if watch else None)
             row[dim] = score
+            metrics.observe("evaluate", elapsed, dim=dim)
+            tracer.add("evaluate", dim_tic, vid=vid, dim=dim, err=err_tag)
             if err_tag:  # 不論何種錯誤都寫 tag + 簡短 stderr
                 log(f"{vid}\t{dim}\t{err_tag}\t{stderr_txt}")
+                if ledger: ledger.fail(vid, dim, err_tag, elapsed)
+                if err_tag.startswith("TIMEOUT") and tracker.record(vid, dim, elapsed, vpath):
+                    log(f"[QUARANTINE] {vid}\t{err_tag} x{args.max_timeouts}")
+                    quarantined = True
+                    break               # 已隔離：剩下的維度不用再卡一次
+                if lane is not None:    # RetryLane 空的時候是 falsy，不能寫 if lane
+                    if breaker.record(vid, err_tag, stderr_txt, key=dim):
+                        tripped = breaker.last(dim)
+                        break
+                    kind = classify(err_tag, stderr_txt)
+                    if kind == PERMANENT:   # 確定是影片的問題：記 dead-letter，之後的 run 不再重跑
+                        dead.add(vid, vpath, f"{dim}:{err_tag} {stderr_txt}")
+                        log(f"[DEAD_LETTER] {vid}\t{dim}\t{err_tag}")
+                    else:               # 暫時性 / 認不出來：重試；認不出來的次數用完才 dead-letter
+                        retry_dims.append(dim)
+                        if kind == UNKNOWN:
+                            unknown_dims[dim] = f"{err_tag} {stderr_txt}"
             else:
                 log(f"{vid}\t{dim}:{score}\t{elapsed:.2f}s")
+                breaker.ok(dim)
+                works.add(dim)
+                if ledger: ledger.finish(vid, dim, score, elapsed)
         video_elapsed_time = time.time() - video_start_time  # 單部影片處理時間
+        metrics.observe("video", video_elapsed_time)
+        tracer.add("video", video_start_time, vid=vid, attempt=attempt)
+        if watch:
+            busy.pop(os.getpid(), None)
+
+        if tripped:
+            # 連續 breaker_threshold 支不同影片同一個錯誤：環境問題，整個 run 停下來；
+            # 這支不寫結果、不進 dead-letter，修好環境後重跑會再做
+            msg = (f"[BREAKER] {args.breaker_threshold} different videos in a row failed with "
+                   f"the same error, aborting the run: {tripped}")
+            log(msg)
+            print(msg, flush=True)
+            if abort is not None:
+                abort.set()
+            break
+
+        if retry_dims and not quarantined:
+            if lane.policy.should_retry(attempt):
+                d = lane.defer(((vpath, vid, vurl, mp4, None), row, retry_dims), attempt)
+                tracer.instant("retry_deferred", vid=vid, dims=retry_dims, delay=round(d, 1))
+                log(f"[RETRY] {vid}\t{','.join(retry_dims)}\tattempt {attempt + 1} in {d:.0f}s")
+                continue                # mp4 留著給重試用
+            log(f"[RETRY] {vid}\tgave up after {attempt} attempts")
+            for dim, why in unknown_dims.items():
+                if dim in works:        # 這個維度別支做得出來、這支重試到底還是失敗：當成影片的問題
+                    dead.add(vid, vpath, f"{dim}:{why}")
+                    log(f"[DEAD_LETTER] {vid}\t{dim}\t{why[:200]}")
+                else:                   # 還沒有任何一支成功過，可能是環境問題：不判死，下次 run 再做
+                    log(f"[RETRY] {vid}\t{dim}\tnot dead-lettered: no {dim} has succeeded yet")
+            if not ledger:
+                # 不寫結果：下次 run 會再試（ledger 模式照寫，ledger 裡是 failed、下次 todo 會撿回來）
+                if mp4.startswith(TMP_DIR) and os.path.exists(mp4):
+                    os.remove(mp4)
+                if settled is not None:     # 沒有 row 也算這支做完了（lease chunk 才湊得滿）
+                    settled.append(vid)
+                continue
         results.append(row)
+        metrics.inc("videos", result="ok" if all(row[d] != -1 for d in VBENCH_DIMS) else "failed")
 
-        # 即時將結果寫入 OUT_FILE
-        with open(OUT_FILE, "a", newline="") as f:
-            writer = csv.DictWriter(f, ["videoid", "Imgurl"] + VBENCH_DIMS, delimiter="\t")
-            writer.writerow(row)
+        # 交給 result sink（單一 writer 批次寫入 OUT_FILE）
+        sink.write(row)
 
         # 刪除暫存的 mp4 檔案
         if mp4.startswith(TMP_DIR) and os.path.exists(mp4):
@@ -158,53 +474,251 @@ def consumer(q: Queue, results, dbg, total_tasks):
     total_elapsed_time = time.time() - start_time
     print(f"[DONE] All videos processed in {total_elapsed_time:.2f}s", flush=True)
 
+# ───────────── lease keeper（main process 的 thread） ─────────────
+def keep_leases(leases, results, state, stop, sink, poll=5.0):
+    """
+    看每支影片的最終結果 → 對回 chunk：results 裡新寫出的 row，加上 state["settled"]
+    （--retry 放棄、不寫 row 的影片）。chunk 的 task 全部有結果、
+    且過了 sink 的 flush + fsync 時間（row 已 commit）才標 .done、釋放 lease。
+    一支影片只算一次（vid_chunk pop 掉）；stop 之後（sink 已 close）再掃最後一次。
+    """
+    grace = sink.flush_secs + sink.fsync_secs + 1
+    seen, seen_settled, done_n, full_at = 0, 0, collections.Counter(), {}
+    while True:
+        stopping = stop.wait(poll)
+        rows = results[seen:]
+        seen += len(rows)
+        gave_up = state["settled"][seen_settled:]
+        seen_settled += len(gave_up)
+        for vid in [row["videoid"] for row in rows] + gave_up:
+            c = state["vid_chunk"].pop(vid, None)
+            if c is not None:
+                done_n[c] += 1
+        now = time.time()
+        for c, n in list(state["chunk_size"].items()):
+            if done_n[c] < n:
+                continue
+            if stopping or now - full_at.setdefault(c, now) >= grace:
+                leases.release(c, done=True)
+                del state["chunk_size"][c]
+                print(f"[LEASE] chunk {c} done ({n} videos)", flush=True)
+        if stopping:
+            return
+
 # ───────────── main ─────────────
 def main():
     tasks, skipped = [], []
     processed_videos = set()
 
-    # 檢查 OUT_FILE 是否已存在，並讀取已處理的檔案
-    if os.path.exists(OUT_FILE):
+    # 先開 sink：recover 會把 OUT_FILE 截到最後一次 commit，resume 才不會讀到殘行
+    metrics.start()
+    if args.cpu_plan or args.pin_cpus:
+        print(cpus.describe(), flush=True)
+    tracer.name_process("main")
+    sink = ResultSink(OUT_FILE, ["videoid", "Imgurl"] + VBENCH_DIMS,
+                      on_commit=IdIndexAppender(IDX_FILE) if args.id_index else None,
+                      metrics=metrics if args.metrics else None).start()
+    ledger = JobLedger(LEDGER_FILE) if args.ledger else None
+    if ledger and ledger.created:       # 第一次用 ledger：舊 output 裡算好的分數直接算 done
+        seeded = ledger.seed_from_tsv(OUT_FILE, VBENCH_DIMS)
+        print(f"[MAIN] ledger {LEDGER_FILE} created, seeded {seeded} done jobs from {OUT_FILE}")
+    shard = parse_shard(args.shard) if args.shard else None
+    leases = LeaseManager(args.lease_dir, args.lease_ttl) if args.lease_dir else None
+    quarantined = Quarantine(QUAR_FILE).ids()      # 反覆超時 / 卡死的影片不再重試
+    if quarantined:
+        print(f"[MAIN] {len(quarantined)} quarantined videos in {QUAR_FILE} will be skipped")
+    if args.retry:                                  # 已知的壞檔（永久失敗）也跳過
+        dead = Quarantine(DEAD_FILE).ids()
+        if dead:
+            print(f"[MAIN] {len(dead)} dead-letter videos in {DEAD_FILE} will be skipped")
+        quarantined |= dead
+
+    # 檢查 OUT_FILE 是否已存在，並讀取已處理的檔案（ledger 模式改查 ledger）
+    if args.id_index and not ledger:    # ledger 模式要補缺的維度，不能整支跳過
+        processed_videos = ProcessedIndex.open(IDX_FILE, seed_from=OUT_FILE)
+        print(f"[MAIN] Resuming from {IDX_FILE}, already processed {len(processed_videos)} videos")
+    elif not ledger and os.path.exists(OUT_FILE):
         with open(OUT_FILE, "r") as f:
             reader = csv.reader(f, delimiter="\t")
             for row in reader:
                 processed_videos.add(row[0])  # 使用第一列作為 videoid
         print(f"[MAIN] Resuming from {OUT_FILE}, already processed {len(processed_videos)} videos")
 
-    # 讀取 input_tsv，過濾掉已處理的檔案
-    with open(args.input_tsv) as f:
-        for r in csv.reader(f, delimiter="\t"):
-            if len(r) < 4: continue
-            vpath, vid, vq, vurl = r[:4]
-            try:
-                vq = float(vq)
-            except ValueError:
-                continue
-            if vq > .3 or not os.path.exists(vpath):
-                skipped.append({"videoid": vid, "Imgurl": vurl,
-                                "motion_smoothness": -1, "dynamic_degree": -1})
-                continue
-            if vid in processed_videos:
-                print(f"[SKIP] {vid} already processed, skipping", flush=True)
-                continue
-            tasks.append((vpath, vid, vurl))
-    print(f"[MAIN] tasks={len(tasks)} skipped={len(skipped)}")
+    def check_row(r):
+        """input_tsv 一行 → ("task", (vpath, vid, vurl)) / ("skip", row) / None（丟掉）"""
+        if len(r) < 4: return None
+        vpath, vid, vq, vurl = r[:4]
+        try:
+            vq = float(vq)
+        except ValueError:
+            return None
+        if not in_shard(vid, shard):    # 別台機器的，連 stat 都不用做
+            return None
+        if vq > .3 or not os.path.exists(vpath):
+            return ("skip", {"videoid": vid, "Imgurl": vurl,
+                             "motion_smoothness": -1, "dynamic_degree": -1})
+        if vid in processed_videos:
+            print(f"[SKIP] {vid} already processed, skipping", flush=True)
+            return None
+        if vid in quarantined:
+            print(f"[SKIP] {vid} quarantined / dead-letter, skipping", flush=True)
+            return None
+        return ("task", (vpath, vid, vurl))
+
+    def wanted(vid):
+        """串流 / lease 模式逐支查 ledger（一次 enqueue 整個 TSV 的做法要先讀完全部）"""
+        if not ledger:
+            return True
+        ledger.enqueue([vid], VBENCH_DIMS)
+        return bool(ledger.missing(vid, VBENCH_DIMS, args.max_attempts))
+
+    lease_state = {}        # Manager dict 在下面建好後放進來（producer fork 時帶過去）
+    if leases:
+        # 搶 chunk → 只轉 / 評這個 chunk 的影片；chunk 做完由 main 的 keep_leases 標 .done
+        def iter_tasks():
+            offsets = chunk_offsets(args.input_tsv, args.lease_chunk)
+            print(f"[LEASE] {len(offsets)} chunks of {args.lease_chunk} rows, owner={leases.owner}", flush=True)
+            with ThreadPoolExecutor(max_workers=args.stat_workers) as pool:
+                for c in leases.claim_iter(len(offsets)):
+                    rows = read_chunk(args.input_tsv, offsets, c, args.lease_chunk)
+                    chunk, vids = [], set()
+                    for res in pool.map(check_row, rows):
+                        if not res or res[0] != "task":
+                            continue
+                        vid = res[1][1]
+                        # 重複的 videoid（同 chunk，或還在做的前一個 chunk）只做一次；
+                        # 否則 chunk 數到的結果永遠比 task 少，不會標 .done
+                        if vid in vids or vid in lease_state["vid_chunk"] or not wanted(vid):
+                            continue
+                        vids.add(vid)
+                        chunk.append(res[1])
+                    for t in chunk:
+                        lease_state["vid_chunk"][t[1]] = c
+                    lease_state["chunk_size"][c] = len(chunk)
+                    print(f"[LEASE] claimed chunk {c}: {len(chunk)} tasks", flush=True)
+                    yield from chunk
+
+        tasks, total = iter_tasks(), "?"
+    elif args.stream_input:
+        # producer 邊讀邊 stat 邊轉檔（fork 後在 producer process 裡跑）；總數未知
+        def iter_tasks():
+            n_task = n_skip = 0
+            for kind, item in stream_checked(args.input_tsv, check_row, args.stat_workers):
+                if kind == "skip":
+                    n_skip += 1
+                    continue
+                if not wanted(item[1]):
+                    continue
+                n_task += 1
+                yield item
+            print(f"[MAIN] input exhausted: tasks={n_task} skipped={n_skip}", flush=True)
+
+        tasks, total = iter_tasks(), "?"
+    else:
+        # 讀取 input_tsv，過濾掉已處理的檔案
+        with open(args.input_tsv) as f:
+            for r in csv.reader(f, delimiter="\t"):
+                res = check_row(r)
+                if res is None: continue
+                (tasks if res[0] == "task" else skipped).append(res[1])
+
+        if ledger:
+            # 新影片補進 ledger，再用 index 查還有缺維度的影片（同一支影片失敗的維度也會被撿回來）
+            added = ledger.enqueue((vid for _, vid, _ in tasks), VBENCH_DIMS)
+            todo = ledger.todo(args.max_attempts)
+            tasks = [t for t in tasks if t[1] in todo]
+            print(f"[MAIN] ledger {LEDGER_FILE}: +{added} jobs, {ledger.counts()}")
+        print(f"[MAIN] tasks={len(tasks)} skipped={len(skipped)}")
+        total = len(tasks)
 
+    if ledger:
+        ledger.close()                  # Manager / producer / consumer 都是 fork：不帶開著的 connection 過去
     with Manager() as m:
         q = m.Queue(args.max_queue_size)
         results = m.list(skipped)
         open(DBG_FILE, "w").close()
+        metrics.watch("queue_depth", q.qsize)
+        metrics.set("queue_capacity", args.max_queue_size)
+        if args.tmp_budget_gb or args.tmp_min_free_gb:     # 看 tmp 用量跟 throttle 對得起來
+            tmp = TmpBudget(TMP_DIR)
+            metrics.watch("tmp_bytes", tmp.usage).watch("tmp_free_bytes", tmp.free)
+            metrics.set("tmp_budget_bytes", args.tmp_budget_gb * GB)
+        if leases:
+            lease_state.update(chunk_size=m.dict(), vid_chunk=m.dict(), settled=m.list())
+            leases.start_renewer()
+            stop = threading.Event()
+            keeper = threading.Thread(target=keep_leases, daemon=True,
+                                      args=(leases, results, lease_state, stop, sink))
+            keeper.start()
 
-        prod = Process(target=convert_to_mp4_worker, args=(tasks, q, args.max_video_processes))
+        busy = m.dict()
+        abort = m.Event()               # --retry 的 circuit breaker 觸發 → 整個 run 停
+        prod = Process(target=cpus.wrap(convert_to_mp4_worker, "producer"),
+                       args=(tasks, q, args.max_video_processes))
         prod.start()
-        workers = [Process(target=consumer, args=(q, results, DBG_FILE, len(tasks)))
-                   for _ in range(args.max_video_processes)]
-        for w in workers: w.start()
+        def spawn(slot):                # watchdog 補上的 consumer 接手被換掉那個的 slot（核心）
+            if ledger:
+                ledger.close()          # on_stuck 在 main 開過 connection
+            w = Process(target=cpus.wrap(consumer, "consumer", slot),
+                        args=(q, results, DBG_FILE, total, sink, ledger, busy, abort, lease_state.get("settled")))
+            w.start()
+            return w
+
+        workers = [spawn(i) for i in range(args.max_video_processes)]
+
+        finished = threading.Event()
+
+        def stop_on_abort():
+            # producer 可能卡在 q.put：直接停掉；還在等 q.get 的 consumer 用 sentinel 叫醒
+            while not finished.is_set():
+                if abort.wait(1.0):
+                    prod.terminate()
+                    for _ in workers:
+                        with contextlib.suppress(queue.Full):
+                            q.put_nowait(SENTINEL)
+                    return
+        aborter = threading.Thread(target=stop_on_abort, daemon=True)
+        aborter.start()
+
+        if args.timeout_base > 0:
+            tracker = TimeoutTracker(TIMEOUT_FILE, QUAR_FILE, args.max_timeouts)
+
+            def on_stuck(info, reason, elapsed):
+                # 被殺掉的 consumer 來不及寫的 row 由 main 補（失敗標記），ledger 標 failed
+                vid = info["vid"]
+                tracer.instant("watchdog_kill", vid=vid, reason=reason)
+                row = {"videoid": vid, "Imgurl": info["vurl"], **{d: -1 for d in VBENCH_DIMS}}
+                if ledger:
+                    row.update(ledger.scores(vid))
+                    for dim in info["dims"]:
+                        ledger.fail(vid, dim, f"WATCHDOG:{reason}", elapsed)
+                results.append(row)
+                sink.write(row)
+                if tracker.record(vid, f"consumer:{reason}", elapsed, info["vpath"]):
+                    print(f"[QUARANTINE] {vid}\t{reason}", flush=True)
+                mp4 = info["mp4"]
+                if mp4 and mp4.startswith(TMP_DIR) and os.path.exists(mp4):
+                    os.remove(mp4)
 
+            supervise(workers, spawn, busy, on_stuck)
         prod.join()
         for w in workers: w.join()
+        finished.set(); aborter.join()      # Manager 關掉前停下來
+        sink.close()
+        if leases:
+            stop.set(); keeper.join()       # sink 已 commit → 剩下做完的 chunk 可以標 .done
+            leases.stop_renewer()
+        metrics.close()                     # 寫最後一次 metrics.prom + metrics.json
+        aborted = abort.is_set()
     
     print(f"[DONE] → {OUT_FILE}\n[DONE] debug → {DBG_FILE}")
+    if args.metrics:
+        print(f"[DONE] metrics → {METRICS_FILE}")
+    if args.trace:
+        print(f"[DONE] trace → {TRACE_FILE} ({tracer.merge(TRACE_FILE)} events)")
+    if aborted:
+        raise SystemExit(f"[ABORT] circuit breaker tripped, see {DBG_FILE}; nothing was dead-lettered, "
+                         f"fix the environment and rerun")
 
 if __name__ == "__main__":
     main()
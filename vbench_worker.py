@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常駐 VBench scorer（warm worker）
+------------------------------------------------
+每個 consumer process 建一個 VBenchScorer，每個 dimension 的模型只載一次；
+之後每支影片直接在 process 內算分，不再為每支影片 / 每個維度
+重開 `vbench evaluate`（重 import torch、重載 RAFT / AMT 權重）。
+
+    scorer = VBenchScorer(["motion_smoothness", "dynamic_degree"])
+    scorer.warmup()
+    score, elapsed, err_tag, err_txt = scorer.score(mp4, "dynamic_degree")
+
+score() 的回傳格式與 driver 裡的 run_vbench() 相同，可直接替換。
+
+score_all() 則是「解碼一次、所有維度共用」：中間 5 秒只 decode 一次，
+再依各 scorer 的取樣規則（與 0001-new-score-for-acceleration.patch 的
+get_frames 完全相同的 frame 數學）切出各自的 frame list 餵進模型。
+"""
+import os, time
+
+SUPPORTED_DIMS = ("motion_smoothness", "dynamic_degree")
+
+
+# ───────────── shared decode ─────────────
+def _ms_frame_ids(fps, total):
+    """同 patched FrameProcess.get_frames(frame_interval=4)"""
+    fps = int(fps)
+    start = max(0, (total // 2) - (fps * 2))
+    end = min(total, (total // 2) + (fps * 3))
+    return range(start, end, 4)
+
+def _dd_frame_ids(fps, total):
+    """同 patched DynamicDegree.get_frames（interval = round(fps/8)）"""
+    interval = max(1, round(fps / 8))
+    start = max(0, int((total // 2) - (fps * 2)))
+    end = min(total, int((total // 2) + (fps * 3)))
+    return range(start, end, interval)
+
+# dim → (fps, total_frames) -> 要取的 frame index；新增共用 decode 的維度在這裡註冊
+FRAME_PLANS = {
+    "motion_smoothness": _ms_frame_ids,
+    "dynamic_degree": _dd_frame_ids,
+}
+
+def decode_frames(video_path, dims):
+    """
+    中間視窗只 decode 一次。
+    return {dim: [RGB ndarray, ...]}，每個維度拿到的 frame 與各自 get_frames() 一致
+    """
+    import cv2
+    video = cv2.VideoCapture(video_path)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    total = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    if fps <= 0 or total <= 0:
+        video.release()
+        return {d: [] for d in dims}
+
+    plans = {d: FRAME_PLANS[d](fps, total) for d in dims}
+    wanted = set().union(*plans.values())
+    last = max(wanted) if wanted else -1
+
+    frames, idx = {}, 0
+    while idx <= last and video.isOpened():
+        if idx in wanted:
+            success, frame = video.read()
+            if not success:
+                break
+            frames[idx] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        elif not video.grab():          # 不需要的 frame 只 grab，不做色彩轉換
+            break
+        idx += 1
+    video.release()
+    return {d: [frames[i] for i in r if i in frames] for d, r in plans.items()}
+
+
+class VBenchScorer:
+    def __init__(self, dims, device=None):
+        unknown = [d for d in dims if d not in SUPPORTED_DIMS]
+        if unknown:
+            raise ValueError(f"unsupported dimension(s): {unknown}")
+        self.dims = list(dims)
+        self.device = device
+        self._models = {}
+        self._submodules = None
+
+    # ───────────── model loading ─────────────
+    def _init_device(self):
+        import torch
+        os.environ.setdefault("RANK", "0")          # 確保 get_rank()==0
+        os.environ.setdefault("WORLD_SIZE", "1")
+        if self.device is None:
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    def _load(self, dim):
+        if dim in self._models:
+            return self._models[dim]
+        self._init_device()
+        if self._submodules is None:
+            from vbench.utils import init_submodules
+            self._submodules = init_submodules(self.dims)   # 權重不存在時會先下載
+        sub = self._submodules[dim]
+
+        tic = time.time()
+        if dim == "motion_smoothness":
+            from vbench.motion_smoothness import MotionSmoothness
+            model = MotionSmoothness(sub["config"], sub["ckpt"], self.device)
+        else:  # dynamic_degree
+            from easydict import EasyDict as edict
+            from vbench.dynamic_degree import DynamicDegree
+            model = DynamicDegree(edict({"model": sub["model"], "small": False,
+                                         "mixed_precision": False, "alternate_corr": False}),
+                                  self.device)
+        print(f"[SCORER] pid={os.getpid()} loaded {dim} in {time.time()-tic:.2f}s", flush=True)
+        self._models[dim] = model
+        return model
+
+    def warmup(self):
+        """先把所有維度的模型載好，第一支影片不用等"""
+        for dim in self.dims:
+            self._load(dim)
+        return self
+
+    # ───────────── scoring ─────────────
+    def _score(self, mp4, dim, frames=None):
+        import torch
+        model = self._load(dim)
+        # 有預先 decode 的 frames 就暫時蓋掉 get_frames，模型其餘流程不動
+        target = model.fp if dim == "motion_smoothness" else model
+        if frames is not None:
+            if dim == "motion_smoothness":
+                target.get_frames = lambda *_a, **_k: list(frames)
+            else:
+                target.get_frames = lambda *_a, **_k: [
+                    torch.from_numpy(f).permute(2, 0, 1).float()[None].to(self.device)
+                    for f in frames]
+        try:
+            with torch.no_grad():
+                if dim == "motion_smoothness":
+                    return float(model.motion_score(mp4))
+                res = model.infer(mp4)
+                # patched 版 infer() 回傳 (whether_move, total_score, avg_score)，與 CLI 一樣取 avg
+                return float(res[2]) if isinstance(res, tuple) else float(res)
+        finally:
+            if frames is not None:
+                del target.get_frames
+
+    def score(self, mp4, dim, frames=None):
+        """return (score, elapsed, err_msg, err_text)，格式同 run_vbench()"""
+        tic = time.time()
+        try:
+            val = self._score(mp4, dim, frames)
+        except Exception as e:
+            self._release_cuda()
+            return -1, time.time() - tic, f"SCORE_ERR:{type(e).__name__}", str(e).strip()[:500]
+        return val, time.time() - tic, "", ""
+
+    def score_all(self, mp4, dims=None):
+        """
+        decode 一次、所有維度共用
+        return ({dim: (score, elapsed, err_msg, err_text)}, decode_time)
+        """
+        dims = list(dims or self.dims)
+        tic = time.time()
+        try:
+            per_dim = decode_frames(mp4, dims)
+        except Exception as e:
+            dec_t = time.time() - tic
+            err = str(e).strip()[:500]
+            return {d: (-1, dec_t, f"DECODE_ERR:{type(e).__name__}", err) for d in dims}, dec_t
+        dec_t = time.time() - tic
+        return {d: self.score(mp4, d, per_dim[d]) for d in dims}, dec_t
+
+    def _release_cuda(self):
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception:
+            pass
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.mov → mp4 轉檔工具（給各 driver 的 producer 共用）
+------------------------------------------------
+probe_video()       : 讀 codec / 解析度 / fps / 長度（ffprobe，沒有就 parse `ffmpeg -i`）
+                      （有 probe_index.ProbeIndex 時 convert_video 改查 sidecar index）
+needs_conversion()  : 要不要轉：.mov 一律轉；其他依容器與 probe 到的 codec（.mkv、HEVC 的 .mp4 也轉）
+convert_video()     : 先 probe，H.264 直接 remux（stream copy），其他 codec 才真的 transcode；
+                      window="center" 時只 transcode 中間視窗（與 patched get_frames 對齊）
+transcode()         : 單支 ffmpeg 轉檔（編碼參數由 CONVERT_PROFILES 決定）
+run_convert_pool()  : N 個轉檔 worker 平行跑，結果依序 / 短的先 丟回 queue
+
+ffmpeg 是外部程序，worker 用 thread 就夠（GIL 不是瓶頸），
+q.put() 滿了會直接卡住 pool → 與原本單一 producer 相同的 backpressure。
+以 bytes 計的 backpressure（tmp 預算 / 剩餘空間）由 admit 在送進 pool 前卡住，見 tmp_budget.py。
+"""
+import os, re, json, math, time, shutil, subprocess, collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import imageio_ffmpeg
+
+CONVERT_ORDERS = ("input", "sjf", "lpt")
+FFMPEG_THREADS = None       # None = ffmpeg 自己決定（≈ 核心數）；cpu_plan 依分到的核心設定
+CONVERT_PLANS  = ("transcode", "auto")
+CONVERT_WINDOWS = ("full", "center")
+
+# 轉檔 profile：只有 scorer 會讀轉出來的 mp4，音軌與原始解析度多半是浪費
+#   audio      : 是否保留 aac 音軌
+#   short_side : 短邊上限（None = 原解析度）；有上限時不走 remux，確保整批輸出解析度一致
+#   gop        : keyframe 間隔（小 → seek 快、decode 起點多）
+# ⚠ short_side 會改變 RAFT / AMT 的輸入解析度，分數可能與 default 略有差異
+CONVERT_PROFILES = {
+    "default":    {"preset": "fast",      "crf": 22, "audio": True,  "short_side": None, "gop": None},
+    "video_only": {"preset": "ultrafast", "crf": 22, "audio": False, "short_side": None, "gop": None},
+    "score":      {"preset": "ultrafast", "crf": 23, "audio": False, "short_side": 512,  "gop": 8},
+    "score_intra":{"preset": "ultrafast", "crf": 23, "audio": False, "short_side": 512,  "gop": 1},
+}
+REMUX_CODECS   = ("h264",)          # OpenCV 直接讀得動、mp4 容器裝得下 → stream copy 即可
+MP4_EXTS       = (".mp4", ".m4v")
+
+
+# ───────────── probe ─────────────
+def _ratio(txt):
+    try:
+        num, den = txt.split("/")
+        return float(num) / float(den) if float(den) != 0 else None
+    except (ValueError, AttributeError):
+        return None
+
+def _ffprobe(path):
+    exe = shutil.which("ffprobe")
+    if not exe:
+        return None
+    out = subprocess.check_output(
+        [exe, "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=codec_name,width,height,avg_frame_rate,nb_frames:format=duration",
+         "-of", "json", path], stderr=subprocess.DEVNULL)
+    meta = json.loads(out.decode("utf-8"))
+    st = (meta.get("streams") or [{}])[0]
+    dur = meta.get("format", {}).get("duration")
+    nb = st.get("nb_frames")
+    return {
+        "codec": st.get("codec_name"),
+        "width": st.get("width"), "height": st.get("height"),
+        "fps": _ratio(st.get("avg_frame_rate")),
+        "nb_frames": int(nb) if nb and str(nb).isdigit() else None,
+        "duration": float(dur) if dur not in (None, "N/A") else None,
+    }
+
+def _ffmpeg_banner(path):
+    """沒有 ffprobe 時：讀 `ffmpeg -i` 的 stderr（不轉碼）"""
+    proc = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-i", path],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+    s = proc.stderr.decode("utf-8", "ignore")
+    info = {"codec": None, "width": None, "height": None,
+            "fps": None, "nb_frames": None, "duration": None}
+    m = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", s)
+    if m:
+        info["duration"] = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+    m = re.search(r"Stream #\S+.*?: Video: (\w+)[^\n]*?, (\d{2,5})x(\d{2,5})", s)
+    if m:
+        info["codec"], info["width"], info["height"] = m.group(1), int(m.group(2)), int(m.group(3))
+    m = re.search(r"Video:[^\n]*?, ([\d.]+) fps", s)
+    if m:
+        info["fps"] = float(m.group(1))
+    return info
+
+def probe_video(path):
+    """return {"codec","width","height","fps","nb_frames","duration"}；拿不到的欄位為 None"""
+    try:
+        info = _ffprobe(path)
+        if info is not None:
+            return info
+    except Exception as e:
+        print(f"[PROBE] ffprobe failed {path}: {e}", flush=True)
+    return _ffmpeg_banner(path)
+
+def needs_conversion(path, info=None, probe=None):
+    """
+    要不要先轉成 mp4（scorer 穩定讀得動的是 H.264 mp4）
+      - .mov 一律轉（舊規則，不用 probe）
+      - 其他看容器（副檔名）與 probe 到的 codec：mp4 且 codec ∈ REMUX_CODECS 才直接用原檔，
+        .mkv / .webm / HEVC 的 .mp4 都轉
+      - probe 不到 codec 時照舊不轉（壞檔交給 evaluate 報錯）
+    info 沒給就查 probe（probe_index.ProbeIndex），沒有 index 就 probe_video
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".mov":
+        return True
+    if info is None:
+        try:
+            info = probe.lookup(path) if probe is not None else probe_video(path)
+        except Exception as e:
+            print(f"[PROBE] failed {path}: {e}", flush=True)
+            return False
+    codec = (info.get("codec") or "").lower()
+    if not codec:
+        return False
+    return ext not in MP4_EXTS or codec not in REMUX_CODECS
+
+def plan_conversion(src, info=None):
+    """'remux' 或 'transcode'"""
+    info = info or probe_video(src)
+    return "remux" if (info.get("codec") or "").lower() in REMUX_CODECS else "transcode"
+
+
+def center_window_frames(info):
+    """
+    只轉中間視窗時要切的 frame 範圍 → (start_frame, n_frames)；不能安全切就回傳 None（整支轉）
+
+    patched get_frames 取 [T//2 - 2s, T//2 + 3s)（前 2 秒、後 3 秒，不對稱），
+    且視窗是用「轉檔後那支 mp4」的 T 重新算的。所以這裡切以中心為準、
+    左右各 H = ceil(3*fps)+1 frame 的對稱視窗：新檔 T' = 2H、T'//2 = H，
+    兩個 extractor 在新檔算出的 frame 正好是原檔那些 frame 平移 T//2-H，
+    interval 的相位也不變 → 分數不變。VisionParser 的中間 5 秒（±2.5s）也落在這個視窗內。
+
+    只有拿得到精確 frame 數（nb_frames）且視窗沒被頭尾 clip 時才切。
+    """
+    fps, total = info.get("fps"), info.get("nb_frames")
+    if not fps or fps <= 0 or not total:
+        return None
+    half = math.ceil(fps * 3) + 1
+    start = total // 2 - half
+    if start < 0 or total // 2 + half > total:
+        return None
+    return start, 2 * half
+
+
+# ───────────── 單支轉檔 ─────────────
+def remux(src, dst):
+    """只換容器不重新編碼；音軌沒有 scorer 會讀，直接丟掉（pcm 音軌也裝不進 mp4）"""
+    tic = time.time()
+    try:
+        subprocess.run(
+            [imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-i", src,
+             "-map", "0:v:0", "-c:v", "copy", "-an", dst],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        return None, time.time() - tic, e.stderr.decode(errors="ignore")
+    return dst, time.time() - tic, ""
+
+def convert_video(src, dst, plan="transcode", window="full", profile="default", cache=None,
+                  probe=None):
+    """
+    plan="transcode" : 一律 libx264 重新編碼（舊行為）
+    plan="auto"      : 先 probe codec，能 remux 就 remux，失敗再退回 transcode
+    window="center"  : transcode 時只編中間視窗（remux 本來就幾乎不花時間，仍整支 copy）
+    profile          : CONVERT_PROFILES 的 key
+    cache            : conv_cache.ConversionCache；有給就不寫 dst，結果放進快取並回傳快取路徑
+    probe            : probe_index.ProbeIndex；有給就查 sidecar index，不再每次 probe
+    return (dst 或 None, conv_time, mode, stderr_text)，
+    mode ∈ cache_hit / remux / transcode / transcode_center / failed
+    """
+    if cache is not None:
+        return _convert_cached(src, cache, plan, window, profile, probe)
+    tic = time.time()
+    can_remux = CONVERT_PROFILES[profile]["short_side"] is None
+    _probe = probe.lookup if probe is not None else probe_video
+    info = _probe(src) if ((plan == "auto" and can_remux) or window == "center") else {}
+    if plan == "auto" and can_remux and plan_conversion(src, info) == "remux":
+        out, _, err = remux(src, dst)
+        if out:
+            return out, time.time() - tic, "remux", ""
+        print(f"[CONVERT] remux failed, fallback to transcode: {src}", flush=True)
+    win = center_window_frames(info) if window == "center" else None
+    out, _, err = transcode(src, dst, win, profile)
+    mode = ("transcode_center" if win else "transcode") if out else "failed"
+    return out, time.time() - tic, mode, err
+
+def _encode_args(profile, window=None):
+    prof = CONVERT_PROFILES[profile]
+    vf = []
+    if window:
+        start, n = window
+        vf.append(f"trim=start_frame={start}:end_frame={start + n},setpts=PTS-STARTPTS")
+    if prof["short_side"]:
+        s = prof["short_side"]      # 只縮不放大，-2 保持比例且為偶數；短邊本身也取偶數（yuv420p 要求）
+        vf.append(f"scale='if(lt(iw,ih),trunc(min(iw,{s})/2)*2,-2)':'if(lt(iw,ih),-2,trunc(min(ih,{s})/2)*2)'")
+    args = ["-c:v", "libx264", "-preset", prof["preset"], "-crf", str(prof["crf"])]
+    if vf:
+        args += ["-vf", ",".join(vf)]
+    if prof["gop"]:
+        args += ["-g", str(prof["gop"]), "-keyint_min", str(prof["gop"]), "-sc_threshold", "0"]
+    # 只轉中間視窗時音軌長度不跟著切會讓容器長度對不上，一律不帶音軌
+    if prof["audio"] and not window:
+        args += ["-c:a", "aac", "-b:a", "128k"]
+    else:
+        args += ["-an"]
+    return args
+
+def _convert_cached(src, cache, plan, window, profile, probe=None):
+    tic = time.time()
+    fp = probe.fingerprint(src) if probe is not None else None
+    key = cache.key(src, f"{plan}|{window}|{profile}", fp)
+    hit = cache.get(key)
+    if hit:
+        return hit, time.time() - tic, "cache_hit", ""
+    tmp = cache.tmp_path(key)
+    out, _, mode, err = convert_video(src, tmp, plan, window, profile, probe=probe)
+    if not out:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None, time.time() - tic, mode, err
+    return cache.put(key, tmp), time.time() - tic, mode, ""
+
+def set_ffmpeg_threads(n):
+    """之後這個 process 的 transcode 都帶 -threads n（decode + encode）"""
+    global FFMPEG_THREADS
+    FFMPEG_THREADS = n
+
+def _thread_args():
+    return ["-threads", str(FFMPEG_THREADS)] if FFMPEG_THREADS else []
+
+def transcode(src, dst, window=None, profile="default"):
+    """
+    window : None 整支轉；(start_frame, n_frames) 只轉這段
+             （用 trim 依 decode 順序切，與 cv2 的 frame 編號一致；不靠 timestamp seek）
+    return (dst 或 None, conv_time, stderr_text)
+    """
+    tic = time.time()
+    try:
+        subprocess.run(
+            [imageio_ffmpeg.get_ffmpeg_exe(), "-y", *_thread_args(), "-i", src,
+             *_encode_args(profile, window), *_thread_args(), dst],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        return None, time.time() - tic, e.stderr.decode(errors="ignore")
+    return dst, time.time() - tic, ""
+
+
+# ───────────── 轉檔 pool ─────────────
+def _job_size(task):
+    """短工作優先的成本估計：先用檔案大小（只要一次 stat）"""
+    try:
+        return os.path.getsize(task[0])
+    except OSError:
+        return 0
+
+def run_convert_pool(task_list, convert_one, emit, n_workers=1, order="input", cost=None, admit=None):
+    """
+    task_list   : [(orig_path, ...), ...]
+    convert_one : task -> queue item（在 worker thread 裡跑）
+    emit        : queue item -> None（通常是 q.put）
+    order       : "input" 保持輸入順序；"sjf" 小檔先轉、先轉完先送；
+                  "lpt" 預估成本最高的先做（job_cost.make_cost_fn），多個 consumer 時尾巴最短
+    cost        : task -> 成本估計（lpt 用；沒給就用檔案大小）
+    admit       : (task, drain) -> None，送進 pool 前呼叫、可以卡住（tmp_budget.TmpBudget.admit）；
+                  drain() 把最舊的已送出工作 emit 掉（沒有 → False），等的時候已轉好的不會卡在 pool 裡
+    同時在跑的工作最多 n_workers*2 個，不會一次把整個 task_list 丟進 pool。
+    """
+    if order not in CONVERT_ORDERS:
+        raise ValueError(f"order must be one of {CONVERT_ORDERS}, got {order!r}")
+    n_workers = max(1, n_workers)
+    if order == "sjf":
+        task_list = sorted(task_list, key=_job_size)
+    elif order == "lpt":
+        task_list = list(task_list)
+        with ThreadPoolExecutor(max_workers=n_workers * 4) as pool:    # probe / stat 平行
+            costs = list(pool.map(cost or _job_size, task_list))
+        task_list = [t for _, t in sorted(zip(costs, task_list), key=lambda x: -x[0])]
+        if costs:
+            print(f"[SCHED] lpt: {len(costs)} jobs, est. total {sum(costs):.0f}s, "
+                  f"max {max(costs):.1f}s", flush=True)
+
+    window = n_workers * 2
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        def drain():
+            if not pending:
+                return False
+            _drain(pending, emit, order)
+            return True
+
+        for task in task_list:
+            if admit is not None:
+                admit(task, drain)
+            pending.append(pool.submit(convert_one, task))
+            while len(pending) >= window:
+                _drain(pending, emit, order)
+        while pending:
+            _drain(pending, emit, order)
+
+def _drain(pending, emit, order):
+    if order in ("input", "lpt"):
+        emit(pending.popleft().result())     # 依（排序後的）輸入順序，最舊的做完才送
+        return
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for fut in [f for f in pending if f in done]:
+        pending.remove(fut)
+        emit(fut.result())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+卡住的影片不再永遠卡住 consumer
+------------------------------------------------
+timeout_for()       : 依影片長度算期限：base + per_sec × 秒數（批次就是加總）
+run_with_deadline() : subprocess.run 的替代品；超時整個 process group 先 TERM 再 KILL
+                      （evaluate 會再開子程序 / 佔著 CUDA，只殺 parent 不夠）
+TimeoutTracker      : 每次超時記一行到 <output_path>/timeouts.tsv；
+                      同一支累計 max_timeouts 次就寫進 quarantine.tsv，之後的 run 直接跳過
+supervise()         : main 盯著 consumer 的 heartbeat（Manager dict）；
+                      in-process 算分（--warm_workers）卡住時 subprocess timeout 管不到 →
+                      SIGKILL 那個 consumer（連同它登記的 evaluate process group）、
+                      幫它補失敗 row、再開一個新的頂上
+"""
+import os, time, signal, subprocess
+
+from batch_bisect import Quarantine
+
+
+_duration_warned = False
+
+def video_duration(path, probe=None):
+    """秒數；拿不到回傳 None（第一次拿不到時印一次警告：期限會退回 fallback_secs 估）"""
+    global _duration_warned
+    try:
+        if probe is not None:
+            d = probe.lookup(path).get("duration")
+        else:
+            from video_convert import probe_video
+            d = probe_video(path).get("duration")
+        why = "no duration in probe"
+    except Exception as e:
+        d, why = None, f"{type(e).__name__}: {e}"
+    if d is None and not _duration_warned:
+        _duration_warned = True
+        print(f"[TIMEOUT] video duration unavailable ({path}: {why}); "
+              f"deadlines fall back to base + per_sec x default length", flush=True)
+    return d
+
+def timeout_for(durations, base, per_sec, fallback_secs=60.0):
+    """durations：一支或多支影片的秒數（None 用 fallback_secs 估）；base<=0 表示不設期限"""
+    if not base or base <= 0:
+        return None
+    if not isinstance(durations, (list, tuple)):
+        durations = [durations]
+    return base + per_sec * sum(d if d else fallback_secs for d in durations)
+
+
+def _kill_group(proc, grace=10.0):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=grace)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+def run_with_deadline(cmd, timeout=None, check=False, capture_output=False, on_child=None, **kw):
+    """
+    同 subprocess.run（回傳 CompletedProcess，check=True 時 rc!=0 丟 CalledProcessError），
+    超時丟 subprocess.TimeoutExpired；子程序在自己的 session，超時整組殺掉
+    on_child : (pgid 或 None) -> None；子程序開起來時給它的 process group、結束後給 None
+               （supervise 殺 consumer 時要連這組一起殺，見 kill_child_group）
+    """
+    if capture_output:
+        kw["stdout"] = kw["stderr"] = subprocess.PIPE
+    proc = subprocess.Popen(cmd, start_new_session=True, **kw)
+    if on_child:
+        on_child(proc.pid)                          # 新 session：pgid == pid
+    try:
+        out, err = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        _kill_group(proc)
+        e.output, e.stderr = proc.communicate()     # 殺掉前印出來的 log 留給 caller
+        raise
+    except BaseException:
+        _kill_group(proc, grace=1.0)
+        raise
+    finally:
+        if on_child:
+            on_child(None)
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out, err)
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+
+class TimeoutTracker:
+    """timeouts.tsv：videoid \\t stage \\t 秒數 \\t 時間；次數夠多就隔離"""
+    def __init__(self, path, quarantine_path, max_timeouts=2):
+        self.path = path
+        self.quarantine = Quarantine(quarantine_path)
+        self.max_timeouts = max_timeouts
+        self._counts = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                for line in f:
+                    vid = line.split("\t", 1)[0]
+                    if vid.strip():
+                        self._counts[vid] = self._counts.get(vid, 0) + 1
+
+    def record(self, vid, stage, secs, video_path=""):
+        """return True 表示這支已經被隔離"""
+        line = f"{vid}\t{stage}\t{secs:.1f}\t{time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+        n = self._counts[vid] = self._counts.get(vid, 0) + 1
+        if n >= self.max_timeouts:
+            self.quarantine.add(vid, video_path, f"TIMEOUT x{n} ({stage})")
+            return True
+        return False
+
+
+def kill_child_group(info):
+    """consumer 在 busy 的 info["pgid"] 登記的 evaluate process group 整組 SIGKILL（沒有 / 已結束就略過）"""
+    pgid = info.get("pgid")
+    if pgid:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def supervise(procs, spawn, busy, on_stuck, poll=5.0):
+    """
+    procs    : 已 start 的 consumer Process list
+    spawn    : (i) -> 新的、已 start 的 consumer，頂替 procs[i]（被殺掉 / crash 的）；i 讓它沿用同一個位置（例如分到的核心）
+    busy     : Manager dict，consumer 處理每支影片前寫 {pid: (deadline, info, started)}、做完刪掉；
+               evaluate 子程序跑著時 info["pgid"] 是它的 process group（在自己的 session，
+               只殺 consumer 它會變孤兒、繼續佔 GPU 跟 tmp 的 mp4）→ 先殺這組再殺 consumer
+    on_stuck : (info, reason, elapsed) -> None，幫卡住的影片補失敗 row / 記 timeout
+    全部 consumer 正常結束才 return
+    """
+    while any(p.is_alive() for p in procs):
+        time.sleep(poll)
+        now = time.time()
+        for i, p in enumerate(procs):
+            ent = busy.get(p.pid)
+            if not ent:
+                continue
+            deadline, info, started = ent
+            if p.is_alive() and deadline and now > deadline:
+                reason = "timeout"
+                kill_child_group(info)
+                p.kill()
+                p.join()
+            elif not p.is_alive() and p.exitcode not in (0, None):
+                reason = f"crash(rc={p.exitcode})"
+                kill_child_group(info)
+            else:
+                continue
+            busy.pop(p.pid, None)
+            print(f"[WATCHDOG] consumer {p.pid} {reason} on {info.get('vid')} "
+                  f"after {now - started:.0f}s → replace", flush=True)
+            on_stuck(info, reason, now - started)
+            procs[i] = spawn(i)
+    for p in procs:
+        p.join()